@@ -23,6 +23,7 @@ from .dirs import get_clan_flake_toplevel
 from .errors import ClanCmdError, ClanError
 from .profiler import profile
 from .ssh import cli as ssh_cli
+from .tracing import TRACER
 
 log = logging.getLogger(__name__)
 
@@ -60,6 +61,14 @@ def create_parser(prog: str | None = None) -> argparse.ArgumentParser:
         action="store_true",
     )
 
+    parser.add_argument(
+        "--trace",
+        help="Write a trace of where the time is spent to this file, "
+        "as Chrome trace JSON or as OpenTelemetry JSON if it ends with .otlp.json",
+        metavar="FILE",
+        type=Path,
+    )
+
     parser.add_argument(
         "--option",
         help="Nix option to set",
@@ -145,6 +154,9 @@ def main() -> None:
     else:
         setup_logging(logging.INFO, root_log_name=__name__.split(".")[0])
 
+    if args.trace:
+        TRACER.output = args.trace
+
     if not hasattr(args, "func"):
         return
 
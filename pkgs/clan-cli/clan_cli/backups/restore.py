@@ -1,14 +1,19 @@
 import argparse
-import json
 import subprocess
+from typing import Any
 
 from ..errors import ClanError
 from ..machines.machines import Machine
 
 
+def backup_config(machine: Machine) -> tuple[dict[str, Any], dict[str, Any]]:
+    # evaluate both attributes in one nix process
+    data = machine.eval_many(["config.clanCore.backups", "config.clanCore.state"])
+    return data["config.clanCore.backups"], data["config.clanCore.state"]
+
+
 def restore_service(machine: Machine, name: str, provider: str, service: str) -> None:
-    backup_metadata = json.loads(machine.eval_nix("config.clanCore.backups"))
-    backup_folders = json.loads(machine.eval_nix("config.clanCore.state"))
+    backup_metadata, backup_folders = backup_config(machine)
     folders = backup_folders[service]["folders"]
     env = {}
     env["NAME"] = name
@@ -54,7 +59,7 @@ def restore_backup(
     service: str | None = None,
 ) -> None:
     if service is None:
-        backup_folders = json.loads(machine.eval_nix("config.clanCore.state"))
+        _, backup_folders = backup_config(machine)
         for _service in backup_folders:
             restore_service(machine, name, provider, _service)
     else:
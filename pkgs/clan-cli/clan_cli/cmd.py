@@ -4,14 +4,15 @@ import select
 import shlex
 import subprocess
 import sys
-import weakref
-from datetime import datetime, timedelta
+import threading
 from enum import Enum
 from pathlib import Path
 from typing import IO, Any
 
 from .custom_logger import get_caller
 from .errors import ClanCmdError, CmdOut
+from .output_capture import MAX_STDERR_BYTES, READ_SIZE, OutputCapture
+from .tracing import normalize_command, span
 
 glog = logging.getLogger(__name__)
 
@@ -23,10 +24,17 @@ class Log(Enum):
     NONE = 4
 
 
-def handle_output(process: subprocess.Popen, log: Log) -> tuple[str, str]:
+def handle_output(
+    process: subprocess.Popen,
+    log: Log,
+    stdout: OutputCapture | None = None,
+    stderr: OutputCapture | None = None,
+) -> tuple[str, str]:
+    if stdout is None:
+        stdout = OutputCapture()
+    if stderr is None:
+        stderr = OutputCapture()
     rlist = [process.stdout, process.stderr]
-    stdout_buf = b""
-    stderr_buf = b""
 
     while len(rlist) != 0:
         r, _, _ = select.select(rlist, [], [], 0.1)
@@ -38,7 +46,7 @@ def handle_output(process: subprocess.Popen, log: Log) -> tuple[str, str]:
 
         def handle_fd(fd: IO[Any] | None) -> bytes:
             if fd and fd in r:
-                read = os.read(fd.fileno(), 4096)
+                read = os.read(fd.fileno(), READ_SIZE)
                 if len(read) != 0:
                     return read
                 rlist.remove(fd)
@@ -48,83 +56,74 @@ def handle_output(process: subprocess.Popen, log: Log) -> tuple[str, str]:
         if ret and log in [Log.STDOUT, Log.BOTH]:
             sys.stdout.buffer.write(ret)
             sys.stdout.flush()
+        stdout.write(ret)
 
-        stdout_buf += ret
         ret = handle_fd(process.stderr)
-
         if ret and log in [Log.STDERR, Log.BOTH]:
             sys.stderr.buffer.write(ret)
             sys.stderr.flush()
-        stderr_buf += ret
-    return stdout_buf.decode("utf-8"), stderr_buf.decode("utf-8")
-
-
-class TimeTable:
-    """
-    This class is used to store the time taken by each command
-    and print it at the end of the program if env PERF=1 is set.
-    """
-
-    def __init__(self) -> None:
-        self.table: dict[str, timedelta] = {}
-        weakref.finalize(self, self.table_print)
-
-    def table_print(self) -> None:
-        if os.getenv("PERF") != "1":
-            return
-        print("======== CMD TIMETABLE ========")
-
-        # Sort the table by time in descending order
-        sorted_table = sorted(
-            self.table.items(), key=lambda item: item[1], reverse=True
-        )
-
-        for k, v in sorted_table:
-            # Check if timedelta is greater than 1 second
-            if v.total_seconds() > 1:
-                # Print in red
-                print(f"\033[91mTook {v}s\033[0m for command: '{k}'")
-            else:
-                # Print in default color
-                print(f"Took {v} for command: '{k}'")
+        stderr.write(ret)
+    return stdout.decode(), stderr.decode()
 
-    def add(self, cmd: str, time: timedelta) -> None:
-        if cmd in self.table:
-            self.table[cmd] += time
-        else:
-            self.table[cmd] = time
 
-
-TIME_TABLE = TimeTable()
+def _write_stdin(process: subprocess.Popen, stdin_data: bytes) -> None:
+    assert process.stdin is not None
+    try:
+        process.stdin.write(stdin_data)
+    except BrokenPipeError:
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
 
 
 def run(
     cmd: list[str],
     *,
+    stdin_data: bytes | None = None,
     env: dict[str, str] | None = None,
     cwd: Path = Path.cwd(),
     log: Log = Log.STDERR,
     check: bool = True,
     error_msg: str | None = None,
+    stdout: OutputCapture | None = None,
+    stderr: OutputCapture | None = None,
 ) -> CmdOut:
+    """
+    Run cmd and capture its output.
+    stdin_data is written to the stdin of the command while its output is read.
+    Pass an OutputCapture as stdout/stderr to limit how much output is kept in memory
+    or to stream it to a file or callback while the command is running.
+    By default stdout is kept in full and only the last MAX_STDERR_BYTES of stderr.
+    """
+    if stdout is None:
+        stdout = OutputCapture()
+    if stderr is None:
+        stderr = OutputCapture(max_bytes=MAX_STDERR_BYTES)
     glog.debug(f"$: {shlex.join(cmd)} \nCaller: {get_caller()}")
-    tstart = datetime.now()
-
-    # Start the subprocess
-    process = subprocess.Popen(
-        cmd,
-        cwd=str(cwd),
-        env=env,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    )
-    stdout_buf, stderr_buf = handle_output(process, log)
 
-    rc = process.wait()
-    tend = datetime.now()
-
-    global TIME_TABLE
-    TIME_TABLE.add(shlex.join(cmd), tend - tstart)
+    with span(normalize_command(cmd), category="cmd") as cmd_span:
+        # Start the subprocess
+        process = subprocess.Popen(
+            cmd,
+            cwd=str(cwd),
+            env=env,
+            stdin=subprocess.PIPE if stdin_data is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if stdin_data is not None:
+            # a thread, so a full stdout pipe cannot block writing the input
+            writer = threading.Thread(target=_write_stdin, args=(process, stdin_data))
+            writer.start()
+        stdout_buf, stderr_buf = handle_output(process, log, stdout, stderr)
+        if stdin_data is not None:
+            writer.join()
+
+        rc = process.wait()
+        cmd_span.attributes["returncode"] = rc
 
     # Wait for the subprocess to finish
     cmd_out = CmdOut(
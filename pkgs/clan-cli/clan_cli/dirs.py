@@ -66,6 +66,22 @@ def user_cache_dir() -> Path:
         return Path(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")))
 
 
+def user_eval_cache_dir() -> Path:
+    return user_cache_dir() / "clan" / "eval"
+
+
+def user_nix_config_cache_dir() -> Path:
+    return user_cache_dir() / "clan" / "nix-config"
+
+
+def user_tool_cache_dir() -> Path:
+    return user_cache_dir() / "clan" / "tools"
+
+
+def user_sops_cache_dir() -> Path:
+    return user_cache_dir() / "clan" / "sops"
+
+
 def user_gcroot_dir() -> Path:
     p = user_config_dir() / "clan" / "gcroots"
     p.mkdir(parents=True, exist_ok=True)
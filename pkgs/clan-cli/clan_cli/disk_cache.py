@@ -0,0 +1,170 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections.abc import Callable
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Any
+
+log = logging.getLogger(__name__)
+
+# directory -> [entries, bytes], an estimate of the size of each cache,
+# so a write does not have to scan the whole directory to decide about eviction
+_usage: dict[Path, list[int]] = {}
+_usage_lock = threading.Lock()
+
+
+def cache_key(*parts: Any) -> str:
+    """
+    Derive a stable cache key from json serializable parts
+    """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class DiskCache:
+    """
+    A small json backed key/value cache living in a directory.
+    Every entry is stored in its own file, which makes writes atomic and lets
+    several clan processes share the same cache without locking.
+    Entries are evicted in least recently used order (based on the file mtime,
+    which is bumped on every hit) once max_entries or max_bytes is exceeded.
+    The directory is scanned once per process, afterwards writes keep an estimate
+    of its size and eviction makes room for a tenth of the limits at once.
+    """
+
+    def __init__(
+        self,
+        directory: Path,
+        max_entries: int = 4096,
+        max_bytes: int = 64 * 1024 * 1024,
+    ) -> None:
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # allows to disable all persistent caches for debugging
+        self.enabled = os.environ.get("CLAN_NO_CACHE", "") == ""
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.json"
+
+    def get(self, key: str) -> Any | None:
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, json.JSONDecodeError) as e:
+            log.debug(f"ignoring corrupted cache entry {path}: {e}")
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry.get("value")
+
+    def set(self, key: str, value: Any, **meta: Any) -> None:
+        if not self.enabled:
+            return
+        path = self._path(key)
+        try:
+            old_size: int | None = path.stat().st_size
+        except OSError:
+            old_size = None
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with NamedTemporaryFile(
+                mode="w", dir=self.directory, suffix=".tmp", delete=False
+            ) as f:
+                json.dump(dict(meta=meta, value=value), f)
+                size = f.tell()
+            os.rename(f.name, path)
+        except OSError as e:
+            # the cache is an optimization, never fail because of it
+            log.debug(f"failed to write cache entry to {self.directory}: {e}")
+            return
+        with _usage_lock:
+            usage = _usage.get(self.directory)
+            if usage is None:
+                entries = self._entries()
+                usage = [len(entries), sum(st.st_size for _, st in entries)]
+                _usage[self.directory] = usage
+            elif old_size is None:
+                usage[0] += 1
+                usage[1] += size
+            else:
+                usage[1] += size - old_size
+            full = usage[0] > self.max_entries or usage[1] > self.max_bytes
+        if full:
+            self.evict()
+
+    def remove(self, key: str) -> None:
+        self._remove(self._path(key))
+
+    def _remove(self, path: Path) -> None:
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+    def _entries(self) -> list[tuple[Path, os.stat_result]]:
+        entries = []
+        try:
+            for path in self.directory.glob("*.json"):
+                try:
+                    entries.append((path, path.stat()))
+                except FileNotFoundError:
+                    continue
+        except OSError:
+            return []
+        return entries
+
+    def evict(self) -> None:
+        entries = self._entries()
+        count = len(entries)
+        total = sum(st.st_size for _, st in entries)
+        if count > self.max_entries or total > self.max_bytes:
+            # leave some room, so not every following write has to evict again
+            max_entries = self.max_entries - self.max_entries // 10
+            max_bytes = self.max_bytes - self.max_bytes // 10
+            # oldest access first
+            entries.sort(key=lambda e: e[1].st_mtime)
+            for path, st in entries:
+                if count <= max_entries and total <= max_bytes:
+                    break
+                self._remove(path)
+                count -= 1
+                total -= st.st_size
+        with _usage_lock:
+            _usage[self.directory] = [count, total]
+
+    def invalidate(self, pred: Callable[[dict[str, Any]], bool]) -> None:
+        """
+        Remove all entries for which pred(meta) returns True
+        """
+        for path, _ in self._entries():
+            try:
+                with open(path) as f:
+                    meta = json.load(f).get("meta", {})
+            except (OSError, json.JSONDecodeError):
+                self._remove(path)
+                continue
+            if pred(meta):
+                self._remove(path)
+        self._forget_usage()
+
+    def clear(self) -> None:
+        for path, _ in self._entries():
+            self._remove(path)
+        self._forget_usage()
+
+    def _forget_usage(self) -> None:
+        # the next write scans the directory again
+        with _usage_lock:
+            _usage.pop(self.directory, None)
@@ -3,46 +3,75 @@ import importlib
 import logging
 
 from ..machines.machines import Machine
+from .public_modules import FactStoreBase
+from .secret_modules import SecretStoreBase
 
 log = logging.getLogger(__name__)
 
 
-def check_secrets(machine: Machine, service: None | str = None) -> bool:
+def fact_stores(machine: Machine) -> tuple[SecretStoreBase, FactStoreBase]:
+    """
+    Instantiate the secret and the public fact store of a machine
+    """
     secret_facts_module = importlib.import_module(machine.secret_facts_module)
     secret_facts_store = secret_facts_module.SecretStore(machine=machine)
     public_facts_module = importlib.import_module(machine.public_facts_module)
     public_facts_store = public_facts_module.FactStore(machine=machine)
+    return secret_facts_store, public_facts_store
 
-    missing_secret_facts = []
-    missing_public_facts = []
-    if service:
-        services = [service]
-    else:
+
+def missing_facts(
+    machine: Machine,
+    secret_facts_store: SecretStoreBase,
+    public_facts_store: FactStoreBase,
+    services: list[str] | None = None,
+) -> dict[str, list[str]]:
+    """
+    Map every service with missing facts to the names of those facts.
+    All services are checked with a single lookup in each store.
+    """
+    if services is None:
         services = list(machine.facts_data.keys())
+    secret_facts = []
+    public_facts = []
     for service in services:
         for secret_fact in machine.facts_data[service]["secret"]:
             if isinstance(secret_fact, str):
                 secret_name = secret_fact
             else:
                 secret_name = secret_fact["name"]
-            if not secret_facts_store.exists(service, secret_name):
-                log.info(
-                    f"Secret fact '{secret_fact}' for service {service} is missing."
-                )
-                missing_secret_facts.append((service, secret_name))
-
+            secret_facts.append((service, secret_name))
         for public_fact in machine.facts_data[service]["public"]:
-            if not public_facts_store.exists(service, public_fact):
-                log.info(
-                    f"Public fact '{public_fact}' for service {service} is missing."
-                )
-                missing_public_facts.append((service, public_fact))
+            public_facts.append((service, public_fact))
+
+    existing_secret_facts = secret_facts_store.list_existing(secret_facts)
+    existing_public_facts = public_facts_store.list_existing(public_facts)
+
+    missing: dict[str, list[str]] = {}
+    for service, secret_name in secret_facts:
+        if (service, secret_name) not in existing_secret_facts:
+            log.info(f"Secret fact '{secret_name}' for service {service} is missing.")
+            missing.setdefault(service, []).append(secret_name)
+    for service, public_fact in public_facts:
+        if (service, public_fact) not in existing_public_facts:
+            log.info(f"Public fact '{public_fact}' for service {service} is missing.")
+            missing.setdefault(service, []).append(public_fact)
 
-    log.debug(f"missing_secret_facts: {missing_secret_facts}")
-    log.debug(f"missing_public_facts: {missing_public_facts}")
-    if missing_secret_facts or missing_public_facts:
-        return False
-    return True
+    return missing
+
+
+def check_secrets(
+    machine: Machine,
+    service: None | str = None,
+    secret_facts_store: SecretStoreBase | None = None,
+    public_facts_store: FactStoreBase | None = None,
+) -> bool:
+    if secret_facts_store is None or public_facts_store is None:
+        secret_facts_store, public_facts_store = fact_stores(machine)
+    services = [service] if service else None
+    return not missing_facts(
+        machine, secret_facts_store, public_facts_store, services=services
+    )
 
 
 def check_command(args: argparse.Namespace) -> None:
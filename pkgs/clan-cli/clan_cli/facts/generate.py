@@ -1,19 +1,22 @@
 import argparse
-import importlib
 import logging
 import os
 import subprocess
 from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 from clan_cli.cmd import run
 
 from ..errors import ClanError
-from ..git import commit_files
+from ..git import batch_commit, commit_files
+from ..machines.list import list_machines
 from ..machines.machines import Machine
 from ..nix import nix_shell
-from .check import check_secrets
+from ..tracing import propagate, span
+from .check import fact_stores, missing_facts
 from .public_modules import FactStoreBase
 from .secret_modules import SecretStoreBase
 
@@ -29,20 +32,17 @@ def read_multiline_input(prompt: str = "Finish with Ctrl-D") -> str:
     return proc.stdout
 
 
-def generate_service_facts(
+def run_generator(
     machine: Machine,
     service: str,
-    secret_facts_store: SecretStoreBase,
-    public_facts_store: FactStoreBase,
     tmpdir: Path,
-    prompt: Callable[[str], str],
-) -> bool:
+    prompt_value: str | None = None,
+) -> tuple[Path, Path]:
+    """
+    Run the generator of a service in a sandbox.
+    Returns the directories the facts and the secrets were written to.
+    """
     service_dir = tmpdir / service
-    # check if all secrets exist and generate them if at least one is missing
-    needs_regeneration = not check_secrets(machine, service=service)
-    log.debug(f"{service} needs_regeneration: {needs_regeneration}")
-    if not needs_regeneration:
-        return False
     if not isinstance(machine.flake, Path):
         msg = f"flake is not a Path: {machine.flake}"
         msg += "fact/secret generation is only supported for local flakes"
@@ -59,8 +59,7 @@ def generate_service_facts(
         generator = machine.facts_data[service]["generator"]
     else:
         generator = machine.facts_data[service]["generator"]["finalScript"]
-        if machine.facts_data[service]["generator"]["prompt"]:
-            prompt_value = prompt(machine.facts_data[service]["generator"]["prompt"])
+        if prompt_value is not None:
             env["prompt_value"] = prompt_value
     # fmt: off
     cmd = nix_shell(
@@ -87,6 +86,21 @@ def generate_service_facts(
         cmd,
         env=env,
     )
+    return facts_dir, secrets_dir
+
+
+def store_service_facts(
+    machine: Machine,
+    service: str,
+    secret_facts_store: SecretStoreBase,
+    public_facts_store: FactStoreBase,
+    facts_dir: Path,
+    secrets_dir: Path,
+) -> None:
+    """
+    Move the generated facts and secrets of a service into the stores and commit them
+    """
+    generator = machine.facts_data[service]["generator"]
     files_to_commit = []
     # store secrets
     for secret in machine.facts_data[service]["secret"]:
@@ -101,7 +115,7 @@ def generate_service_facts(
         secret_file = secrets_dir / secret_name
         if not secret_file.is_file():
             msg = f"did not generate a file for '{secret_name}' when running the following command:\n"
-            msg += generator
+            msg += generator if isinstance(generator, str) else generator["finalScript"]
             raise ClanError(msg)
         secret_path = secret_facts_store.set(
             service, secret_name, secret_file.read_bytes(), groups
@@ -124,56 +138,159 @@ def generate_service_facts(
         machine.flake_dir,
         f"Update facts/secrets for service {service} in machine {machine.name}",
     )
-    return True
 
 
-def generate_facts(
-    machine: Machine,
-    prompt: None | Callable[[str], str] = None,
-) -> bool:
-    secret_facts_module = importlib.import_module(machine.secret_facts_module)
-    secret_facts_store = secret_facts_module.SecretStore(machine=machine)
+def _ask_prompt(
+    machine: Machine, service: str, prompt: Callable[[str], str]
+) -> str | None:
+    generator = machine.facts_data[service]["generator"]
+    if isinstance(generator, str) or not generator["prompt"]:
+        return None
+    return prompt(generator["prompt"])
 
-    public_facts_module = importlib.import_module(machine.public_facts_module)
-    public_facts_store = public_facts_module.FactStore(machine=machine)
 
-    if prompt is None:
+def default_prompt(text: str) -> str:
+    print(f"{text}: ")
+    return read_multiline_input()
+
+
+@dataclass
+class ServiceJob:
+    machine: Machine
+    service: str
+    secret_facts_store: SecretStoreBase
+    public_facts_store: FactStoreBase
+    prompt_value: str | None = None
 
-        def prompt_func(text: str) -> str:
-            print(f"{text}: ")
-            return read_multiline_input()
 
-        prompt = prompt_func
+def generate_facts_for_machines(
+    machines: list[Machine],
+    prompt: None | Callable[[str], str] = None,
+    jobs: int | None = None,
+) -> bool:
+    """
+    Generate the missing facts of all services of the given machines.
+    Prompts are asked upfront, then the generators run in parallel,
+    at most `jobs` at a time (default: number of CPUs).
+    Writing to the fact stores and committing is serialized
+    and all changes end up in a single commit.
+    """
+    if prompt is None:
+        prompt = default_prompt
+    max_workers = jobs or os.cpu_count() or 1
+
+    # evaluating the machines is the slow part of checking for missing facts
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda machine: machine.facts_data, machines))
 
-    was_regenerated = False
-    with TemporaryDirectory() as tmp:
-        tmpdir = Path(tmp)
+    service_jobs = []
+    for machine in machines:
+        # the stores are shared by all services of the machine
+        secret_facts_store, public_facts_store = fact_stores(machine)
+        # generate the facts of a service if at least one of them is missing
+        missing = missing_facts(machine, secret_facts_store, public_facts_store)
         for service in machine.facts_data:
-            was_regenerated |= generate_service_facts(
-                machine=machine,
-                service=service,
-                secret_facts_store=secret_facts_store,
-                public_facts_store=public_facts_store,
-                tmpdir=tmpdir,
-                prompt=prompt,
+            if service not in missing:
+                continue
+            log.debug(f"{machine.name}/{service} needs regeneration")
+            service_jobs.append(
+                ServiceJob(machine, service, secret_facts_store, public_facts_store)
             )
 
-    if was_regenerated:
-        # flush caches to make sure the new secrets are available in evaluation
-        machine.flush_caches()
-    else:
+    if not service_jobs:
         print("All secrets and facts are already up to date")
-    return was_regenerated
+        return False
+
+    # prompts need the terminal, so they are asked before the generators run
+    for job in service_jobs:
+        job.prompt_value = _ask_prompt(job.machine, job.service, prompt)
+
+    if len(machines) == 1:
+        commit_message = f"Update facts/secrets for machine {machines[0].name}"
+    else:
+        commit_message = f"Update facts/secrets for {len(machines)} machines"
+    failed = []
+    regenerated: dict[str, Machine] = {}
+    with (
+        span("facts-generate", machines=len(machines)),
+        TemporaryDirectory() as tmp,
+        batch_commit(commit_message),
+        ThreadPoolExecutor(max_workers=max_workers) as executor,
+    ):
+
+        @propagate
+        def generate(job: ServiceJob) -> tuple[Path, Path]:
+            with span("generator", machine=job.machine.name, service=job.service):
+                return run_generator(
+                    job.machine,
+                    job.service,
+                    Path(tmp) / job.machine.name,
+                    job.prompt_value,
+                )
+
+        futures = {executor.submit(generate, job): job for job in service_jobs}
+        for future in as_completed(futures):
+            job = futures[future]
+            name = f"{job.machine.name}/{job.service}"
+            try:
+                facts_dir, secrets_dir = future.result()
+                # the stores and git are only touched from this thread
+                store_service_facts(
+                    job.machine,
+                    job.service,
+                    job.secret_facts_store,
+                    job.public_facts_store,
+                    facts_dir,
+                    secrets_dir,
+                )
+            except Exception as e:
+                log.error(f"failed to generate facts for {name}: {e}")
+                failed.append(name)
+                continue
+            regenerated[job.machine.name] = job.machine
+
+    # flush caches to make sure the new secrets are available in evaluation
+    for machine in regenerated.values():
+        machine.flush_caches()
+    if failed:
+        raise ClanError(f"failed to generate facts for {', '.join(sorted(failed))}")
+    return len(regenerated) != 0
+
+
+def generate_facts(
+    machine: Machine,
+    prompt: None | Callable[[str], str] = None,
+) -> bool:
+    return generate_facts_for_machines([machine], prompt)
 
 
 def generate_command(args: argparse.Namespace) -> None:
-    machine = Machine(name=args.machine, flake=args.flake)
-    generate_facts(machine)
+    if args.all_machines:
+        names = list_machines(args.flake)
+    elif args.machine:
+        names = [args.machine]
+    else:
+        raise ClanError("Specify a machine or use --all-machines")
+    machines = [Machine(name=name, flake=args.flake) for name in names]
+    generate_facts_for_machines(machines, jobs=args.jobs)
 
 
 def register_generate_parser(parser: argparse.ArgumentParser) -> None:
     parser.add_argument(
         "machine",
+        nargs="?",
         help="The machine to generate facts for",
     )
+    parser.add_argument(
+        "--all-machines",
+        action="store_true",
+        help="generate facts for all machines of the clan",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        help="number of generators to run in parallel (default: number of CPUs)",
+    )
     parser.set_defaults(func=generate_command)
@@ -13,6 +13,15 @@ class FactStoreBase(ABC):
     def exists(self, service: str, name: str) -> bool:
         pass
 
+    def list_existing(self, facts: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        """
+        Return which of the given (service, name) facts exist.
+        Stores should override this to answer with a single scan of their storage.
+        """
+        return {
+            (service, name) for service, name in facts if self.exists(service, name)
+        }
+
     @abstractmethod
     def set(self, service: str, name: str, value: bytes) -> Path | None:
         pass
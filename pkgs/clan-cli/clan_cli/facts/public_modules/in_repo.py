@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 from clan_cli.errors import ClanError
@@ -11,6 +12,14 @@ class FactStore(FactStoreBase):
         self.machine = machine
         self.works_remotely = False
 
+    def list_existing(self, facts: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        facts_folder = self.machine.flake_dir / "machines" / self.machine.name / "facts"
+        try:
+            names = set(os.listdir(facts_folder))
+        except FileNotFoundError:
+            return set()
+        return {(service, name) for service, name in facts if name in names}
+
     def set(self, service: str, name: str, value: bytes) -> Path | None:
         if isinstance(self.machine.flake, Path):
             fact_path = (
@@ -1,4 +1,5 @@
 import logging
+import os
 from pathlib import Path
 
 from clan_cli.dirs import vm_state_dir
@@ -21,6 +22,15 @@ class FactStore(FactStoreBase):
         fact_path = self.dir / service / name
         return fact_path.exists()
 
+    def list_existing(self, facts: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        existing = set()
+        if self.dir.exists():
+            for service in self.dir.iterdir():
+                if service.is_dir():
+                    for name in os.listdir(service):
+                        existing.add((service.name, name))
+        return existing.intersection(facts)
+
     def set(self, service: str, name: str, value: bytes) -> Path | None:
         fact_path = self.dir / service / name
         fact_path.parent.mkdir(parents=True, exist_ok=True)
@@ -9,6 +9,29 @@ class SecretStoreBase(ABC):
     def __init__(self, machine: Machine) -> None:
         pass
 
+    def list_existing(self, facts: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        """
+        Return which of the given (service, name) secrets exist.
+        Stores should override this to answer with a single scan of their storage.
+        """
+        return {
+            (service, name) for service, name in facts if self.exists(service, name)
+        }
+
+    def manifest(self) -> dict[str, str] | None:
+        """
+        Map each file written by upload() to a hash of its encrypted source.
+        This lets unchanged secrets be skipped without decrypting them.
+        Stores that return None are always uploaded in full.
+        """
+        return None
+
+    def upload_files(self, output_dir: Path, files: set[str]) -> None:
+        """
+        Like upload(), but only write the given files of the manifest.
+        """
+        self.upload(output_dir)
+
     @abstractmethod
     def set(
         self, service: str, name: str, value: bytes, groups: list[str]
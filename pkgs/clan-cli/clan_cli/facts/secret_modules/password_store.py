@@ -2,16 +2,92 @@ import os
 import subprocess
 from pathlib import Path
 
+from clan_cli.errors import ClanError
+from clan_cli.git_reader import blob_sha
 from clan_cli.machines.machines import Machine
 from clan_cli.nix import nix_shell
 
 from . import SecretStoreBase
 
 
+def _password_store_dir() -> Path:
+    return Path(
+        os.environ.get("PASSWORD_STORE_DIR", f"{os.environ['HOME']}/.password-store")
+    )
+
+
+# decrypts "$store/$name.gpg" to "$out/$name" for each name, like pass show
+_DECRYPT_SCRIPT = """
+store="$0"; out="$1"; shift
+for name in "$@"; do
+  gpg -d --quiet --yes --compress-algo=none --no-encrypt-to $PASSWORD_STORE_GPG_OPTS \\
+    -o "$out/$name" "$store/$name.gpg" || exit 1
+done
+"""
+
+
 class SecretStore(SecretStoreBase):
     def __init__(self, machine: Machine) -> None:
         self.machine = machine
 
+    def list_existing(self, facts: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        machine_dir = _password_store_dir() / "machines" / self.machine.name
+        secrets = {
+            str(path.relative_to(machine_dir)).removesuffix(".gpg")
+            for path in machine_dir.rglob("*.gpg")
+        }
+        return {(service, name) for service, name in facts if name in secrets}
+
+    def _secrets(self) -> list[tuple[str, str]]:
+        secrets = []
+        for service in self.machine.facts_data:
+            for secret in self.machine.facts_data[service]["secret"]:
+                if isinstance(secret, dict):
+                    secrets.append((service, secret["name"]))
+                else:
+                    # TODO: drop old format soon
+                    secrets.append((service, secret))
+        return secrets
+
+    def manifest(self) -> dict[str, str] | None:
+        # the git object id of the encrypted file, computed without spawning git
+        machine_dir = _password_store_dir() / "machines" / self.machine.name
+        manifest = {}
+        for _, secret_name in self._secrets():
+            try:
+                data = (machine_dir / f"{secret_name}.gpg").read_bytes()
+            except FileNotFoundError:
+                # always treat it as changed, upload_files reports the missing secret
+                manifest[secret_name] = ""
+                continue
+            manifest[secret_name] = blob_sha(data)
+        return manifest
+
+    def upload_files(self, output_dir: Path, files: set[str]) -> None:
+        machine_dir = _password_store_dir() / "machines" / self.machine.name
+        names = [name for _, name in self._secrets() if name in files]
+        missing = [name for name in names if not (machine_dir / f"{name}.gpg").exists()]
+        if missing:
+            raise ClanError(
+                f"secrets of machine {self.machine.name} are missing in {machine_dir}: {', '.join(missing)}"
+            )
+        if names:
+            # decrypt all secrets in one shell instead of spawning pass for each
+            subprocess.run(
+                nix_shell(
+                    ["nixpkgs#gnupg"],
+                    [
+                        "sh",
+                        "-c",
+                        _DECRYPT_SCRIPT,
+                        str(machine_dir),
+                        str(output_dir),
+                        *names,
+                    ],
+                ),
+                check=True,
+            )
+
     def set(
         self, service: str, name: str, value: bytes, groups: list[str]
     ) -> Path | None:
@@ -36,82 +112,8 @@ class SecretStore(SecretStoreBase):
         ).stdout
 
     def exists(self, service: str, name: str) -> bool:
-        password_store = os.environ.get(
-            "PASSWORD_STORE_DIR", f"{os.environ['HOME']}/.password-store"
-        )
-        secret_path = Path(password_store) / f"machines/{self.machine.name}/{name}.gpg"
+        secret_path = _password_store_dir() / f"machines/{self.machine.name}/{name}.gpg"
         return secret_path.exists()
 
-    def generate_hash(self) -> bytes:
-        password_store = os.environ.get(
-            "PASSWORD_STORE_DIR", f"{os.environ['HOME']}/.password-store"
-        )
-        hashes = []
-        hashes.append(
-            subprocess.run(
-                nix_shell(
-                    ["nixpkgs#git"],
-                    [
-                        "git",
-                        "-C",
-                        password_store,
-                        "log",
-                        "-1",
-                        "--format=%H",
-                        f"machines/{self.machine.name}",
-                    ],
-                ),
-                stdout=subprocess.PIPE,
-            ).stdout.strip()
-        )
-        for symlink in Path(password_store).glob(f"machines/{self.machine.name}/**/*"):
-            if symlink.is_symlink():
-                hashes.append(
-                    subprocess.run(
-                        nix_shell(
-                            ["nixpkgs#git"],
-                            [
-                                "git",
-                                "-C",
-                                password_store,
-                                "log",
-                                "-1",
-                                "--format=%H",
-                                str(symlink),
-                            ],
-                        ),
-                        stdout=subprocess.PIPE,
-                    ).stdout.strip()
-                )
-
-        # we sort the hashes to make sure that the order is always the same
-        hashes.sort()
-        return b"\n".join(hashes)
-
-    # FIXME: add this when we switch to python3.12
-    # @override
-    def update_check(self) -> bool:
-        local_hash = self.generate_hash()
-        remote_hash = self.machine.target_host.run(
-            # TODO get the path to the secrets from the machine
-            ["cat", f"{self.machine.secrets_upload_directory}/.pass_info"],
-            check=False,
-            stdout=subprocess.PIPE,
-        ).stdout.strip()
-
-        if not remote_hash:
-            print("remote hash is empty")
-            return False
-
-        return local_hash.decode() == remote_hash
-
     def upload(self, output_dir: Path) -> None:
-        for service in self.machine.facts_data:
-            for secret in self.machine.facts_data[service]["secret"]:
-                if isinstance(secret, dict):
-                    secret_name = secret["name"]
-                else:
-                    # TODO: drop old format soon
-                    secret_name = secret
-                (output_dir / secret_name).write_bytes(self.get(service, secret_name))
-        (output_dir / ".pass_info").write_bytes(self.generate_hash())
+        self.upload_files(output_dir, {name for _, name in self._secrets()})
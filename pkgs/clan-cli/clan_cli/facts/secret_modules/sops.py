@@ -1,10 +1,12 @@
+import hashlib
+import os
 from pathlib import Path
 
 from clan_cli.machines.machines import Machine
 from clan_cli.secrets.folders import sops_secrets_folder
 from clan_cli.secrets.machines import add_machine, has_machine
 from clan_cli.secrets.secrets import decrypt_secret, encrypt_secret, has_secret
-from clan_cli.secrets.sops import generate_private_key
+from clan_cli.secrets.sops import generate_private_key, sops_recipients
 
 from . import SecretStoreBase
 
@@ -30,6 +32,39 @@ class SecretStore(SecretStoreBase):
         )
         add_machine(self.machine.flake_dir, self.machine.name, pub_key, False)
 
+    def list_existing(self, facts: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        folder = sops_secrets_folder(self.machine.flake_dir)
+        try:
+            secrets = set(os.listdir(folder))
+        except FileNotFoundError:
+            return set()
+        return {
+            (service, name)
+            for service, name in facts
+            if f"{self.machine.name}-{name}" in secrets
+            and has_secret(self.machine.flake_dir, f"{self.machine.name}-{name}")
+        }
+
+    def generate_hash(self) -> bytes:
+        key_name = f"{self.machine.name}-age.key"
+        if not has_secret(self.machine.flake_dir, key_name):
+            return b""
+        secret_path = sops_secrets_folder(self.machine.flake_dir) / key_name / "secret"
+        h = hashlib.sha256(secret_path.read_bytes())
+        for recipient in sorted(sops_recipients(secret_path) or []):
+            h.update(b"\n" + recipient.encode())
+        return h.hexdigest().encode()
+
+    def manifest(self) -> dict[str, str] | None:
+        local_hash = self.generate_hash()
+        if not local_hash:
+            return {}
+        return {"key.txt": local_hash.decode()}
+
+    def upload_files(self, output_dir: Path, files: set[str]) -> None:
+        if "key.txt" in files:
+            self.upload(output_dir)
+
     def set(
         self, service: str, name: str, value: bytes, groups: list[str]
     ) -> Path | None:
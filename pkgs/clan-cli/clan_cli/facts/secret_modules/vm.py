@@ -14,6 +14,15 @@ class SecretStore(SecretStoreBase):
         self.dir = vm_state_dir(str(machine.flake), machine.name) / "secrets"
         self.dir.mkdir(parents=True, exist_ok=True)
 
+    def list_existing(self, facts: list[tuple[str, str]]) -> set[tuple[str, str]]:
+        existing = set()
+        if self.dir.exists():
+            for service in self.dir.iterdir():
+                if service.is_dir():
+                    for name in os.listdir(service):
+                        existing.add((service.name, name))
+        return existing.intersection(facts)
+
     def set(
         self, service: str, name: str, value: bytes, groups: list[str]
     ) -> Path | None:
@@ -1,43 +1,140 @@
 import argparse
 import importlib
+import json
 import logging
-from pathlib import Path
+import subprocess
+from pathlib import Path, PurePosixPath
 from tempfile import TemporaryDirectory
 
 from ..cmd import Log, run
 from ..machines.machines import Machine
 from ..nix import nix_shell
+from ..tracing import span
 
 log = logging.getLogger(__name__)
 
+# hashes of the uploaded secrets, stored next to them on the target
+MANIFEST_FILE = ".clan_manifest"
+
+
+def parse_manifest(data: str) -> dict[str, str] | None:
+    try:
+        manifest = json.loads(data)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(manifest, dict):
+        return None
+    for name, digest in manifest.items():
+        path = PurePosixPath(name)
+        if (
+            not isinstance(digest, str)
+            or path.is_absolute()
+            or ".." in path.parts
+            or name in ("", ".")
+        ):
+            return None
+    return manifest
+
+
+def diff_manifest(
+    local: dict[str, str], remote: dict[str, str]
+) -> tuple[set[str], set[str]]:
+    """
+    Return the files that need to be uploaded and the files to remove from the target.
+    """
+    changed = {
+        name
+        for name, digest in local.items()
+        if not digest or remote.get(name) != digest
+    }
+    removed = set(remote) - set(local)
+    return changed, removed
+
+
+def read_remote_manifest(machine: Machine) -> dict[str, str] | None:
+    proc = machine.target_host.run(
+        ["cat", f"{machine.secrets_upload_directory}/{MANIFEST_FILE}"],
+        check=False,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    if proc.returncode != 0:
+        return None
+    return parse_manifest(proc.stdout)
+
+
+def _rsync(machine: Machine, source: Path, delete: bool) -> None:
+    host = machine.target_host
+    ssh_cmd = host.ssh_cmd()
+    run(
+        nix_shell(
+            ["nixpkgs#rsync"],
+            [
+                "rsync",
+                "-e",
+                " ".join(["ssh"] + ssh_cmd[2:]),
+                "-az",
+                *(["--delete"] if delete else []),
+                f"{source!s}/",
+                f"{host.ssh_target}:{machine.secrets_upload_directory}/",
+            ],
+        ),
+        log=Log.BOTH,
+    )
+
 
 def upload_secrets(machine: Machine) -> None:
+    with span("secrets-upload", machine=machine.name):
+        _upload_secrets(machine)
+
+
+def _upload_secrets(machine: Machine) -> None:
     secret_facts_module = importlib.import_module(machine.secret_facts_module)
     secret_facts_store = secret_facts_module.SecretStore(machine=machine)
 
-    if secret_facts_store.update_check():
-        log.info("Secrets already up to date")
+    manifest = secret_facts_store.manifest()
+    if manifest is None:
+        # stores without a manifest are uploaded in full unless they say otherwise
+        if secret_facts_store.update_check():
+            log.info("Secrets already up to date")
+            return
+        with TemporaryDirectory() as tempdir:
+            secret_facts_store.upload(Path(tempdir))
+            _rsync(machine, Path(tempdir), delete=True)
         return
-    with TemporaryDirectory() as tempdir:
-        secret_facts_store.upload(Path(tempdir))
-        host = machine.target_host
-
-        ssh_cmd = host.ssh_cmd()
-        run(
-            nix_shell(
-                ["nixpkgs#rsync"],
-                [
-                    "rsync",
-                    "-e",
-                    " ".join(["ssh"] + ssh_cmd[2:]),
-                    "-az",
-                    "--delete",
-                    f"{tempdir!s}/",
-                    f"{host.user}@{host.host}:{machine.secrets_upload_directory}/",
-                ],
-            ),
-            log=Log.BOTH,
+
+    remote_manifest = read_remote_manifest(machine)
+    removed: set[str] = set()
+    if remote_manifest is None:
+        # nothing we uploaded before, replace whatever is in the directory
+        changed = set(manifest)
+    else:
+        changed, removed = diff_manifest(manifest, remote_manifest)
+        if not changed and not removed:
+            log.info("Secrets already up to date")
+            return
+
+    if removed:
+        machine.target_host.run(
+            [
+                "rm",
+                "-f",
+                "--",
+                *(f"{machine.secrets_upload_directory}/{name}" for name in removed),
+            ]
         )
+    with TemporaryDirectory() as tempdir:
+        secrets_dir = Path(tempdir) / "secrets"
+        secrets_dir.mkdir()
+        # only decrypt the secrets that changed since the last upload
+        secret_facts_store.upload_files(secrets_dir, changed)
+        _rsync(machine, secrets_dir, delete=remote_manifest is None)
+        # the manifest is only uploaded once all secrets arrived,
+        # if the upload fails the old manifest makes us retry them next time
+        manifest_dir = Path(tempdir) / "manifest"
+        manifest_dir.mkdir()
+        (manifest_dir / MANIFEST_FILE).write_text(json.dumps(manifest, sort_keys=True))
+        _rsync(machine, manifest_dir, delete=False)
 
 
 def upload_command(args: argparse.Namespace) -> None:
@@ -7,7 +7,7 @@ from ..dirs import machine_gcroot
 from ..errors import ClanError
 from ..machines.list import list_machines
 from ..machines.machines import Machine
-from ..nix import nix_add_to_gcroots, nix_build, nix_config, nix_eval, nix_metadata
+from ..nix import nix_add_to_gcroots, nix_build, nix_config, nix_metadata
 from ..vms.inspect import VmConfig, inspect_vm
 
 
@@ -46,6 +46,15 @@ def inspect_flake(flake_url: str | Path, machine_name: str) -> FlakeConfig:
         )
 
     machine = Machine(machine_name, flake_url)
+    # evaluate everything we need from the machine in one go,
+    # inspect_vm will pick up the cached result
+    data = machine.eval_many(
+        [
+            "config.clanCore.vm.inspect",
+            "config.clanCore.clanName",
+            "config.clanCore.clanIcon",
+        ]
+    )
     vm = inspect_vm(machine)
 
     # Make symlink to gcroots from vm.machine_icon
@@ -53,29 +62,11 @@ def inspect_flake(flake_url: str | Path, machine_name: str) -> FlakeConfig:
         gcroot_icon: Path = machine_gcroot(flake_url=str(flake_url)) / vm.machine_name
         nix_add_to_gcroots(vm.machine_icon, gcroot_icon)
 
-    # Get the cLAN name
-    cmd = nix_eval(
-        [
-            f'{flake_url}#clanInternals.machines."{system}"."{machine_name}".config.clanCore.clanName'
-        ]
-    )
-    res = run_cmd(cmd)
-    clan_name = res.strip('"')
-
-    # Get the clan icon path
-    cmd = nix_eval(
-        [
-            f'{flake_url}#clanInternals.machines."{system}"."{machine_name}".config.clanCore.clanIcon'
-        ]
-    )
-    res = run_cmd(cmd)
+    clan_name = data["config.clanCore.clanName"]
 
     # If the icon is null, no icon is set for this cLAN
-    if res == "null":
-        icon_path = None
-    else:
-        icon_path = res.strip('"')
-
+    icon_path = data["config.clanCore.clanIcon"]
+    if icon_path is not None:
         cmd = nix_build(
             [
                 f'{flake_url}#clanInternals.machines."{system}"."{machine_name}".config.clanCore.clanIcon'
@@ -1,7 +1,12 @@
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
 from pathlib import Path
+from tempfile import NamedTemporaryFile
 
 # from clan_cli.dirs import find_git_repo_root
 from clan_cli.errors import ClanError
+from clan_cli.git_reader import GitRepo
 from clan_cli.nix import nix_shell
 
 from .cmd import Log, run
@@ -22,6 +27,48 @@ def commit_file(
     commit_files([file_path], repo_dir, commit_message)
 
 
+class _Batch:
+    def __init__(self) -> None:
+        # repo_dir -> files and commit messages of the batched commits
+        self.file_paths: dict[Path, list[Path]] = {}
+        self.messages: dict[Path, list[str]] = {}
+
+
+# the batch opened by batch_commit() in the current thread or task,
+# so a failing batch of one thread does not discard the commits of another
+_batch: ContextVar[_Batch | None] = ContextVar("clan_git_batch", default=None)
+
+
+@contextmanager
+def batch_commit(commit_message: str | None = None) -> Iterator[None]:
+    """Collect all commits of commit_files() into one commit per repository.
+
+    The commit is made when the context exits. If an exception is raised,
+    nothing is committed and the changes are left in the working tree.
+    Nested calls join the outer batch. Batches are per thread,
+    commits of other threads are not collected.
+
+    :param commit_message: The subject of the commit,
+        the messages of the batched commits are added to the body.
+    """
+    if _batch.get() is not None:
+        yield
+        return
+    batch = _Batch()
+    token = _batch.set(batch)
+    try:
+        yield
+    finally:
+        _batch.reset(token)
+    for repo_dir, file_paths in batch.file_paths.items():
+        messages = list(dict.fromkeys(batch.messages[repo_dir]))
+        if commit_message is None:
+            message = "\n".join(messages)
+        else:
+            message = commit_message + "\n\n" + "\n".join(messages)
+        _commit_file_to_git(repo_dir, list(dict.fromkeys(file_paths)), message)
+
+
 # generic vcs agnostic commit function
 def commit_files(
     file_paths: list[Path],
@@ -39,54 +86,108 @@ def commit_files(
             # ensure that mentioned file path is relative to repo
             commit_message += f"Add {file_path.relative_to(repo_dir)}"
     # check if the repo is a git repo and commit
-    if (repo_dir / ".git").exists():
-        _commit_file_to_git(repo_dir, file_paths, commit_message)
-    else:
+    if not (repo_dir / ".git").exists():
         return
+    batch = _batch.get()
+    if batch is not None:
+        batch.file_paths.setdefault(repo_dir, []).extend(file_paths)
+        batch.messages.setdefault(repo_dir, []).append(commit_message)
+        return
+    _commit_file_to_git(repo_dir, file_paths, commit_message)
+
+
+def _relative_path(file_path: Path, repo_dir: Path) -> str:
+    # don't resolve the file itself, it might be a symlink we want to commit
+    path = Path(file_path).absolute()
+    path = path.parent.resolve() / path.name
+    return str(path.relative_to(repo_dir.resolve()))
+
+
+def _has_staged_changes(repo_dir: Path, file_paths: list[Path]) -> bool:
+    cmd = nix_shell(
+        ["nixpkgs#git"],
+        [
+            "git",
+            "-C",
+            str(repo_dir),
+            "diff",
+            "--cached",
+            "--name-only",
+            "-z",
+            "--relative",
+        ],
+    )
+    result = run(cmd, cwd=repo_dir, log=Log.NONE)
+    changed = [path for path in result.stdout.split("\0") if path]
+    wanted = {_relative_path(file_path, repo_dir) for file_path in file_paths}
+    if "." in wanted:
+        return len(changed) != 0
+    for path in changed:
+        # the file itself or one of its parent directories
+        parts = path.split("/")
+        for i in range(1, len(parts) + 1):
+            if "/".join(parts[:i]) in wanted:
+                return True
+    return False
 
 
 def _commit_file_to_git(
     repo_dir: Path, file_paths: list[Path], commit_message: str
 ) -> None:
-    """Commit a file to a git repository.
+    """Commit files to a git repository with one git add and one git commit.
 
     :param repo_dir: The path to the git repository.
-    :param file_path: The path to the file to commit.
+    :param file_paths: The paths to the files to commit.
     :param commit_message: The commit message.
     :raises ClanError: If the file is not in the git repository.
     """
-    for file_path in file_paths:
+    # skip spawning git if none of the files changed since the last commit
+    repo = GitRepo.find(repo_dir)
+    if repo is not None and repo.unchanged(
+        [_relative_path(file_path, repo.worktree) for file_path in file_paths]
+    ):
+        return
+
+    # the paths are passed in a file to not hit the argument length limit
+    with NamedTemporaryFile(mode="w", prefix="clan-pathspec-") as pathspec:
+        pathspec.write(
+            "\0".join(_relative_path(file_path, repo_dir) for file_path in file_paths)
+        )
+        pathspec.flush()
+        pathspec_args = [
+            f"--pathspec-from-file={pathspec.name}",
+            "--pathspec-file-nul",
+        ]
+
+        # add the files to the git index
         cmd = nix_shell(
             ["nixpkgs#git"],
-            ["git", "-C", str(repo_dir), "add", str(file_path)],
+            ["git", "-C", str(repo_dir), "add", *pathspec_args],
+        )
+        run(
+            cmd,
+            log=Log.BOTH,
+            error_msg=f"Failed to add {file_paths} files to git index",
         )
-        # add the file to the git index
-
-        run(cmd, log=Log.BOTH, error_msg=f"Failed to add {file_path} file to git index")
-
-    # check if there is a diff
-    cmd = nix_shell(
-        ["nixpkgs#git"],
-        ["git", "-C", str(repo_dir), "diff", "--cached", "--exit-code"]
-        + [str(file_path) for file_path in file_paths],
-    )
-    result = run(cmd, check=False, cwd=repo_dir)
-    # if there is no diff, return
-    if result.returncode == 0:
-        return
 
-    # commit only that file
-    cmd = nix_shell(
-        ["nixpkgs#git"],
-        [
-            "git",
-            "-C",
-            str(repo_dir),
-            "commit",
-            "-m",
-            commit_message,
-        ]
-        + [str(file_path) for file_path in file_paths],
-    )
+        # if there is no diff, return
+        if not _has_staged_changes(repo_dir, file_paths):
+            return
 
-    run(cmd, error_msg=f"Failed to commit {file_paths} to git repository {repo_dir}")
+        # commit only those files
+        cmd = nix_shell(
+            ["nixpkgs#git"],
+            [
+                "git",
+                "-C",
+                str(repo_dir),
+                "commit",
+                "-m",
+                commit_message,
+                *pathspec_args,
+            ],
+        )
+        run(
+            cmd,
+            error_msg=f"Failed to commit {file_paths} to git repository {repo_dir}",
+        )
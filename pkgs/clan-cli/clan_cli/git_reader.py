@@ -0,0 +1,431 @@
+import hashlib
+import logging
+import os
+import re
+import stat
+import struct
+import zlib
+from pathlib import Path
+from typing import NamedTuple
+
+log = logging.getLogger(__name__)
+
+# pack object types, see gitformat-pack(5)
+PACK_OBJECT_TYPES = {1: "commit", 2: "tree", 3: "blob", 4: "tag"}
+
+# index entry flags
+FLAG_EXTENDED = 0x4000
+FLAG_ASSUME_VALID = 0x8000
+FLAG_STAGE_MASK = 0x3000
+# extended flags
+FLAG_SKIP_WORKTREE = 0x4000
+FLAG_INTENT_TO_ADD = 0x2000
+
+# repositories with sha256 object names are not supported
+SHA256_OBJECT_FORMAT = re.compile(r"objectformat\s*=\s*sha256", re.IGNORECASE)
+
+MODE_GITLINK = 0o160000
+MODE_SYMLINK = 0o120000
+
+
+class IndexEntry(NamedTuple):
+    mtime: int
+    # 0 if git was built without sub-second mtime support
+    mtime_nsec: int
+    ino: int
+    mode: int
+    size: int
+    sha: str
+    flags: int
+    extended_flags: int
+
+
+class GitIndex(NamedTuple):
+    entries: dict[str, IndexEntry]
+    # the tree of the whole index from the cache tree extension,
+    # None if it was invalidated since the last commit
+    root_tree: str | None
+    mtime_ns: int
+
+
+def _read_offset(data: bytes, pos: int) -> tuple[int, int]:
+    """
+    Read a variable length integer as used by index v4 and ofs-deltas
+    """
+    c = data[pos]
+    pos += 1
+    value = c & 0x7F
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7F)
+    return value, pos
+
+
+def parse_index(data: bytes, mtime_ns: int = 0) -> GitIndex:
+    """
+    Parse a git index file (version 2 to 4), see gitformat-index(5)
+    """
+    signature, version, count = struct.unpack(">4sII", data[:12])
+    if signature != b"DIRC" or version not in (2, 3, 4):
+        raise ValueError(f"unsupported git index version {version}")
+    entries = {}
+    pos = 12
+    previous_name = b""
+    for _ in range(count):
+        start = pos
+        fields = struct.unpack(">10I20sH", data[pos : pos + 62])
+        pos += 62
+        flags = fields[11]
+        extended_flags = 0
+        if version >= 3 and flags & FLAG_EXTENDED:
+            (extended_flags,) = struct.unpack(">H", data[pos : pos + 2])
+            pos += 2
+        if version == 4:
+            strip, pos = _read_offset(data, pos)
+            end = data.index(b"\0", pos)
+            name = previous_name[: len(previous_name) - strip] + data[pos:end]
+            pos = end + 1
+        else:
+            end = data.index(b"\0", pos)
+            name = data[pos:end]
+            # entries are padded with 1-8 NUL bytes to a multiple of 8
+            pos = start + ((end - start + 8) // 8) * 8
+        previous_name = name
+        entries[name.decode("utf-8", errors="surrogateescape")] = IndexEntry(
+            mtime=fields[2],
+            mtime_nsec=fields[3],
+            ino=fields[5],
+            mode=fields[6],
+            size=fields[9],
+            sha=fields[10].hex(),
+            flags=flags,
+            extended_flags=extended_flags,
+        )
+
+    root_tree = None
+    # the last 20 bytes are the checksum of the index
+    while pos + 8 <= len(data) - 20:
+        signature, size = struct.unpack(">4sI", data[pos : pos + 8])
+        pos += 8
+        # extensions starting with A-Z are optional, the others change
+        # the meaning of the entries: the split index ("link") keeps part
+        # of them in a shared index, the sparse index ("sdir") has
+        # directory entries standing in for the files below them
+        if not b"A"[0] <= signature[0] <= b"Z"[0]:
+            raise ValueError(f"unsupported git index extension {signature!r}")
+        if signature == b"TREE":
+            root_tree = _parse_root_tree(data[pos : pos + size])
+        pos += size
+    return GitIndex(entries=entries, root_tree=root_tree, mtime_ns=mtime_ns)
+
+
+def _parse_root_tree(data: bytes) -> str | None:
+    # the first entry of the cache tree extension is the root
+    end = data.index(b"\0")
+    if data[:end] != b"":
+        return None
+    line_end = data.index(b"\n", end)
+    entry_count = int(data[end + 1 : line_end].split(b" ")[0])
+    if entry_count < 0:
+        return None
+    return data[line_end + 1 : line_end + 21].hex()
+
+
+def blob_sha(data: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+class GitRepo:
+    """
+    Reads HEAD, refs, the index and commit objects of a git repository
+    without spawning git.
+    Only the common sha1 repository layout is supported,
+    methods return None if they cannot answer a question.
+    """
+
+    def __init__(self, worktree: Path, git_dir: Path, common_dir: Path) -> None:
+        self.worktree = worktree
+        self.git_dir = git_dir
+        self.common_dir = common_dir
+
+    @classmethod
+    def find(cls, path: Path) -> "GitRepo | None":
+        """
+        Find the repository containing path
+        """
+        path = path.absolute()
+        for worktree in [path, *path.parents]:
+            dot_git = worktree / ".git"
+            if dot_git.is_dir():
+                git_dir = dot_git
+            elif dot_git.is_file():
+                # linked worktrees and submodules
+                content = dot_git.read_text().strip()
+                if not content.startswith("gitdir: "):
+                    return None
+                git_dir = (worktree / content.removeprefix("gitdir: ")).resolve()
+            else:
+                continue
+            common_dir = git_dir
+            commondir_file = git_dir / "commondir"
+            if commondir_file.exists():
+                common_dir = (git_dir / commondir_file.read_text().strip()).resolve()
+            try:
+                config = (common_dir / "config").read_text()
+            except OSError:
+                config = ""
+            if SHA256_OBJECT_FORMAT.search(config):
+                return None
+            return cls(worktree, git_dir, common_dir)
+        return None
+
+    def _packed_refs(self) -> dict[str, str]:
+        refs = {}
+        try:
+            with open(self.common_dir / "packed-refs") as f:
+                for line in f:
+                    if line.startswith(("#", "^")):
+                        continue
+                    sha, _, name = line.strip().partition(" ")
+                    refs[name] = sha
+        except FileNotFoundError:
+            pass
+        return refs
+
+    def resolve_ref(self, ref: str) -> str | None:
+        for _ in range(10):
+            base = self.git_dir if ref == "HEAD" else self.common_dir
+            try:
+                content = (base / ref).read_text().strip()
+            except (FileNotFoundError, NotADirectoryError):
+                return self._packed_refs().get(ref)
+            if not content.startswith("ref: "):
+                return content
+            ref = content.removeprefix("ref: ")
+        return None
+
+    def head(self) -> tuple[str | None, str] | None:
+        """
+        The branch HEAD points to (None if detached) and the commit
+        """
+        try:
+            content = (self.git_dir / "HEAD").read_text().strip()
+        except FileNotFoundError:
+            return None
+        if not content.startswith("ref: "):
+            return None, content
+        ref = content.removeprefix("ref: ")
+        rev = self.resolve_ref(ref)
+        if rev is None:
+            # no commit on this branch yet
+            return None
+        return ref, rev
+
+    def read_index(self) -> GitIndex | None:
+        path = self.git_dir / "index"
+        try:
+            with open(path, "rb") as f:
+                mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                return parse_index(f.read(), mtime_ns)
+        except FileNotFoundError:
+            return GitIndex(entries={}, root_tree=None, mtime_ns=0)
+        except (OSError, ValueError, struct.error) as e:
+            log.debug(f"failed to read git index {path}: {e}")
+            return None
+
+    def read_object(self, sha: str) -> tuple[str, bytes] | None:
+        """
+        Read a loose or packed object, deltified objects are not supported
+        """
+        path = self.common_dir / "objects" / sha[:2] / sha[2:]
+        try:
+            raw = zlib.decompress(path.read_bytes())
+        except FileNotFoundError:
+            return self._read_packed_object(sha)
+        except zlib.error:
+            return None
+        header, _, content = raw.partition(b"\0")
+        kind, _, _ = header.partition(b" ")
+        return kind.decode(), content
+
+    def _read_packed_object(self, sha: str) -> tuple[str, bytes] | None:
+        binsha = bytes.fromhex(sha)
+        for idx in (self.common_dir / "objects" / "pack").glob("*.idx"):
+            offset = _find_in_pack_index(idx.read_bytes(), binsha)
+            if offset is None:
+                continue
+            with open(idx.with_suffix(".pack"), "rb") as f:
+                f.seek(offset)
+                c = f.read(1)[0]
+                kind = PACK_OBJECT_TYPES.get((c >> 4) & 7)
+                while c & 0x80:
+                    c = f.read(1)[0]
+                if kind is None:
+                    # a delta, we would need to resolve its base object
+                    return None
+                decompressor = zlib.decompressobj()
+                content = b""
+                while not decompressor.eof:
+                    chunk = f.read(64 * 1024)
+                    if not chunk:
+                        return None
+                    content += decompressor.decompress(chunk)
+                return kind, content
+        return None
+
+    def commit_tree(self, rev: str) -> str | None:
+        obj = self.read_object(rev)
+        if obj is None or obj[0] != "commit":
+            return None
+        first_line = obj[1].split(b"\n", 1)[0]
+        if not first_line.startswith(b"tree "):
+            return None
+        return first_line.removeprefix(b"tree ").decode()
+
+    def _entry_changed(self, name: str, entry: IndexEntry, index: GitIndex) -> bool:
+        if entry.flags & FLAG_ASSUME_VALID or entry.extended_flags & FLAG_SKIP_WORKTREE:
+            return False
+        if entry.mode == MODE_GITLINK:
+            # submodules are not part of the flake
+            return False
+        if entry.extended_flags & FLAG_INTENT_TO_ADD:
+            return True
+        path = self.worktree / name
+        try:
+            st = path.lstat()
+        except (FileNotFoundError, NotADirectoryError):
+            return True
+        if entry.mode == MODE_SYMLINK:
+            if not stat.S_ISLNK(st.st_mode):
+                return True
+        elif not stat.S_ISREG(st.st_mode):
+            return True
+        elif bool(entry.mode & 0o100) != bool(st.st_mode & 0o100):
+            return True
+        # the index stores these truncated to 32 bit
+        size = st.st_size & 0xFFFFFFFF
+        mtime_ns = entry.mtime * 1_000_000_000 + entry.mtime_nsec
+        if entry.mtime_nsec == 0:
+            same_mtime = entry.mtime == int(st.st_mtime)
+        else:
+            same_mtime = mtime_ns == st.st_mtime_ns
+        if (
+            entry.size == size
+            and same_mtime
+            and entry.ino == st.st_ino & 0xFFFFFFFF
+            # racily clean entries could have been modified after the index was written
+            and mtime_ns < index.mtime_ns - 1_000_000_000
+        ):
+            return False
+        if entry.size != size:
+            return True
+        if entry.mode == MODE_SYMLINK:
+            content = os.readlink(path).encode("utf-8", errors="surrogateescape")
+        else:
+            content = path.read_bytes()
+        return blob_sha(content) != entry.sha
+
+    def changed_paths(
+        self, paths: list[str] | None = None, index: GitIndex | None = None
+    ) -> list[str] | None:
+        """
+        Tracked files that differ between the index and the worktree
+        @paths: only check these files, relative to the worktree
+        """
+        if index is None:
+            index = self.read_index()
+        if index is None:
+            return None
+        if paths is None:
+            names = list(index.entries)
+        else:
+            names = [name for name in paths if name in index.entries]
+        return [
+            name
+            for name in names
+            if self._entry_changed(name, index.entries[name], index)
+        ]
+
+    def index_matches_head(self, index: GitIndex) -> bool | None:
+        """
+        Whether nothing is staged, None if we cannot tell
+        """
+        head = self.head()
+        if head is None:
+            return None
+        if any(entry.flags & FLAG_STAGE_MASK for entry in index.entries.values()):
+            # merge conflicts
+            return False
+        if index.root_tree is None:
+            return None
+        head_tree = self.commit_tree(head[1])
+        if head_tree is None:
+            return None
+        return head_tree == index.root_tree
+
+    def is_dirty(self) -> bool | None:
+        """
+        Whether tracked files differ from HEAD, None if we cannot tell
+        """
+        index = self.read_index()
+        if index is None:
+            return None
+        changed = self.changed_paths(index=index)
+        if changed is None:
+            return None
+        if changed:
+            return True
+        matches = self.index_matches_head(index)
+        if matches is None:
+            return None
+        return not matches
+
+    def unchanged(self, paths: list[str]) -> bool:
+        """
+        True if all paths are tracked files that are the same as in HEAD.
+        False means they might have changed.
+        """
+        index = self.read_index()
+        if index is None or any(path not in index.entries for path in paths):
+            return False
+        if self.index_matches_head(index) is not True:
+            return False
+        return self.changed_paths(paths, index=index) == []
+
+
+def _find_in_pack_index(data: bytes, binsha: bytes) -> int | None:
+    """
+    Look up the offset of an object in a version 2 pack index
+    """
+    if data[:8] != b"\377tOc\0\0\0\2":
+        return None
+
+    def u32(pos: int) -> int:
+        return struct.unpack(">I", data[pos : pos + 4])[0]
+
+    # number of objects whose first byte is <= the index
+    fanout = 8
+    lo = u32(fanout + (binsha[0] - 1) * 4) if binsha[0] > 0 else 0
+    hi = u32(fanout + binsha[0] * 4)
+    count = u32(fanout + 255 * 4)
+    shas = fanout + 256 * 4
+    while lo < hi:
+        mid = (lo + hi) // 2
+        sha = data[shas + mid * 20 : shas + (mid + 1) * 20]
+        if sha == binsha:
+            break
+        if sha < binsha:
+            lo = mid + 1
+        else:
+            hi = mid
+    else:
+        return None
+    # the sha table is followed by the crc32 and the offset table
+    offsets = shas + count * 24
+    offset = u32(offsets + mid * 4)
+    if offset & 0x80000000:
+        large_offsets = offsets + count * 4
+        pos = large_offsets + (offset & 0x7FFFFFFF) * 8
+        offset = struct.unpack(">Q", data[pos : pos + 8])[0]
+    return offset
@@ -0,0 +1,125 @@
+import json
+import logging
+import threading
+
+from ..cmd import run
+from ..errors import ClanError
+from ..nix import nix_command
+from ..ssh import Host, HostKeyCheck
+
+log = logging.getLogger(__name__)
+
+# store paths passed to a single nix copy, to stay well below the argument length limit
+COPY_CHUNK_SIZE = 1000
+
+
+def nix_ssh_opts(h: Host) -> str:
+    ssh_arg = f"-p {h.port}" if h.port else ""
+    for k, v in h.ssh_options.items():
+        ssh_arg += f" -o {k}={v}"
+    if h.host_key_check != HostKeyCheck.STRICT:
+        ssh_arg += " -o StrictHostKeyChecking=no"
+    if h.host_key_check == HostKeyCheck.NONE:
+        ssh_arg += " -o UserKnownHostsFile=/dev/null"
+    ssh_arg += " -i " + h.key if h.key else ""
+    # share the ssh connection with the other commands we run on the host
+    ssh_arg += " " + " ".join(h.control_opts())
+    return ssh_arg.strip()
+
+
+class CopyPlanner:
+    """
+    Copies the closures of a set of store paths to many hosts.
+    The closures are computed once with a single nix path-info call,
+    each host is asked once which paths it already has,
+    and only missing paths are streamed to it.
+    At most max_parallel copies run at the same time.
+    """
+
+    def __init__(
+        self,
+        roots: list[str],
+        max_parallel: int = 4,
+        substitute_on_destination: bool = False,
+    ) -> None:
+        self.roots = roots
+        self.substitute_on_destination = substitute_on_destination
+        self._references: dict[str, list[str]] | None = None
+        self._lock = threading.Lock()
+        self._copy_slots = threading.Semaphore(max_parallel)
+
+    def references(self) -> dict[str, list[str]]:
+        with self._lock:
+            if self._references is None:
+                proc = run(
+                    nix_command(["path-info", "--json", "--recursive", *self.roots]),
+                    error_msg=f"failed to query the closure of {' '.join(self.roots)}",
+                )
+                data = json.loads(proc.stdout)
+                # nix < 2.19 returns a list, newer versions a dict keyed by path
+                if isinstance(data, list):
+                    data = {info["path"]: info for info in data}
+                self._references = {
+                    path: (info or {}).get("references", [])
+                    for path, info in data.items()
+                }
+            return self._references
+
+    def closure(self, roots: list[str]) -> list[str]:
+        references = self.references()
+        seen: set[str] = set()
+        stack = list(roots)
+        while stack:
+            path = stack.pop()
+            if path in seen:
+                continue
+            seen.add(path)
+            stack.extend(references.get(path, []))
+        return sorted(seen)
+
+    def missing_paths(self, host: Host, paths: list[str]) -> list[str]:
+        """
+        Ask the host which of the paths are not in its store, in a single ssh round-trip
+        """
+        if not paths:
+            return []
+        # paths are passed over stdin to not hit the argument length limit
+        cmd = [
+            *host.ssh_cmd(),
+            "--",
+            "xargs nix-store --check-validity --print-invalid",
+        ]
+        proc = run(
+            cmd,
+            stdin_data="\n".join(paths).encode(),
+            check=False,
+        )
+        if proc.returncode != 0:
+            log.debug(f"failed to query valid paths on {host.host}, copying all")
+            return paths
+        return [line for line in proc.stdout.splitlines() if line]
+
+    def copy(self, host: Host, roots: list[str] | None = None) -> None:
+        """
+        Copy the closure of roots (default: all roots of the planner) to host
+        """
+        if roots is None:
+            roots = self.roots
+        missing = self.missing_paths(host, self.closure(roots))
+        if not missing:
+            log.info(f"{host.command_prefix} already has {' '.join(roots)}")
+            return
+        log.info(f"copying {len(missing)} paths to {host.command_prefix}")
+        target = f"{host.user or 'root'}@{host.host}"
+        args = ["copy", "--to", f"ssh://{target}", "--no-check-sigs"]
+        if self.substitute_on_destination:
+            args.append("--substitute-on-destination")
+        with self._copy_slots:
+            for i in range(0, len(missing), COPY_CHUNK_SIZE):
+                proc = host.run_local(
+                    nix_command([*args, *missing[i : i + COPY_CHUNK_SIZE]]),
+                    extra_env=dict(NIX_SSHOPTS=nix_ssh_opts(host)),
+                    check=False,
+                )
+                if proc.returncode != 0:
+                    raise ClanError(f"failed to copy {' '.join(roots)} to {target}")
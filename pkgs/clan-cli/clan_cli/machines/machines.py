@@ -1,5 +1,6 @@
 import json
 import logging
+import os
 from collections.abc import Generator
 from contextlib import contextmanager
 from pathlib import Path
@@ -7,17 +8,29 @@ from tempfile import NamedTemporaryFile
 from typing import Any
 
 from clan_cli.clan_uri import ClanURI, MachineData
-from clan_cli.dirs import vm_state_dir
+from clan_cli.dirs import user_eval_cache_dir, vm_state_dir
 from clan_cli.qemu.qmp import QEMUMonitorProtocol
 
 from ..cmd import run
+from ..disk_cache import DiskCache, cache_key
 from ..errors import ClanError
+from ..git_reader import GitRepo
 from ..nix import nix_build, nix_config, nix_eval, nix_metadata
+from ..nix_repl import NIX_REPL_POOL, NixReplTimeoutError, nix_repl_enabled
 from ..ssh import Host, parse_deployment_address
+from ..tracing import span
 
 log = logging.getLogger(__name__)
 
 
+def _nix_json(value: Any) -> str:
+    """
+    Serialize value like `nix eval --json` does, so evaluation results are stored
+    as the same text whichever way they were evaluated
+    """
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
 class QMPWrapper:
     def __init__(self, state_dir: Path) -> None:
         # These sockets here are just symlinks to the real sockets which
@@ -47,6 +60,7 @@ class Machine:
     eval_cache: dict[str, str]
     build_cache: dict[str, Path]
     _flake_path: Path | None
+    _flake_metadata: None | dict[str, Any]
     _deployment_info: None | dict
     vm: QMPWrapper
 
@@ -75,17 +89,30 @@ class Machine:
         self.eval_cache: dict[str, str] = {}
         self.build_cache: dict[str, Path] = {}
         self._flake_path: Path | None = None
+        self._flake_metadata: None | dict[str, Any] = None
         self._deployment_info: None | dict = deployment_info
 
         state_dir = vm_state_dir(flake_url=str(self.flake), vm_name=self.data.name)
 
         self.vm: QMPWrapper = QMPWrapper(state_dir)
 
-    def flush_caches(self) -> None:
+    def flush_caches(self, persistent: bool = False) -> None:
+        """
+        Drop all cached evaluation results of this machine.
+        @persistent: also remove the entries from the on-disk evaluation cache
+        """
         self._deployment_info = None
         self._flake_path = None
+        self._flake_metadata = None
         self.build_cache.clear()
         self.eval_cache.clear()
+        if persistent:
+            flake = str(self.data.flake_id)
+            DiskCache(user_eval_cache_dir()).invalidate(
+                lambda meta: (
+                    meta.get("flake") == flake and meta.get("machine") == self.data.name
+                )
+            )
 
     def __str__(self) -> str:
         return f"Machine(name={self.data.name}, flake={self.data.flake_id})"
@@ -150,6 +177,62 @@ class Machine:
         assert self._flake_path is not None
         return self._flake_path
 
+    @property
+    def flake_metadata(self) -> dict[str, Any]:
+        if self._flake_metadata is None:
+            self._flake_metadata = nix_metadata(self.flake_dir)
+        return self._flake_metadata
+
+    def _git_repo(self) -> GitRepo | None:
+        if not self.data.flake_id.is_local():
+            return None
+        return GitRepo.find(self.flake_dir)
+
+    @property
+    def flake_fingerprint(self) -> str | None:
+        """
+        A hash identifying the content of the flake, None if the flake cannot be locked
+        """
+        # for clean git checkouts the commit is enough, no need to ask nix
+        repo = self._git_repo()
+        if repo is not None and repo.is_dirty() is False:
+            head = repo.head()
+            if head is not None:
+                subdir = os.path.relpath(self.flake_dir, repo.worktree)
+                return f"git:{head[1]}:{subdir}"
+        locked = self.flake_metadata.get("locked", {})
+        return locked.get("narHash") or locked.get("rev")
+
+    def _disk_cache_key(
+        self,
+        method: str,
+        attr: str,
+        extra_config: None | dict,
+        impure: bool,
+        nix_options: list[str],
+    ) -> str | None:
+        """
+        The key of a result in the on-disk cache, None if it must not be cached:
+        impure results may depend on more than the content of the flake.
+        """
+        if impure:
+            return None
+        fingerprint = self.flake_fingerprint
+        if fingerprint is None:
+            return None
+        return cache_key(
+            fingerprint,
+            nix_config()["system"],
+            self.data.name,
+            method,
+            attr,
+            extra_config,
+            nix_options,
+        )
+
+    def _cache_meta(self, attr: str) -> dict[str, str]:
+        return dict(flake=str(self.data.flake_id), machine=self.data.name, attr=attr)
+
     @property
     def target_host(self) -> Host:
         return parse_deployment_address(
@@ -173,6 +256,56 @@ class Machine:
             meta={"machine": self, "target_host": self.target_host},
         )
 
+    def _flake_ref(self) -> str:
+        if (self.flake_dir / ".git").exists():
+            return f"git+file://{self.flake_dir}"
+        return f"path:{self.flake_dir}"
+
+    def _eval_flake_url(self) -> tuple[str, bool]:
+        """
+        The url to pass to builtins.getFlake and whether the flake is dirty.
+        This is read from the git repository if possible,
+        to not spawn `nix flake metadata` for every evaluation.
+        """
+        repo = self._git_repo()
+        # nix needs extra flags for submodules, let it figure out the url
+        if repo is not None and not (repo.worktree / ".gitmodules").exists():
+            dirty = repo.is_dirty()
+            head = repo.head()
+            if dirty is not None and head is not None:
+                params = []
+                subdir = os.path.relpath(self.flake_dir, repo.worktree)
+                if subdir != ".":
+                    params.append(f"dir={subdir}")
+                # a dirty flake is referenced without revision, like nix does
+                if not dirty:
+                    ref, rev = head
+                    if ref is not None:
+                        params.append(f"ref={ref}")
+                    params.append(f"rev={rev}")
+                url = f"git+file://{repo.worktree}"
+                if params:
+                    url += "?" + "&".join(params)
+                return url, dirty
+        metadata = self.flake_metadata
+        return metadata["url"], "dirtyRevision" in metadata
+
+    def _machine_attr(self, system: str) -> str:
+        return f'clanInternals.machines."{system}"."{self.data.name}"'
+
+    def _machine_installable(self, system: str) -> str:
+        return f"{self._flake_ref()}#{self._machine_attr(system)}"
+
+    def _repl_eval(self, system: str, expr: str) -> Any:
+        """
+        Evaluate expr with `machine` bound to the machine in a long-lived nix repl
+        """
+        return NIX_REPL_POOL.eval_json(
+            self._flake_ref(),
+            self.flake_fingerprint or "",
+            f"let machine = outputs.{self._machine_attr(system)}; in {expr}",
+        )
+
     def nix(
         self,
         method: str,
@@ -188,33 +321,28 @@ class Machine:
         config = nix_config()
         system = config["system"]
 
-        file_info = dict()
-        with NamedTemporaryFile(mode="w") as config_json:
-            if extra_config is not None:
-                json.dump(extra_config, config_json, indent=2)
-            else:
-                json.dump({}, config_json)
-            config_json.flush()
-
-            file_info = json.loads(
-                run(
-                    nix_eval(
-                        [
-                            "--impure",
-                            "--expr",
-                            f'let x = (builtins.fetchTree {{ type = "file"; url = "file://{config_json.name}"; }}); in {{ narHash = x.narHash; path = x.outPath; }}',
-                        ]
-                    )
-                ).stdout.strip()
-            )
-
         args = []
 
         # get git commit from flake
         if extra_config is not None:
-            metadata = nix_metadata(self.flake_dir)
-            url = metadata["url"]
-            if "dirtyRevision" in metadata:
+            with NamedTemporaryFile(mode="w") as config_json:
+                json.dump(extra_config, config_json, indent=2)
+                config_json.flush()
+
+                file_info = json.loads(
+                    run(
+                        nix_eval(
+                            [
+                                "--impure",
+                                "--expr",
+                                f'let x = (builtins.fetchTree {{ type = "file"; url = "file://{config_json.name}"; }}); in {{ narHash = x.narHash; path = x.outPath; }}',
+                            ]
+                        )
+                    ).stdout.strip()
+                )
+
+            url, dirty = self._eval_flake_url()
+            if dirty:
                 # if not impure:
                 #     raise ClanError(
                 #         "The machine has a dirty revision, and impure mode is not allowed"
@@ -236,13 +364,13 @@ class Machine:
                 """,
             ]
         else:
-            if (self.flake_dir / ".git").exists():
-                flake = f"git+file://{self.flake_dir}"
-            else:
-                flake = f"path:{self.flake_dir}"
-
+            if method == "eval" and not nix_options and nix_repl_enabled():
+                try:
+                    return _nix_json(self._repl_eval(system, f"machine.{attr}"))
+                except NixReplTimeoutError as e:
+                    log.warning(f"{e}, falling back to nix eval")
             args += [
-                f'{flake}#clanInternals.machines."{system}".{self.data.name}.{attr}',
+                f"{self._machine_installable(system)}.{attr}",
                 *nix_options,
             ]
 
@@ -270,13 +398,89 @@ class Machine:
         if attr in self.eval_cache and not refresh and extra_config is None:
             return self.eval_cache[attr]
 
-        output = self.nix("eval", attr, extra_config, impure, nix_options)
+        disk_cache = DiskCache(user_eval_cache_dir())
+        key = self._disk_cache_key("eval", attr, extra_config, impure, nix_options)
+        if key is not None and not refresh:
+            cached = disk_cache.get(key)
+            if isinstance(cached, str):
+                if extra_config is None:
+                    self.eval_cache[attr] = cached
+                return cached
+
+        with span("evaluate", machine=self.data.name, attr=attr):
+            output = self.nix("eval", attr, extra_config, impure, nix_options)
         if isinstance(output, str):
-            self.eval_cache[attr] = output
+            # eval_many stores re-serialized values under the same keys
+            output = _nix_json(json.loads(output))
+            if extra_config is None:
+                self.eval_cache[attr] = output
+            if key is not None:
+                disk_cache.set(key, output, **self._cache_meta(attr))
             return output
         else:
             raise ClanError("eval_nix returned not a string")
 
+    def eval_many(
+        self,
+        attrs: list[str],
+        refresh: bool = False,
+        nix_options: list[str] = [],
+    ) -> dict[str, Any]:
+        """
+        eval multiple nix attributes of the machine in a single nix process
+        @attrs: the attributes to get
+        @return a dict mapping each attribute to its decoded json value
+        """
+        results: dict[str, Any] = {}
+        disk_cache = DiskCache(user_eval_cache_dir())
+        keys: dict[str, str | None] = {}
+        missing = []
+        for attr in dict.fromkeys(attrs):
+            if attr in self.eval_cache and not refresh:
+                results[attr] = json.loads(self.eval_cache[attr])
+                continue
+            keys[attr] = self._disk_cache_key("eval", attr, None, False, nix_options)
+            key = keys[attr]
+            if key is not None and not refresh:
+                cached = disk_cache.get(key)
+                if isinstance(cached, str):
+                    self.eval_cache[attr] = cached
+                    results[attr] = json.loads(cached)
+                    continue
+            missing.append(attr)
+
+        if not missing:
+            return results
+
+        system = nix_config()["system"]
+        fields = " ".join(f"{json.dumps(attr)} = machine.{attr};" for attr in missing)
+        with span("evaluate", machine=self.data.name, attr=" ".join(missing)):
+            values = None
+            if not nix_options and nix_repl_enabled():
+                try:
+                    values = self._repl_eval(system, f"{{ {fields} }}")
+                except NixReplTimeoutError as e:
+                    log.warning(f"{e}, falling back to nix eval")
+            if values is None:
+                output = run(
+                    nix_eval(
+                        [
+                            self._machine_installable(system),
+                            "--apply",
+                            f"machine: {{ {fields} }}",
+                            *nix_options,
+                        ]
+                    )
+                ).stdout.strip()
+                values = json.loads(output)
+        for attr, value in values.items():
+            self.eval_cache[attr] = _nix_json(value)
+            key = keys[attr]
+            if key is not None:
+                disk_cache.set(key, self.eval_cache[attr], **self._cache_meta(attr))
+            results[attr] = value
+        return results
+
     def build_nix(
         self,
         attr: str,
@@ -293,9 +497,23 @@ class Machine:
         if attr in self.build_cache and not refresh and extra_config is None:
             return self.build_cache[attr]
 
-        output = self.nix("build", attr, extra_config, impure, nix_options)
+        disk_cache = DiskCache(user_eval_cache_dir())
+        key = self._disk_cache_key("build", attr, extra_config, impure, nix_options)
+        if key is not None and not refresh:
+            cached = disk_cache.get(key)
+            # the store path might have been garbage collected in the meantime
+            if isinstance(cached, str) and Path(cached).exists():
+                if extra_config is None:
+                    self.build_cache[attr] = Path(cached)
+                return Path(cached)
+
+        with span("build", machine=self.data.name, attr=attr):
+            output = self.nix("build", attr, extra_config, impure, nix_options)
         if isinstance(output, Path):
-            self.build_cache[attr] = output
+            if extra_config is None:
+                self.build_cache[attr] = output
+            if key is not None:
+                disk_cache.set(key, str(output), **self._cache_meta(attr))
             return output
         else:
             raise ClanError("build_nix returned not a Path")
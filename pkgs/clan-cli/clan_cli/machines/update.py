@@ -1,19 +1,31 @@
 import argparse
+import asyncio
 import json
 import logging
 import os
-import shlex
-import subprocess
 import sys
+import threading
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from pathlib import Path
+from tempfile import TemporaryDirectory
 
-from ..cmd import run
+from ..cmd import Log, run
 from ..errors import ClanError
-from ..facts.generate import generate_facts
+from ..facts.generate import generate_facts_for_machines
 from ..facts.upload import upload_secrets
 from ..machines.machines import Machine
 from ..nix import nix_build, nix_command, nix_config, nix_metadata
-from ..ssh import Host, HostGroup, HostKeyCheck, parse_deployment_address
+from ..ssh import (
+    Host,
+    HostGroup,
+    HostResult,
+    parse_deployment_address,
+)
+from ..ssh.async_host_group import AsyncHostGroup, run_remote
+from ..tracing import span
+from .copy_planner import CopyPlanner
 
 log = logging.getLogger(__name__)
 
@@ -25,90 +37,155 @@ def is_path_input(node: dict[str, dict[str, str]]) -> bool:
     return locked["type"] == "path" or locked.get("url", "").startswith("file://")
 
 
-def upload_sources(
-    flake_url: str, remote_url: str, always_upload_source: bool = False
-) -> str:
-    if not always_upload_source:
-        flake_data = nix_metadata(flake_url)
-        url = flake_data["resolvedUrl"]
-        has_path_inputs = any(
-            is_path_input(node) for node in flake_data["locks"]["nodes"].values()
-        )
-        if not has_path_inputs and not is_path_input(flake_data):
-            # No need to upload sources, we can just build the flake url directly
-            # FIXME: this might fail for private repositories?
-            return url
-        if not has_path_inputs:
-            # Just copy the flake to the remote machine, we can substitute other inputs there.
-            path = flake_data["path"]
-            env = os.environ.copy()
-            # env["NIX_SSHOPTS"] = " ".join(opts.remote_ssh_options)
-            assert remote_url
-            cmd = nix_command(
-                [
-                    "copy",
-                    "--to",
-                    f"ssh://{remote_url}",
-                    "--no-check-sigs",
-                    path,
-                ]
+def archive_paths(archive: dict) -> list[str]:
+    paths = [archive["path"]]
+    for node in archive.get("inputs", {}).values():
+        paths += archive_paths(node)
+    return paths
+
+
+class SourceUploader:
+    """
+    Uploads the sources of a flake to many hosts.
+    What needs to be uploaded is computed once and shared between all hosts,
+    each host only receives the store paths it does not have yet.
+    """
+
+    def __init__(
+        self,
+        flake_url: str,
+        always_upload_source: bool = False,
+        max_parallel: int = 4,
+    ) -> None:
+        self.flake_url = flake_url
+        self.always_upload_source = always_upload_source
+        self.max_parallel = max_parallel
+        self._lock = threading.Lock()
+        self._plan: tuple[str, CopyPlanner | None] | None = None
+
+    def _compute_plan(self) -> tuple[str, CopyPlanner | None]:
+        if not self.always_upload_source:
+            flake_data = nix_metadata(self.flake_url)
+            url = flake_data["resolvedUrl"]
+            has_path_inputs = any(
+                is_path_input(node) for node in flake_data["locks"]["nodes"].values()
             )
-            proc = subprocess.run(cmd, stdout=subprocess.PIPE, env=env, check=False)
-            if proc.returncode != 0:
-                raise ClanError(
-                    f"failed to upload sources: {shlex.join(cmd)} failed with {proc.returncode}"
-                )
-            return path
-
-    # Slow path: we need to upload all sources to the remote machine
-    assert remote_url
-    cmd = nix_command(
-        [
-            "flake",
-            "archive",
-            "--to",
-            f"ssh://{remote_url}",
-            "--json",
-            flake_url,
-        ]
-    )
-    log.info("run %s", shlex.join(cmd))
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, check=False)
-    if proc.returncode != 0:
-        raise ClanError(
-            f"failed to upload sources: {shlex.join(cmd)} failed with {proc.returncode}"
-        )
-    try:
-        return json.loads(proc.stdout)["path"]
-    except (json.JSONDecodeError, OSError) as e:
-        raise ClanError(
-            f"failed to parse output of {shlex.join(cmd)}: {e}\nGot: {proc.stdout.decode('utf-8', 'replace')}"
+            if not has_path_inputs and not is_path_input(flake_data):
+                # No need to upload sources, we can just build the flake url directly
+                # FIXME: this might fail for private repositories?
+                return url, None
+            if not has_path_inputs:
+                # Just copy the flake to the remote machine, we can substitute other inputs there.
+                path = flake_data["path"]
+                return path, CopyPlanner([path], max_parallel=self.max_parallel)
+
+        # Slow path: we need to upload all sources to the remote machine.
+        # Without --dry-run, so inputs that were never evaluated are fetched
+        # into the local store before we copy their closure.
+        proc = run(
+            nix_command(["flake", "archive", "--json", self.flake_url]),
+            error_msg=f"failed to archive {self.flake_url}",
         )
+        try:
+            archive = json.loads(proc.stdout)
+        except json.JSONDecodeError as e:
+            raise ClanError(
+                f"failed to parse output of nix flake archive: {e}\nGot: {proc.stdout}"
+            )
+        paths = archive_paths(archive)
+        return archive["path"], CopyPlanner(paths, max_parallel=self.max_parallel)
 
+    def upload(self, host: Host) -> str:
+        """
+        Upload the sources to host and return the flake url to build on host
+        """
+        with self._lock:
+            if self._plan is None:
+                self._plan = self._compute_plan()
+            url, planner = self._plan
+        if planner is not None:
+            planner.copy(host)
+        return url
 
-def deploy_nixos(hosts: HostGroup) -> None:
+
+def default_jobs() -> int:
+    return os.cpu_count() or 4
+
+
+def print_summary(
+    results: list[HostResult[None]], durations: dict[str, timedelta]
+) -> None:
+    rows = [("MACHINE", "STATUS", "DURATION")]
+    for result in results:
+        name = result.host.command_prefix
+        status = "failed" if result.error else "ok"
+        duration = durations.get(name)
+        # strip microseconds
+        elapsed = str(duration).split(".")[0] if duration else "-"
+        rows.append((name, status, elapsed))
+    widths = [max(len(row[i]) for row in rows) for i in range(3)]
+    for row in rows:
+        line = "  ".join(col.ljust(width) for col, width in zip(row, widths))
+        print(line.rstrip())
+
+
+def run_deploy(
+    hosts: HostGroup,
+    func: Callable[[Host], Awaitable[None]],
+    jobs: int | None = None,
+) -> None:
     """
-    Deploy to all hosts in parallel
+    Await func for all hosts from one event loop, at most `jobs` at a time,
+    and print a summary once all hosts are done.
+    func runs the commands on the hosts with run_remote,
+    blocking steps are moved to a thread with asyncio.to_thread.
     """
+    total = len(hosts.hosts)
+    durations: dict[str, timedelta] = {}
+    finished = 0
 
-    def deploy(h: Host) -> None:
-        target = f"{h.user or 'root'}@{h.host}"
-        ssh_arg = f"-p {h.port}" if h.port else ""
-        env = os.environ.copy()
-        env["NIX_SSHOPTS"] = ssh_arg
-        machine: Machine = h.meta["machine"]
+    async def func_with_progress(h: Host) -> None:
+        nonlocal finished
+        start = datetime.now()
+        try:
+            machine: Machine | None = h.meta.get("machine")
+            with span(
+                "deploy",
+                machine=machine.name if machine else h.host,
+                host=h.command_prefix,
+            ):
+                await func(h)
+        finally:
+            durations[h.command_prefix] = datetime.now() - start
+            finished += 1
+            log.info(f"[{finished}/{total}] finished deploying {h.command_prefix}")
 
-        generate_facts(machine)
-        upload_secrets(machine)
+    group = AsyncHostGroup(hosts.hosts, max_concurrency=jobs or default_jobs())
+    results = asyncio.run(group.run_function(func_with_progress, check=False))
+    if total > 1:
+        print_summary(results, durations)
+    failed = [r.host.command_prefix for r in results if r.error]
+    if failed:
+        raise ClanError(f"failed to update machines: {', '.join(failed)}")
 
-        path = upload_sources(".", target)
 
-        if h.host_key_check != HostKeyCheck.STRICT:
-            ssh_arg += " -o StrictHostKeyChecking=no"
-        if h.host_key_check == HostKeyCheck.NONE:
-            ssh_arg += " -o UserKnownHostsFile=/dev/null"
+def deploy_nixos(hosts: HostGroup, jobs: int | None = None) -> None:
+    """
+    Deploy to all hosts in parallel, at most `jobs` at a time
+    """
+
+    sources = SourceUploader(".", max_parallel=jobs or default_jobs())
+    # generate the facts of all machines at once, so generators run in parallel
+    # and the changes end up in a single commit
+    generate_facts_for_machines([h.meta["machine"] for h in hosts.hosts], jobs=jobs)
+
+    async def deploy(h: Host) -> None:
+        machine: Machine = h.meta["machine"]
 
-        ssh_arg += " -i " + h.key if h.key else ""
+        await asyncio.to_thread(upload_secrets, machine)
+
+        with span("copy"):
+            path = await asyncio.to_thread(sources.upload, h)
 
         extra_args = h.meta.get("extra_args", [])
         cmd = [
@@ -130,12 +207,114 @@ def deploy_nixos(hosts: HostGroup) -> None:
         if target_host := h.meta.get("target_host"):
             target_host = f"{target_host.user or 'root'}@{target_host.host}"
             cmd.extend(["--target-host", target_host])
-        ret = h.run(cmd, check=False)
-        # re-retry switch if the first time fails
-        if ret.returncode != 0:
-            ret = h.run(cmd)
+        # nixos-rebuild builds the system on the host before activating it
+        with span("activate"):
+            ret = await run_remote(h, cmd, check=False)
+            # re-retry switch if the first time fails
+            if ret.returncode != 0:
+                ret = await run_remote(h, cmd)
+
+    run_deploy(hosts, deploy, jobs)
+
 
-    hosts.run_function(deploy)
+def build_toplevels(
+    machines: list[Machine], flake_dir: Path, out_link: Path
+) -> tuple[dict[str, Path], dict[str, str]]:
+    """
+    Build the system closures of all machines with a single nix build,
+    so the flake is evaluated once and nix can schedule all builds together.
+    Returns the closures of the machines that could be built
+    and the build errors of the others.
+    """
+    system = nix_config()["system"]
+
+    def installable(machine: Machine) -> str:
+        return f'{flake_dir}#clanInternals.machines."{system}"."{machine.name}".config.system.build.toplevel'
+
+    with span("build", machines=len(machines)):
+        # with --keep-going a broken machine doesn't stop the builds of the others
+        proc = run(
+            nix_build(["--keep-going", *map(installable, machines)], out_link),
+            log=Log.BOTH,
+            check=False,
+        )
+    if proc.returncode == 0:
+        # one out path per installable, in the order of the installables
+        paths = proc.stdout.split()
+        if len(paths) != len(machines):
+            raise ClanError(
+                f"expected {len(machines)} out paths from nix build, got:\n{proc.stdout}"
+            )
+        return {m.name: Path(p) for m, p in zip(machines, paths)}, {}
+
+    # nix doesn't tell which installables failed, but everything that could be
+    # built is in the store now, so building the machines one by one is cheap
+    toplevels: dict[str, Path] = {}
+    failures: dict[str, str] = {}
+    links = out_link.parent / f"{out_link.name}-machines"
+    links.mkdir(exist_ok=True)
+    for machine in machines:
+        with span("build", machine=machine.name):
+            proc = run(
+                nix_build([installable(machine)], links / machine.name),
+                log=Log.NONE,
+                check=False,
+            )
+        if proc.returncode == 0:
+            toplevels[machine.name] = Path(proc.stdout.strip())
+        else:
+            failures[machine.name] = proc.stderr.strip()
+    return toplevels, failures
+
+
+def deploy_fleet(hosts: HostGroup, flake_dir: Path, jobs: int | None = None) -> None:
+    """
+    Build all machines in one nix build, then copy the closures
+    and activate them on all hosts in parallel.
+    Machines that fail to build are reported as failed, the others are deployed.
+    """
+    machines: list[Machine] = [h.meta["machine"] for h in hosts.hosts]
+    # facts might change the configuration, so they have to exist before we build
+    generate_facts_for_machines(machines, jobs=jobs)
+
+    with TemporaryDirectory() as tmpdir:
+        # the out links keep the closures alive until every host got them
+        toplevels, failures = build_toplevels(
+            machines, flake_dir, Path(tmpdir) / "result"
+        )
+        # the closures of all machines are computed once, most paths are shared
+        planner = CopyPlanner(
+            [str(p) for p in toplevels.values()],
+            max_parallel=jobs or default_jobs(),
+            substitute_on_destination=True,
+        )
+
+        async def activate(h: Host) -> None:
+            machine: Machine = h.meta["machine"]
+            if machine.name in failures:
+                raise ClanError(
+                    f"failed to build {machine.name}:\n{failures[machine.name]}"
+                )
+            target_host: Host = h.meta.get("target_host", h)
+            toplevel = toplevels[machine.name]
+
+            await asyncio.to_thread(upload_secrets, machine)
+            with span("copy"):
+                await asyncio.to_thread(planner.copy, target_host, [str(toplevel)])
+            with span("activate"):
+                profile = "/nix/var/nix/profiles/system"
+                await run_remote(
+                    target_host,
+                    ["nix-env", "-p", profile, "--set", str(toplevel)],
+                    become_root=True,
+                )
+                await run_remote(
+                    target_host,
+                    [f"{toplevel}/bin/switch-to-configuration", "switch"],
+                    become_root=True,
+                )
+
+        run_deploy(hosts, activate, jobs)
 
 
 # function to speedup eval if we want to evauluate all machines
@@ -171,11 +350,17 @@ def get_all_machines(clan_dir: Path) -> HostGroup:
     return HostGroup(hosts)
 
 
-def get_selected_machines(machine_names: list[str], flake_dir: Path) -> HostGroup:
-    hosts = []
-    for name in machine_names:
+def get_selected_machines(
+    machine_names: list[str], flake_dir: Path, jobs: int | None = None
+) -> HostGroup:
+    def build_host(name: str) -> Host:
         machine = Machine(name=name, flake=flake_dir)
-        hosts.append(machine.build_host)
+        # this evaluates the deployment info of the machine
+        return machine.build_host
+
+    # evaluate the machines concurrently, but don't start more nix processes than jobs
+    with ThreadPoolExecutor(max_workers=jobs or default_jobs()) as executor:
+        hosts = list(executor.map(build_host, machine_names))
     return HostGroup(hosts)
 
 
@@ -200,9 +385,12 @@ def update(args: argparse.Namespace) -> None:
         if len(args.machines) == 0:
             machines = get_all_machines(args.flake)
         else:
-            machines = get_selected_machines(args.machines, args.flake)
+            machines = get_selected_machines(args.machines, args.flake, args.jobs)
 
-    deploy_nixos(machines)
+    if args.fleet:
+        deploy_fleet(machines, args.flake, args.jobs)
+    else:
+        deploy_nixos(machines, args.jobs)
 
 
 def register_update_parser(parser: argparse.ArgumentParser) -> None:
@@ -218,4 +406,17 @@ def register_update_parser(parser: argparse.ArgumentParser) -> None:
         type=str,
         help="address of the machine to update, in the format of user@host:1234",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        help="maximum number of machines to evaluate and deploy in parallel (default: number of cpus)",
+    )
+    parser.add_argument(
+        "--fleet",
+        action="store_true",
+        default=False,
+        help="build all machines locally in a single nix build, then copy and activate the closures on each machine",
+    )
     parser.set_defaults(func=update)
@@ -1,11 +1,25 @@
+import hashlib
 import json
+import logging
 import os
+import shutil
 import tempfile
+import threading
+from contextlib import ExitStack
 from pathlib import Path
 from typing import Any
 
-from .cmd import run
-from .dirs import nixpkgs_flake, nixpkgs_source
+from .cmd import Log, run
+from .dirs import (
+    nixpkgs_flake,
+    nixpkgs_source,
+    user_config_dir,
+    user_nix_config_cache_dir,
+    user_tool_cache_dir,
+)
+from .disk_cache import DiskCache, cache_key
+
+log = logging.getLogger(__name__)
 
 
 def nix_command(flags: list[str]) -> list[str]:
@@ -58,13 +72,80 @@ def nix_add_to_gcroots(nix_path: Path, dest: Path) -> None:
     run(cmd)
 
 
+def _nix_conf_files() -> list[Path]:
+    files = [Path(os.environ.get("NIX_CONF_DIR", "/etc/nix")) / "nix.conf"]
+    user_files = os.environ.get("NIX_USER_CONF_FILES")
+    if user_files:
+        files += [Path(f) for f in user_files.split(":") if f]
+    else:
+        xdg_dirs = os.environ.get("XDG_CONFIG_DIRS", "/etc/xdg").split(":")
+        files += [Path(d) / "nix" / "nix.conf" for d in xdg_dirs if d]
+        files.append(user_config_dir() / "nix" / "nix.conf")
+    return files
+
+
+def _read_nix_conf(file: Path, digests: dict[str, str | None]) -> None:
+    """
+    Record the content hash of a nix.conf file and of the files it includes.
+    Keyed by the real path: on NixOS the files are symlinks into the store,
+    where every mtime is 1.
+    """
+    path = os.path.realpath(file)
+    if path in digests:
+        return
+    try:
+        data = Path(path).read_bytes()
+    except OSError:
+        digests[path] = None
+        return
+    digests[path] = hashlib.sha256(data).hexdigest()
+    for line in data.decode(errors="replace").splitlines():
+        words = line.split("#", 1)[0].split()
+        if len(words) == 2 and words[0] in ("include", "!include"):
+            # relative includes are resolved against the including file
+            _read_nix_conf(file.parent / words[1], digests)
+
+
+def _nix_config_cache_key() -> str:
+    """
+    Changes whenever the nix binary or one of the nix.conf files changes
+    """
+    nix = shutil.which("nix")
+    # the store path of the nix binary contains the version
+    nix_path = os.path.realpath(nix) if nix else None
+    digests: dict[str, str | None] = {}
+    for file in _nix_conf_files():
+        _read_nix_conf(file, digests)
+    return cache_key(
+        nix_path,
+        sorted(digests.items()),
+        os.environ.get("NIX_CONFIG"),
+        os.environ.get("NIX_REMOTE"),
+        os.environ.get("IN_NIX_SANDBOX"),
+    )
+
+
+# memoized for the lifetime of the process, see nix_config()
+_nix_config: dict[str, Any] | None = None
+
+
 def nix_config() -> dict[str, Any]:
-    cmd = nix_command(["show-config", "--json"])
-    proc = run(cmd)
-    data = json.loads(proc.stdout)
-    config = {}
-    for key, value in data.items():
-        config[key] = value["value"]
+    global _nix_config
+    if _nix_config is not None:
+        return _nix_config
+
+    disk_cache = DiskCache(user_nix_config_cache_dir(), max_entries=16)
+    key = _nix_config_cache_key()
+    config = disk_cache.get(key)
+    if not isinstance(config, dict):
+        cmd = nix_command(["show-config", "--json"])
+        proc = run(cmd)
+        data = json.loads(proc.stdout)
+        config = {}
+        for name, value in data.items():
+            config[name] = value["value"]
+        disk_cache.set(key, config)
+    _nix_config = config
     return config
 
 
@@ -100,11 +181,105 @@ def nix_metadata(flake_url: str | Path) -> dict[str, Any]:
     return data
 
 
+# package -> bin directories of its store paths, see resolve_packages()
+_tool_paths: dict[str, list[str]] = {}
+# package -> lock held while the package is realised, guarded by _tool_lock
+_tool_locks: dict[str, threading.Lock] = {}
+_tool_lock = threading.Lock()
+
+
+def _tool_cache_key(package: str) -> str:
+    # nixpkgs_flake() resolves to a different store path for every nixpkgs revision
+    return cache_key(str(nixpkgs_flake()), package)
+
+
+def _cached_tool_paths(disk_cache: DiskCache, package: str) -> list[str] | None:
+    paths = _tool_paths.get(package)
+    if paths is None:
+        paths = disk_cache.get(_tool_cache_key(package))
+        if not isinstance(paths, list):
+            return None
+    # the store paths might have been garbage collected in the meantime
+    if not all(os.path.isdir(path) for path in paths):
+        return None
+    _tool_paths[package] = paths
+    return paths
+
+
+def resolve_packages(packages: list[str]) -> list[str] | None:
+    """
+    Realise packages from our pinned nixpkgs
+    and return the bin directories to put into PATH.
+    Every package is only realised once per nixpkgs revision,
+    the store paths are remembered in an on-disk cache.
+    Returns None if the packages could not be realised.
+    """
+    disk_cache = DiskCache(user_tool_cache_dir(), max_entries=256)
+    with _tool_lock:
+        locks = [
+            _tool_locks.setdefault(p, threading.Lock()) for p in sorted(set(packages))
+        ]
+    # only resolutions of the same packages wait for each other,
+    # the locks are taken in sorted order to not deadlock
+    with ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        missing = [
+            package
+            for package in dict.fromkeys(packages)
+            if _cached_tool_paths(disk_cache, package) is None
+        ]
+        if missing:
+            cmd = nix_command(
+                [
+                    "build",
+                    "--inputs-from",
+                    f"{nixpkgs_flake()!s}",
+                    "--no-link",
+                    "--json",
+                    *missing,
+                ]
+            )
+            try:
+                proc = run(cmd, check=False, log=Log.NONE)
+            except OSError as e:
+                log.debug(f"failed to run nix: {e}")
+                return None
+            if proc.returncode != 0:
+                log.debug(f"failed to realise {' '.join(missing)}: {proc.stderr}")
+                return None
+            try:
+                # the results are in the same order as the installables
+                resolved = {
+                    package: [
+                        f"{path}/bin"
+                        for path in result["outputs"].values()
+                        if os.path.isdir(f"{path}/bin")
+                    ]
+                    for package, result in zip(
+                        missing, json.loads(proc.stdout), strict=True
+                    )
+                }
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                log.debug(f"unexpected output of nix build for {missing}: {e}")
+                return None
+            for package, paths in resolved.items():
+                _tool_paths[package] = paths
+                disk_cache.set(_tool_cache_key(package), paths, package=package)
+        return [path for package in packages for path in _tool_paths[package]]
+
+
 def nix_shell(packages: list[str], cmd: list[str]) -> list[str]:
     # we cannot use nix-shell inside the nix sandbox
     # in our tests we just make sure we have all the packages
     if os.environ.get("IN_NIX_SANDBOX"):
         return cmd
+    paths = resolve_packages(packages)
+    if paths == []:
+        return cmd
+    if paths is not None:
+        # like `nix shell`, prepend the packages to PATH when the command is started
+        return ["sh", "-c", 'PATH="$0:$PATH"; exec "$@"', ":".join(paths), *cmd]
     return [
         *nix_command(
             [
@@ -0,0 +1,326 @@
+import atexit
+import json
+import logging
+import os
+import re
+import select
+import subprocess
+import threading
+import time
+from typing import IO, Any
+
+from .errors import ClanError
+from .nix import nix_command
+from .output_capture import READ_SIZE, LineBuffer
+
+log = logging.getLogger(__name__)
+
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+NIX_STRING_ESCAPE = re.compile(r"\\(.)", re.DOTALL)
+
+
+def nix_repl_enabled() -> bool:
+    """
+    The evaluation workers are opt-in via CLAN_EVAL_WORKER=1.
+    We cannot use them inside the nix sandbox, where nix_eval needs to override the store.
+    """
+    if os.environ.get("IN_NIX_SANDBOX"):
+        return False
+    return os.environ.get("CLAN_EVAL_WORKER", "") == "1"
+
+
+def eval_worker_timeout() -> float:
+    """
+    Seconds a nix repl worker may take for a single query, CLAN_EVAL_WORKER_TIMEOUT (default 600)
+    """
+    value = os.environ.get("CLAN_EVAL_WORKER_TIMEOUT", "600")
+    try:
+        timeout = float(value)
+    except ValueError:
+        timeout = 0
+    if timeout <= 0:
+        raise ClanError(
+            f"CLAN_EVAL_WORKER_TIMEOUT must be a positive number, got '{value}'"
+        )
+    return timeout
+
+
+class NixReplTimeoutError(ClanError):
+    """
+    A nix repl worker did not answer in time and was killed
+    """
+
+
+def parse_nix_string(line: str) -> str:
+    """
+    Parse a string literal as printed by the nix repl
+    """
+    line = ANSI_ESCAPE.sub("", line).strip()
+    # skip a prompt that some nix versions print even if stdin is not a tty
+    start = line.find('"')
+    if start == -1 or not line.endswith('"') or start == len(line) - 1:
+        raise ValueError(f"not a nix string: {line}")
+    escapes = {"n": "\n", "r": "\r", "t": "\t"}
+    return NIX_STRING_ESCAPE.sub(
+        lambda m: escapes.get(m.group(1), m.group(1)), line[start + 1 : -1]
+    )
+
+
+class NixRepl:
+    """
+    A long-lived `nix repl` process with a flake loaded.
+    Queries are written to stdin and the result is read back up to a sentinel,
+    so the flake and nixpkgs are only instantiated once for many queries.
+    A worker that does not answer within timeout seconds is killed
+    and NixReplTimeoutError is raised.
+    """
+
+    def __init__(self, flake_url: str, timeout: float | None = None) -> None:
+        self.flake_url = flake_url
+        self.timeout = eval_worker_timeout() if timeout is None else timeout
+        self._counter = 0
+        self._stdout_buf = LineBuffer()
+        self._stdout_lines: list[str] = []
+        self._stderr_lines: list[str] = []
+        self._stderr_lock = threading.Lock()
+        env = os.environ.copy()
+        env["NO_COLOR"] = "1"
+        env["TERM"] = "dumb"
+        self.process = subprocess.Popen(
+            nix_command(["repl"]),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env,
+        )
+        self._stderr_thread = threading.Thread(
+            target=self._drain_stderr, args=(self.process.stderr,), daemon=True
+        )
+        self._stderr_thread.start()
+        self._command(f":lf {flake_url}")
+
+    def _drain_stderr(self, stderr: IO[bytes] | None) -> None:
+        assert stderr is not None
+        for line in stderr:
+            with self._stderr_lock:
+                self._stderr_lines.append(line.decode("utf-8", "replace"))
+
+    def _take_stderr(self) -> str:
+        with self._stderr_lock:
+            lines = self._stderr_lines
+            self._stderr_lines = []
+        return "".join(lines)
+
+    def _readline(self, deadline: float) -> str | None:
+        """
+        Return the next line printed on stdout, None once stdout is closed.
+        The worker is killed if no line arrives before the deadline.
+        """
+        assert self.process.stdout is not None
+        fd = self.process.stdout.fileno()
+        while not self._stdout_lines:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.process.kill()
+                self.process.wait()
+                raise NixReplTimeoutError(
+                    f"nix repl for {self.flake_url} did not answer within {self.timeout}s"
+                )
+            if not select.select([fd], [], [], remaining)[0]:
+                continue
+            chunk = os.read(fd, READ_SIZE)
+            lines = self._stdout_buf.feed(chunk) if chunk else self._stdout_buf.flush()
+            if not chunk and not lines:
+                return None
+            self._stdout_lines += [line.decode("utf-8", "replace") for line in lines]
+        return self._stdout_lines.pop(0)
+
+    def _command(self, command: str) -> list[str]:
+        """
+        Run a repl command and return the lines it printed on stdout
+        """
+        assert self.process.stdin is not None
+        self._counter += 1
+        sentinel = f"__clan_eof_{self._counter}"
+        self._take_stderr()
+        try:
+            self.process.stdin.write(f'{command}\n"{sentinel}"\n'.encode())
+            self.process.stdin.flush()
+        except BrokenPipeError as e:
+            raise ClanError(f"nix repl for {self.flake_url} died") from e
+
+        lines = []
+        deadline = time.monotonic() + self.timeout
+        while True:
+            line = self._readline(deadline)
+            if line is None:
+                # give the stderr thread a chance to collect the error message
+                self._stderr_thread.join(timeout=1)
+                raise ClanError(
+                    f"nix repl for {self.flake_url} exited unexpectedly:\n{self._take_stderr()}"
+                )
+            if line.rstrip().endswith(f'"{sentinel}"'):
+                break
+            if ANSI_ESCAPE.sub("", line).strip():
+                lines.append(line)
+        return lines
+
+    def eval_json(self, expr: str) -> Any:
+        """
+        Evaluate expr in the scope of the loaded flake outputs and return the decoded value
+        """
+        lines = self._command(f"builtins.toJSON ({expr})")
+        for line in reversed(lines):
+            try:
+                return json.loads(parse_nix_string(line))
+            except ValueError:
+                continue
+        # errors are printed on stderr before the sentinel is echoed,
+        # but the stderr thread might not have picked them up yet.
+        deadline = time.time() + 1
+        stderr = self._take_stderr()
+        while not stderr and time.time() < deadline:
+            time.sleep(0.01)
+            stderr = self._take_stderr()
+        raise ClanError(f"failed to evaluate {expr} in {self.flake_url}:\n{stderr}")
+
+    def close(self) -> None:
+        if self.process.poll() is not None:
+            return
+        try:
+            assert self.process.stdin is not None
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+
+def eval_workers() -> int:
+    """
+    The number of nix repl workers per flake revision, CLAN_EVAL_WORKERS (default 2)
+    """
+    value = os.environ.get("CLAN_EVAL_WORKERS", "2")
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size < 1:
+        raise ClanError(f"CLAN_EVAL_WORKERS must be a positive number, got '{value}'")
+    return size
+
+
+class _Slot:
+    """
+    The workers of one flake revision
+    """
+
+    def __init__(self) -> None:
+        self.idle: list[NixRepl] = []
+        # idle and busy workers
+        self.count = 0
+        # set once the revision is outdated, its workers are closed when released
+        self.discarded = False
+
+
+class NixReplPool:
+    """
+    Keeps up to `size` nix repl workers per flake revision around.
+    A worker is only used by one thread at a time.
+    """
+
+    def __init__(self, size: int | None = None) -> None:
+        self._size = size
+        self._cond = threading.Condition()
+        # (flake_url, fingerprint) -> workers
+        self._slots: dict[tuple[str, str], _Slot] = {}
+        self._all: set[NixRepl] = set()
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            self._size = eval_workers()
+        return self._size
+
+    def _discard(self, key: tuple[str, str]) -> list[NixRepl]:
+        """
+        Forget the workers of key and return the idle ones, which need to be closed.
+        Must be called with the lock held.
+        """
+        slot = self._slots.pop(key)
+        slot.discarded = True
+        idle = slot.idle
+        slot.idle = []
+        slot.count -= len(idle)
+        self._all.difference_update(idle)
+        # threads waiting for a worker of key need to pick up the new slot
+        self._cond.notify_all()
+        return idle
+
+    def _acquire(self, key: tuple[str, str]) -> tuple[_Slot, NixRepl]:
+        size = self.size
+        outdated: list[NixRepl] = []
+        repl = None
+        with self._cond:
+            # workers of older revisions of the same flake are no longer needed
+            for old_key in list(self._slots):
+                if old_key[0] == key[0] and old_key != key:
+                    outdated += self._discard(old_key)
+            while True:
+                slot = self._slots.setdefault(key, _Slot())
+                if slot.idle:
+                    repl = slot.idle.pop()
+                    break
+                if slot.count < size:
+                    slot.count += 1
+                    break
+                # woken up when a worker is released, dies or key is discarded
+                self._cond.wait()
+        for old in outdated:
+            old.close()
+        if repl is not None:
+            return slot, repl
+        try:
+            repl = NixRepl(key[0])
+        except Exception:
+            with self._cond:
+                slot.count -= 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._all.add(repl)
+        return slot, repl
+
+    def _release(self, slot: _Slot, repl: NixRepl) -> None:
+        with self._cond:
+            reuse = not slot.discarded and repl.process.poll() is None
+            if reuse:
+                slot.idle.append(repl)
+            else:
+                slot.count -= 1
+                self._all.discard(repl)
+            self._cond.notify_all()
+        if not reuse:
+            repl.close()
+
+    def eval_json(self, flake_url: str, fingerprint: str, expr: str) -> Any:
+        slot, repl = self._acquire((flake_url, fingerprint))
+        try:
+            return repl.eval_json(expr)
+        finally:
+            self._release(slot, repl)
+
+    def close(self) -> None:
+        with self._cond:
+            repls = list(self._all)
+            self._all.clear()
+            for slot in self._slots.values():
+                slot.discarded = True
+            self._slots.clear()
+            self._cond.notify_all()
+        for repl in repls:
+            repl.close()
+
+
+NIX_REPL_POOL = NixReplPool()
+atexit.register(NIX_REPL_POOL.close)
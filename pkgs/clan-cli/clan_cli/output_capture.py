@@ -0,0 +1,96 @@
+from collections import deque
+from collections.abc import Callable
+from typing import IO
+
+# How much we read from a pipe at once
+READ_SIZE = 64 * 1024
+
+# How much stderr of a command is kept in memory by default.
+# stderr only ends up in error messages, where the last lines are what matters.
+# stdout is kept in full unless the caller asks for a limit, it is parsed by the caller.
+MAX_STDERR_BYTES = 1024 * 1024
+
+
+class OutputCapture:
+    """
+    Collects the output of a process in linear time.
+    Chunks are appended to a list and only joined once when the output is requested.
+    @max_bytes: only keep the last max_bytes of output, older output is dropped
+    @tee: file that receives a copy of all output, i.e. a log file
+    @callback: called with every chunk as it arrives
+    """
+
+    def __init__(
+        self,
+        max_bytes: int | None = None,
+        tee: IO[bytes] | None = None,
+        callback: Callable[[bytes], None] | None = None,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.tee = tee
+        self.callback = callback
+        self._chunks: deque[bytes] = deque()
+        self._size = 0
+        # number of bytes dropped because of max_bytes
+        self.dropped = 0
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        if self.tee is not None:
+            self.tee.write(data)
+        if self.callback is not None:
+            self.callback(data)
+        self._chunks.append(data)
+        self._size += len(data)
+        if self.max_bytes is None:
+            return
+        while self._chunks and self._size - len(self._chunks[0]) >= self.max_bytes:
+            chunk = self._chunks.popleft()
+            self._size -= len(chunk)
+            self.dropped += len(chunk)
+
+    def getvalue(self) -> bytes:
+        data = b"".join(self._chunks)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            self.dropped += len(data) - self.max_bytes
+            # not data[-max_bytes:], which keeps everything for max_bytes=0
+            data = data[len(data) - self.max_bytes :]
+            self._chunks = deque([data])
+            self._size = len(data)
+        return data
+
+    def decode(self) -> str:
+        data = self.getvalue().decode("utf-8", errors="replace")
+        if self.dropped:
+            return f"[... {self.dropped} bytes of output dropped ...]\n{data}"
+        return data
+
+
+class LineBuffer:
+    """
+    Splits a stream of chunks into lines without re-scanning old data
+    """
+
+    def __init__(self) -> None:
+        self._buf = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        end = data.rfind(b"\n")
+        if end == -1:
+            self._buf += data
+            return []
+        self._buf += data[:end]
+        lines = [bytes(line) for line in self._buf.split(b"\n")]
+        self._buf = bytearray(data[end + 1 :])
+        return lines
+
+    def flush(self) -> list[bytes]:
+        """
+        Return the incomplete last line, if any, once the stream is drained
+        """
+        if not self._buf:
+            return []
+        line = bytes(self._buf)
+        self._buf = bytearray()
+        return [line]
@@ -11,7 +11,8 @@ from .folders import (
     sops_secrets_folder,
     sops_users_folder,
 )
-from .sops import update_keys
+from .key_index import KeyIndex
+from .sops import update_keys_batch
 from .types import (
     VALID_USER_NAME,
     group_name_type,
@@ -88,13 +89,15 @@ def list_directory(directory: Path) -> str:
 
 
 def update_group_keys(flake_dir: Path, group: str) -> None:
+    index = KeyIndex.load(flake_dir)
+    group_secrets = {}
     for secret_ in secrets.list_secrets(flake_dir):
         secret = sops_secrets_folder(flake_dir) / secret_
         if (secret / "groups" / group).is_symlink():
-            update_keys(
-                secret,
-                list(sorted(secrets.collect_keys_for_path(secret))),
+            group_secrets[secret] = list(
+                sorted(secrets.collect_keys_for_path(secret, index))
             )
+    update_keys_batch(group_secrets)
 
 
 def add_member(
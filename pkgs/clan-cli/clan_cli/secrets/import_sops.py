@@ -6,7 +6,7 @@ from pathlib import Path
 from ..cmd import run
 from ..errors import ClanError
 from ..nix import nix_shell
-from .secrets import encrypt_secret, sops_secrets_folder
+from .secrets import encrypt_secrets, sops_secrets_folder
 
 
 def import_sops(args: argparse.Namespace) -> None:
@@ -26,6 +26,7 @@ def import_sops(args: argparse.Namespace) -> None:
 
         res = run(cmd, error_msg=f"Could not import sops file {file}")
         secrets = json.loads(res.stdout)
+        values = {}
         for k, v in secrets.items():
             k = args.prefix + k
             if not isinstance(v, str):
@@ -40,14 +41,18 @@ def import_sops(args: argparse.Namespace) -> None:
                     file=sys.stderr,
                 )
                 continue
-            encrypt_secret(
-                Path(args.flake),
-                sops_secrets_folder(Path(args.flake)) / k,
-                v,
-                add_groups=args.group,
-                add_machines=args.machine,
-                add_users=args.user,
-            )
+            values[k] = v
+        if not values:
+            return
+        encrypt_secrets(
+            Path(args.flake),
+            values,
+            add_groups=args.group,
+            add_machines=args.machine,
+            add_users=args.user,
+            max_workers=args.jobs,
+            commit_message=f"Import {len(values)} secrets from {file.name}",
+        )
 
 
 def register_import_sops_parser(parser: argparse.ArgumentParser) -> None:
@@ -78,6 +83,13 @@ def register_import_sops_parser(parser: argparse.ArgumentParser) -> None:
         default=[],
         help="the user to import the secrets to",
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=None,
+        help="number of secrets to encrypt in parallel (default: number of CPUs)",
+    )
     parser.add_argument(
         "--prefix",
         type=str,
@@ -0,0 +1,121 @@
+import os
+import threading
+from pathlib import Path
+
+from ..errors import ClanError
+from .folders import sops_groups_folder, sops_machines_folder, sops_users_folder
+from .sops import read_key
+
+FileStat = tuple[int, int, int] | None
+
+
+def _file_stat(path: Path) -> FileStat:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+
+class KeyIndex:
+    """
+    The public keys of all users and machines and the members of all groups,
+    read with a single walk over sops/users, sops/machines and sops/groups.
+    Use KeyIndex.load() to get an index that is rebuilt when one of the scanned
+    directories or key files changed.
+    """
+
+    def __init__(self, flake_dir: Path) -> None:
+        self.flake_dir = flake_dir
+        # resolved user or machine folder -> its public key or the error reading it
+        self.keys: dict[Path, str | ClanError] = {}
+        # resolved machines/users folder of a group -> (symlink, resolved target)
+        self.links: dict[Path, list[tuple[Path, Path | None]]] = {}
+        self._stats: dict[Path, FileStat] = {}
+        self._scan()
+
+    def _watch(self, path: Path) -> None:
+        self._stats[path] = _file_stat(path)
+
+    def _scan(self) -> None:
+        for folder in (
+            sops_users_folder(self.flake_dir),
+            sops_machines_folder(self.flake_dir),
+        ):
+            self._watch(folder)
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder):
+                path = Path(entry.path)
+                self._watch(path)
+                self._watch(path / "key.json")
+                try:
+                    key: str | ClanError = read_key(path)
+                except ClanError as e:
+                    key = e
+                except Exception:
+                    # i.e. no key.json, read_key() reports it if the key is used
+                    continue
+                self.keys[path.resolve()] = key
+
+        groups = sops_groups_folder(self.flake_dir)
+        self._watch(groups)
+        if not groups.is_dir():
+            return
+        for group in os.scandir(groups):
+            self._watch(Path(group.path))
+            for kind in ("machines", "users"):
+                folder = Path(group.path) / kind
+                self._watch(folder)
+                if folder.is_dir():
+                    self.links[folder.resolve()] = _read_links(folder)
+
+    def valid(self) -> bool:
+        return all(_file_stat(path) == stat for path, stat in self._stats.items())
+
+    def key(self, path: Path) -> str:
+        """
+        Return the public key of the resolved user or machine folder path.
+        """
+        key = self.keys.get(path)
+        if key is None:
+            return read_key(path)
+        if isinstance(key, ClanError):
+            raise key
+        return key
+
+    def folder_links(self, folder: Path) -> list[tuple[Path, Path | None]]:
+        """
+        Return the symlinks in folder together with their resolved targets,
+        or None if the target cannot be resolved.
+        """
+        links = self.links.get(folder.resolve())
+        if links is None:
+            return _read_links(folder)
+        return links
+
+    @classmethod
+    def load(cls, flake_dir: Path) -> "KeyIndex":
+        with _key_indexes_lock:
+            index = _key_indexes.get(flake_dir)
+            if index is None or not index.valid():
+                index = cls(flake_dir)
+                _key_indexes[flake_dir] = index
+            return index
+
+
+def _read_links(folder: Path) -> list[tuple[Path, Path | None]]:
+    links: list[tuple[Path, Path | None]] = []
+    for entry in os.scandir(folder):
+        path = Path(entry.path)
+        if not entry.is_symlink():
+            continue
+        try:
+            links.append((path, path.resolve()))
+        except FileNotFoundError:
+            links.append((path, None))
+    return links
+
+
+_key_indexes: dict[Path, KeyIndex] = {}
+_key_indexes_lock = threading.Lock()
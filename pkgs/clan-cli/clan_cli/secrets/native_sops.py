@@ -0,0 +1,274 @@
+"""
+In-process decryption of the sops files written by clan.
+
+clan stores every secret as a sops binary file (a json document with a single
+"data" value) encrypted for age recipients only. Such files can be decrypted
+without spawning sops: the data key is unwrapped with one of the user's age
+identities, then the value is decrypted with AES-GCM and checked against the MAC.
+Everything else (other key types, other layouts, missing cryptography package)
+is left to the sops binary.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any
+
+try:
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric.x25519 import (
+        X25519PrivateKey,
+        X25519PublicKey,
+    )
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    HAS_CRYPTOGRAPHY = True
+except ImportError:
+    HAS_CRYPTOGRAPHY = False
+
+
+class UnsupportedSopsFileError(Exception):
+    """
+    The file cannot be decrypted in-process and has to be passed to sops.
+    """
+
+
+def native_sops_enabled() -> bool:
+    """
+    The in-process decryption needs the cryptography package
+    and can be disabled with CLAN_NATIVE_SOPS=0.
+    """
+    return HAS_CRYPTOGRAPHY and os.environ.get("CLAN_NATIVE_SOPS", "1") != "0"
+
+
+def _hkdf(ikm: bytes, salt: bytes | None, info: bytes) -> bytes:
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info).derive(ikm)
+
+
+_BECH32_CHARSET = "qpzry9x8gf2tvdw0s3jn54khce6mua7l"
+
+
+def _bech32_polymod(values: list[int]) -> int:
+    generator = [0x3B6A57B2, 0x26508E6D, 0x1EA119FA, 0x3D4233DD, 0x2A1462B3]
+    chk = 1
+    for value in values:
+        top = chk >> 25
+        chk = (chk & 0x1FFFFFF) << 5 ^ value
+        for i in range(5):
+            chk ^= generator[i] if ((top >> i) & 1) else 0
+    return chk
+
+
+def _bech32_decode(text: str) -> tuple[str, bytes]:
+    text = text.lower()
+    hrp, _, data = text.rpartition("1")
+    if not hrp or len(data) < 6 or any(c not in _BECH32_CHARSET for c in data):
+        raise UnsupportedSopsFileError("invalid bech32 string")
+    values = [_BECH32_CHARSET.index(c) for c in data]
+    hrp_expanded = [ord(c) >> 5 for c in hrp] + [0] + [ord(c) & 31 for c in hrp]
+    if _bech32_polymod(hrp_expanded + values) != 1:
+        raise UnsupportedSopsFileError("invalid bech32 checksum")
+    # convert the 5 bit groups without the checksum to bytes
+    acc = 0
+    bits = 0
+    out = bytearray()
+    for value in values[:-6]:
+        acc = (acc << 5) | value
+        bits += 5
+        if bits >= 8:
+            bits -= 8
+            out.append((acc >> bits) & 0xFF)
+    return hrp, bytes(out)
+
+
+# parsed identities, keyed by their AGE-SECRET-KEY-1... encoding
+_identities: dict[str, tuple[Any, bytes]] = {}
+
+
+def _parse_identity(identity: str) -> tuple[Any, bytes]:
+    """
+    Return the X25519 private key and the raw public key of an age identity.
+    """
+    if identity not in _identities:
+        hrp, scalar = _bech32_decode(identity)
+        if hrp != "age-secret-key-" or len(scalar) != 32:
+            raise UnsupportedSopsFileError("not an age X25519 identity")
+        private_key = X25519PrivateKey.from_private_bytes(scalar)
+        _identities[identity] = (
+            private_key,
+            private_key.public_key().public_bytes_raw(),
+        )
+    return _identities[identity]
+
+
+def parse_identities(text: str) -> list[str]:
+    """
+    Return the age identities in the contents of a keys.txt file or SOPS_AGE_KEY.
+    """
+    return [
+        line.strip()
+        for line in text.splitlines()
+        if line.strip().startswith("AGE-SECRET-KEY-1")
+    ]
+
+
+def _b64decode_raw(data: str) -> bytes:
+    return base64.b64decode(data + "=" * (-len(data) % 4), validate=True)
+
+
+def _dearmor(text: str) -> bytes:
+    begin = "-----BEGIN AGE ENCRYPTED FILE-----"
+    end = "-----END AGE ENCRYPTED FILE-----"
+    text = text.strip()
+    if not text.startswith(begin) or not text.endswith(end):
+        raise UnsupportedSopsFileError("age data key is not armored")
+    body = "".join(text[len(begin) : -len(end)].split())
+    return base64.b64decode(body, validate=True)
+
+
+def age_decrypt(data: bytes, identities: list[str]) -> bytes:
+    """
+    Decrypt an age v1 file with the given X25519 identities.
+    """
+    header_end = data.find(b"\n--- ")
+    if not data.startswith(b"age-encryption.org/v1\n") or header_end == -1:
+        raise UnsupportedSopsFileError("not an age v1 file")
+    mac_end = data.index(b"\n", header_end + 1)
+    header = data[: header_end + len(b"\n---")]
+    mac = _b64decode_raw(data[header_end + len(b"\n--- ") : mac_end].decode())
+    payload = data[mac_end + 1 :]
+
+    # each stanza is "-> type args..." followed by the body in lines of 64 columns,
+    # the last line is always shorter
+    stanzas: list[tuple[list[str], bytes]] = []
+    lines = header.decode().split("\n")[1:-1]
+    i = 0
+    while i < len(lines):
+        if not lines[i].startswith("-> "):
+            raise UnsupportedSopsFileError("malformed age header")
+        args = lines[i][3:].split(" ")
+        encoded = ""
+        i += 1
+        while True:
+            if i >= len(lines):
+                raise UnsupportedSopsFileError("malformed age header")
+            encoded += lines[i]
+            i += 1
+            if len(lines[i - 1]) < 64:
+                break
+        stanzas.append((args, _b64decode_raw(encoded)))
+
+    file_key = None
+    for identity in identities:
+        private_key, public_key = _parse_identity(identity)
+        for args, wrapped_key in stanzas:
+            if args[0] != "X25519" or len(args) != 2 or len(wrapped_key) != 32:
+                continue
+            share = _b64decode_raw(args[1])
+            shared = private_key.exchange(X25519PublicKey.from_public_bytes(share))
+            salt = share + public_key
+            wrap_key = _hkdf(shared, salt, b"age-encryption.org/v1/X25519")
+            try:
+                file_key = ChaCha20Poly1305(wrap_key).decrypt(
+                    bytes(12), wrapped_key, None
+                )
+            except Exception:
+                # the stanza is for another recipient
+                continue
+            break
+        if file_key is not None:
+            break
+    if file_key is None:
+        raise UnsupportedSopsFileError("no age identity matches the recipients")
+
+    header_key = _hkdf(file_key, None, b"header")
+    if not hmac.compare_digest(
+        hmac.new(header_key, header, hashlib.sha256).digest(), mac
+    ):
+        raise UnsupportedSopsFileError("age header MAC mismatch")
+
+    # STREAM: chunks of 64KiB, each with a 16 byte tag and a counter nonce
+    nonce, payload = payload[:16], payload[16:]
+    cipher = ChaCha20Poly1305(_hkdf(file_key, nonce, b"payload"))
+    chunk_size = 64 * 1024 + 16
+    chunks = [
+        payload[i : i + chunk_size] for i in range(0, len(payload), chunk_size)
+    ] or [b""]
+    plaintext = bytearray()
+    for counter, chunk in enumerate(chunks):
+        last = counter == len(chunks) - 1
+        chunk_nonce = counter.to_bytes(11, "big") + (b"\x01" if last else b"\x00")
+        plaintext += cipher.decrypt(chunk_nonce, chunk, None)
+    return bytes(plaintext)
+
+
+_SOPS_VALUE = re.compile(
+    r"^ENC\[AES256_GCM,data:(.*),iv:(.+),tag:(.+),type:(.+)\]$", re.DOTALL
+)
+
+
+def _decrypt_value(value: str, data_key: bytes, additional_data: str) -> bytes:
+    match = _SOPS_VALUE.match(value)
+    if match is None:
+        raise UnsupportedSopsFileError("value is not encrypted with AES256_GCM")
+    if match.group(4) not in ("str", "bytes"):
+        raise UnsupportedSopsFileError(f"unsupported value type {match.group(4)}")
+    data, iv, tag = (base64.b64decode(part) for part in match.groups()[:3])
+    return AESGCM(data_key).decrypt(iv, data + tag, additional_data.encode())
+
+
+# sops key types other than age, we don't manage those
+SOPS_OTHER_KEY_TYPES = ["kms", "gcp_kms", "azure_kv", "hc_vault", "pgp", "key_groups"]
+
+
+def decrypt_sops_file(secret_path: Path, identities: list[str]) -> str:
+    """
+    Decrypt a sops binary file that is encrypted for age recipients only.
+    Raises UnsupportedSopsFileError if the file has to be decrypted by sops.
+    """
+    try:
+        return _decrypt_sops_file(secret_path, identities)
+    except UnsupportedSopsFileError:
+        raise
+    except Exception as e:
+        # i.e. a failed authentication, sops gives the better error message
+        raise UnsupportedSopsFileError(f"failed to decrypt {secret_path}: {e!r}") from e
+
+
+def _decrypt_sops_file(secret_path: Path, identities: list[str]) -> str:
+    try:
+        with open(secret_path) as f:
+            document = json.load(f)
+    except (OSError, ValueError) as e:
+        raise UnsupportedSopsFileError(f"cannot read {secret_path}: {e}") from e
+    if not isinstance(document, dict) or set(document) != {"data", "sops"}:
+        raise UnsupportedSopsFileError("not a sops binary file")
+    metadata = document["sops"]
+    if any(metadata.get(key) for key in SOPS_OTHER_KEY_TYPES):
+        raise UnsupportedSopsFileError("file uses other key types than age")
+    if metadata.get("mac_only_encrypted") or metadata.get("encrypted_regex"):
+        raise UnsupportedSopsFileError("file uses partial encryption")
+
+    data_key = None
+    for entry in metadata.get("age") or []:
+        try:
+            data_key = age_decrypt(_dearmor(entry["enc"]), identities)
+            break
+        except UnsupportedSopsFileError:
+            continue
+    if data_key is None:
+        raise UnsupportedSopsFileError("no age identity can decrypt the data key")
+
+    # sops authenticates every value with its path in the document
+    plaintext = _decrypt_value(document["data"], data_key, "data:")
+    mac = _decrypt_value(metadata["mac"], data_key, metadata["lastmodified"])
+    if not hmac.compare_digest(
+        hashlib.sha512(plaintext).hexdigest().upper().encode(), mac
+    ):
+        raise UnsupportedSopsFileError("sops MAC mismatch")
+    return plaintext.decode("utf-8")
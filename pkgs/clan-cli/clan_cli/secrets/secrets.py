@@ -3,7 +3,8 @@ import getpass
 import os
 import shutil
 import sys
-from collections.abc import Callable
+from collections.abc import Callable, Mapping
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 from typing import IO
@@ -18,71 +19,89 @@ from .folders import (
     sops_secrets_folder,
     sops_users_folder,
 )
-from .sops import decrypt_file, encrypt_file, ensure_sops_key, read_key, update_keys
+from .key_index import KeyIndex
+from .sops import (
+    SopsKey,
+    decrypt_file,
+    encrypt_file,
+    ensure_sops_key,
+    update_keys,
+    update_keys_batch,
+)
 from .types import VALID_SECRET_NAME, secret_name_type
 
 
 def update_secrets(
     flake_dir: Path, filter_secrets: Callable[[Path], bool] = lambda _: True
 ) -> list[Path]:
-    changed_files = []
+    index = KeyIndex.load(flake_dir)
+    secrets = {}
     for name in list_secrets(flake_dir):
         secret_path = sops_secrets_folder(flake_dir) / name
         if not filter_secrets(secret_path):
             continue
-        changed_files.extend(
-            update_keys(
-                secret_path,
-                list(sorted(collect_keys_for_path(secret_path))),
-            )
-        )
-    return changed_files
+        secrets[secret_path] = list(sorted(collect_keys_for_path(secret_path, index)))
+    return update_keys_batch(secrets)
 
 
-def collect_keys_for_type(folder: Path) -> set[str]:
+def collect_keys_for_type(folder: Path, index: KeyIndex | None = None) -> set[str]:
     if not folder.exists():
         return set()
+    if index is None:
+        index = _key_index_for(folder)
     keys = set()
-    for p in folder.iterdir():
-        if not p.is_symlink():
-            continue
-        try:
-            target = p.resolve()
-        except FileNotFoundError:
+    for p, target in index.folder_links(folder):
+        if target is None:
             tty.warn(f"Ignoring broken symlink {p}")
             continue
         kind = target.parent.name
         if folder.name != kind:
             tty.warn(f"Expected {p} to point to {folder} but points to {target.parent}")
             continue
-        keys.add(read_key(target))
+        keys.add(index.key(target))
     return keys
 
 
-def collect_keys_for_path(path: Path) -> set[str]:
+def _key_index_for(path: Path) -> KeyIndex:
+    # path is inside <flake>/sops/
+    for parent in path.absolute().parents:
+        if parent.name == "sops":
+            return KeyIndex.load(parent.parent)
+    return KeyIndex.load(path)
+
+
+def collect_keys_for_path(path: Path, index: KeyIndex | None = None) -> set[str]:
+    """
+    Return the public keys of the users, machines and groups a secret is shared with.
+    The keys are looked up in the KeyIndex of the flake.
+    """
+    if index is None:
+        index = _key_index_for(path)
     keys = set([])
-    keys.update(collect_keys_for_type(path / "machines"))
-    keys.update(collect_keys_for_type(path / "users"))
+    keys.update(collect_keys_for_type(path / "machines", index))
+    keys.update(collect_keys_for_type(path / "users", index))
     groups = path / "groups"
     if not groups.is_dir():
         return keys
     for group in groups.iterdir():
-        keys.update(collect_keys_for_type(group / "machines"))
-        keys.update(collect_keys_for_type(group / "users"))
+        keys.update(collect_keys_for_type(group / "machines", index))
+        keys.update(collect_keys_for_type(group / "users", index))
     return keys
 
 
-def encrypt_secret(
+def _add_secret_members(
     flake_dir: Path,
     secret: Path,
-    value: IO[str] | str | bytes | None,
-    add_users: list[str] = [],
-    add_machines: list[str] = [],
-    add_groups: list[str] = [],
-) -> None:
-    key = ensure_sops_key(flake_dir)
-    keys = set([])
-
+    key: SopsKey,
+    add_users: list[str],
+    add_machines: list[str],
+    add_groups: list[str],
+    index: KeyIndex | None = None,
+) -> tuple[list[str], list[Path]]:
+    """
+    Allow the given users, machines and groups and our own key to read the secret.
+    Returns the keys to encrypt the secret for and the files to commit.
+    """
     files_to_commit = []
     for user in add_users:
         files_to_commit.append(
@@ -114,7 +133,7 @@ def encrypt_secret(
             )
         )
 
-    keys = collect_keys_for_path(secret)
+    keys = collect_keys_for_path(secret, index)
 
     if key.pubkey not in keys:
         keys.add(key.pubkey)
@@ -126,9 +145,24 @@ def encrypt_secret(
                 False,
             )
         )
+    return list(sorted(keys)), files_to_commit
+
+
+def encrypt_secret(
+    flake_dir: Path,
+    secret: Path,
+    value: IO[str] | str | bytes | None,
+    add_users: list[str] = [],
+    add_machines: list[str] = [],
+    add_groups: list[str] = [],
+) -> None:
+    key = ensure_sops_key(flake_dir)
+    keys, files_to_commit = _add_secret_members(
+        flake_dir, secret, key, add_users, add_machines, add_groups
+    )
 
     secret_path = secret / "secret"
-    encrypt_file(secret_path, value, list(sorted(keys)))
+    encrypt_file(secret_path, value, keys)
     files_to_commit.append(secret_path)
     commit_files(
         files_to_commit,
@@ -137,6 +171,89 @@ def encrypt_secret(
     )
 
 
+def _secret_entries(secret: Path) -> set[Path]:
+    if not secret.exists():
+        return set()
+    return {secret, *secret.rglob("*")}
+
+
+def _remove_new_entries(secret: Path, before: set[Path]) -> None:
+    """
+    Undo _add_secret_members() for a secret that could not be encrypted
+    """
+    # children sort after their parents, so they are removed first
+    for path in sorted(_secret_entries(secret) - before, reverse=True):
+        if path.is_dir() and not path.is_symlink():
+            path.rmdir()
+        else:
+            path.unlink()
+
+
+def encrypt_secrets(
+    flake_dir: Path,
+    values: Mapping[str, str | bytes],
+    add_users: list[str] = [],
+    add_machines: list[str] = [],
+    add_groups: list[str] = [],
+    max_workers: int | None = None,
+    commit_message: str | None = None,
+) -> None:
+    """
+    Encrypt many secrets for the same users, machines and groups.
+    The sops key and the recipients are resolved once, the secrets are encrypted
+    in parallel and all of them are added in a single commit.
+    Secrets that fail to encrypt are left out of the commit
+    and their new member links are removed again.
+    """
+    key = ensure_sops_key(flake_dir)
+    index = KeyIndex.load(flake_dir)
+    jobs = {}
+    files_to_commit: dict[str, list[Path]] = {}
+    entries_before: dict[str, set[Path]] = {}
+    try:
+        for name, value in values.items():
+            secret = sops_secrets_folder(flake_dir) / name
+            entries_before[name] = _secret_entries(secret)
+            keys, files = _add_secret_members(
+                flake_dir, secret, key, add_users, add_machines, add_groups, index
+            )
+            jobs[name] = (secret / "secret", value, keys)
+            files_to_commit[name] = [*files, secret / "secret"]
+    except BaseException:
+        for name, before in entries_before.items():
+            _remove_new_entries(sops_secrets_folder(flake_dir) / name, before)
+        raise
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        futures = {
+            executor.submit(encrypt_file, *job): name for name, job in jobs.items()
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            name = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                # i.e. OSError, the other secrets are still committed
+                tty.warn(f"Failed to encrypt {name}: {e}")
+                failed.append(name)
+                _remove_new_entries(
+                    sops_secrets_folder(flake_dir) / name, entries_before[name]
+                )
+                continue
+            tty.info(f"[{done}/{len(jobs)}] encrypted {name}")
+
+    encrypted = [name for name in jobs if name not in failed]
+    if encrypted:
+        commit_files(
+            [path for name in encrypted for path in files_to_commit[name]],
+            flake_dir,
+            commit_message or f"Add {len(encrypted)} secrets",
+        )
+    if failed:
+        raise ClanError(f"Failed to encrypt secrets: {', '.join(sorted(failed))}")
+
+
 def remove_secret(flake_dir: Path, secret: str) -> None:
     path = sops_secrets_folder(flake_dir) / secret
     if not path.exists():
@@ -1,18 +1,30 @@
+import hashlib
 import json
+import logging
 import os
-import shutil
 import subprocess
 from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
 from tempfile import NamedTemporaryFile
 from typing import IO
 
 from ..cmd import Log, run
-from ..dirs import user_config_dir
+from ..dirs import user_config_dir, user_sops_cache_dir
+from ..disk_cache import DiskCache, cache_key
 from ..errors import ClanError
 from ..nix import nix_shell
 from .folders import sops_machines_folder, sops_users_folder
+from .native_sops import (
+    SOPS_OTHER_KEY_TYPES,
+    UnsupportedSopsFileError,
+    decrypt_sops_file,
+    native_sops_enabled,
+    parse_identities,
+)
+
+log = logging.getLogger(__name__)
 
 
 class SopsKey:
@@ -21,7 +33,29 @@ class SopsKey:
         self.username = username
 
 
+# sha256 of a private key -> its public key
+_public_keys: dict[str, str] = {}
+
+
+def _key_digest(privkey: str) -> str:
+    return hashlib.sha256(privkey.encode("utf-8")).hexdigest()
+
+
 def get_public_key(privkey: str) -> str:
+    """
+    Derive the public key of an age private key.
+    The result is cached in memory and on disk, keyed by a hash of the private key.
+    """
+    digest = _key_digest(privkey)
+    if digest in _public_keys:
+        return _public_keys[digest]
+    disk_cache = DiskCache(user_sops_cache_dir())
+    key = cache_key("age-public-key", digest)
+    cached = disk_cache.get(key)
+    if isinstance(cached, str):
+        _public_keys[digest] = cached
+        return cached
+
     cmd = nix_shell(["nixpkgs#age"], ["age-keygen", "-y"])
     try:
         res = subprocess.run(
@@ -31,7 +65,10 @@ def get_public_key(privkey: str) -> str:
         raise ClanError(
             "Failed to get public key for age private key. Is the key malformed?"
         ) from e
-    return res.stdout.strip()
+    pubkey = res.stdout.strip()
+    _public_keys[digest] = pubkey
+    disk_cache.set(key, pubkey)
+    return pubkey
 
 
 def generate_private_key() -> tuple[str, str]:
@@ -94,13 +131,58 @@ def default_sops_key_path() -> Path:
         return user_config_dir() / "sops" / "age" / "keys.txt"
 
 
+# (private key hash, flake, folder mtimes) -> the identity of the key in the flake
+_sops_keys: dict[tuple[str, str, tuple[int, ...]], SopsKey] = {}
+
+
+def _folder_mtime(folder: Path) -> int:
+    try:
+        return folder.stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def _cached_sops_key(flake_dir: Path, privkey: str) -> SopsKey:
+    folders = [sops_users_folder(flake_dir), sops_machines_folder(flake_dir)]
+    # adding or removing a user or machine changes the mtime of its folder
+    mtimes = tuple(_folder_mtime(folder) for folder in folders)
+    memory_key = (_key_digest(privkey), str(flake_dir), mtimes)
+    if memory_key in _sops_keys:
+        return _sops_keys[memory_key]
+
+    disk_cache = DiskCache(user_sops_cache_dir())
+    key = cache_key("sops-identity", *memory_key)
+    cached = disk_cache.get(key)
+    if isinstance(cached, dict):
+        # a key.json might have been replaced without changing the folder mtime
+        folder = sops_users_folder(flake_dir).parent / cached["folder"]
+        try:
+            if read_key(folder / cached["username"]) == cached["pubkey"]:
+                sops_key = SopsKey(cached["pubkey"], cached["username"])
+                _sops_keys[memory_key] = sops_key
+                return sops_key
+        except (OSError, KeyError, ClanError):
+            pass
+
+    sops_key = ensure_user_or_machine(flake_dir, get_public_key(privkey))
+    folder = "users"
+    if not (sops_users_folder(flake_dir) / sops_key.username).exists():
+        folder = "machines"
+    _sops_keys[memory_key] = sops_key
+    disk_cache.set(
+        key,
+        dict(pubkey=sops_key.pubkey, username=sops_key.username, folder=folder),
+    )
+    return sops_key
+
+
 def ensure_sops_key(flake_dir: Path) -> SopsKey:
     key = os.environ.get("SOPS_AGE_KEY")
     if key:
-        return ensure_user_or_machine(flake_dir, get_public_key(key))
+        return _cached_sops_key(flake_dir, key)
     path = default_sops_key_path()
     if path.exists():
-        return ensure_user_or_machine(flake_dir, get_public_key(path.read_text()))
+        return _cached_sops_key(flake_dir, path.read_text())
     else:
         raise ClanError(
             "No sops key found. Please generate one with 'clan secrets key generate'."
@@ -117,9 +199,27 @@ def sops_manifest(keys: list[str]) -> Iterator[Path]:
         yield Path(manifest.name)
 
 
+def sops_recipients(secret_path: Path) -> set[str] | None:
+    """
+    Read the age recipients from the metadata of a sops encrypted file,
+    without decrypting it.
+    Returns None if they cannot be determined, i.e. because other key types are used.
+    """
+    try:
+        with open(secret_path) as f:
+            metadata = json.load(f)["sops"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if any(metadata.get(key) for key in SOPS_OTHER_KEY_TYPES):
+        return None
+    return {entry["recipient"] for entry in metadata.get("age") or []}
+
+
 def update_keys(secret_path: Path, keys: list[str]) -> list[Path]:
+    secret_path = secret_path / "secret"
+    if sops_recipients(secret_path) == set(keys):
+        return []
     with sops_manifest(keys) as manifest:
-        secret_path = secret_path / "secret"
         time_before = secret_path.stat().st_mtime
         cmd = nix_shell(
             ["nixpkgs#sops"],
@@ -138,6 +238,31 @@ def update_keys(secret_path: Path, keys: list[str]) -> list[Path]:
         return [secret_path]
 
 
+def update_keys_batch(
+    secrets: dict[Path, list[str]], max_workers: int | None = None
+) -> list[Path]:
+    """
+    Re-key many secrets at once.
+    Secrets that are already encrypted for exactly the given keys are skipped,
+    the others are updated in parallel.
+    @secrets: maps secret directories to the keys they should be encrypted for
+    """
+    todo = [
+        (path, keys)
+        for path, keys in secrets.items()
+        if sops_recipients(path / "secret") != set(keys)
+    ]
+    if not todo:
+        return []
+    if max_workers is None:
+        max_workers = min(len(todo), os.cpu_count() or 1)
+    changed_files = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for paths in executor.map(lambda item: update_keys(*item), todo):
+            changed_files.extend(paths)
+    return changed_files
+
+
 def encrypt_file(
     secret_path: Path, content: IO[str] | str | bytes | None, keys: list[str]
 ) -> None:
@@ -159,37 +284,54 @@ def encrypt_file(
                 )
             return
 
-        # hopefully /tmp is written to an in-memory file to avoid leaking secrets
-        with NamedTemporaryFile(delete=False) as f:
+        if isinstance(content, str):
+            plaintext = content.encode("utf-8")
+        elif isinstance(content, bytes):
+            plaintext = content
+        elif hasattr(content, "read"):
+            data = content.read()
+            plaintext = data.encode("utf-8") if isinstance(data, str) else data
+        else:
+            raise ClanError("Invalid content type")
+        # the plaintext is streamed through a pipe, so it never touches the disk
+        # we pass an empty manifest to pick up existing configuration of the user
+        args = ["sops", "--config", str(manifest)]
+        args.extend(["--input-type", "binary", "--output-type", "binary"])
+        args.extend(["--encrypt", "/dev/stdin"])
+        cmd = nix_shell(["nixpkgs#sops"], args)
+        res = run(
+            cmd, stdin_data=plaintext, error_msg=f"Failed to encrypt {secret_path}"
+        )
+        # write the encrypted file once and atomically
+        with NamedTemporaryFile(mode="w", dir=folder, delete=False) as f:
             try:
-                if isinstance(content, str):
-                    with open(f.name, "w") as fd:
-                        fd.write(content)
-                elif isinstance(content, bytes):
-                    with open(f.name, "wb") as fd:
-                        fd.write(content)
-                elif isinstance(content, IO):
-                    with open(f.name, "w") as fd:
-                        shutil.copyfileobj(content, fd)
-                else:
-                    raise ClanError("Invalid content type")
-                # we pass an empty manifest to pick up existing configuration of the user
-                args = ["sops", "--config", str(manifest)]
-                args.extend(["-i", "--encrypt", str(f.name)])
-                cmd = nix_shell(["nixpkgs#sops"], args)
-                run(cmd, log=Log.BOTH)
-                # atomic copy of the encrypted file
-                with NamedTemporaryFile(dir=folder, delete=False) as f2:
-                    shutil.copyfile(f.name, f2.name)
-                    os.rename(f2.name, secret_path)
-            finally:
-                try:
-                    os.remove(f.name)
-                except OSError:
-                    pass
+                f.write(res.stdout)
+                f.close()
+                os.rename(f.name, secret_path)
+            except BaseException:
+                os.remove(f.name)
+                raise
+
+
+def age_identities() -> list[str]:
+    """
+    The age identities sops would use, from SOPS_AGE_KEY and the key file.
+    """
+    identities = parse_identities(os.environ.get("SOPS_AGE_KEY", ""))
+    try:
+        identities += parse_identities(default_sops_key_path().read_text())
+    except OSError:
+        pass
+    return identities
 
 
 def decrypt_file(secret_path: Path) -> str:
+    if native_sops_enabled():
+        # decrypt age-only secrets in-process instead of starting sops
+        try:
+            return decrypt_sops_file(secret_path, age_identities())
+        except UnsupportedSopsFileError as e:
+            log.debug(f"falling back to sops for {secret_path}: {e}")
     with sops_manifest([]) as manifest:
         cmd = nix_shell(
             ["nixpkgs#sops"],
@@ -1,16 +1,21 @@
 # Adapted from https://github.com/numtide/deploykit
 
+import atexit
 import fcntl
 import logging
 import math
 import os
 import select
 import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 import urllib.parse
 from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import ExitStack, contextmanager
 from enum import Enum
 from pathlib import Path
@@ -18,6 +23,13 @@ from shlex import quote
 from threading import Thread
 from typing import IO, Any, Generic, TypeVar
 
+from ..output_capture import (
+    MAX_STDERR_BYTES,
+    READ_SIZE,
+    LineBuffer,
+    OutputCapture,
+)
+
 # https://no-color.org
 DISABLE_COLOR = not sys.stderr.isatty() or os.environ.get("NO_COLOR", "") != ""
 
@@ -132,6 +144,50 @@ class HostKeyCheck(Enum):
     NONE = 2
 
 
+# Directory holding the ssh ControlMaster sockets of this process
+_control_dir: Path | None = None
+# (ssh target, control path) -> options needed to address the ControlMaster
+_control_masters: dict[tuple[str, str], list[str]] = {}
+_control_lock = threading.Lock()
+
+
+def _ssh_control_dir() -> Path:
+    global _control_dir
+    with _control_lock:
+        if _control_dir is None:
+            # unix socket paths are limited to 108 bytes, so prefer the short runtime dir
+            runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+            if runtime_dir is None or not os.path.isdir(runtime_dir):
+                runtime_dir = None
+            _control_dir = Path(tempfile.mkdtemp(prefix="clan-ssh-", dir=runtime_dir))
+            atexit.register(close_control_masters)
+        return _control_dir
+
+
+def close_control_masters() -> None:
+    """
+    Stop all ssh ControlMaster connections opened by this process
+    """
+    global _control_dir
+    with _control_lock:
+        masters = list(_control_masters.items())
+        _control_masters.clear()
+        control_dir = _control_dir
+        _control_dir = None
+    for (target, _), opts in masters:
+        try:
+            subprocess.run(
+                ["ssh", *opts, "-O", "exit", target],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=10,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            pass
+    if control_dir is not None:
+        shutil.rmtree(control_dir, ignore_errors=True)
+
+
 class Host:
     def __init__(
         self,
@@ -145,6 +201,8 @@ class Host:
         meta: dict[str, Any] = {},
         verbose_ssh: bool = False,
         ssh_options: dict[str, str] = {},
+        control_master: bool = True,
+        control_persist: str = "60s",
     ) -> None:
         """
         Creates a Host
@@ -155,6 +213,8 @@ class Host:
         @host_key_check: whether to check ssh host keys
         @verbose_ssh: Enables verbose logging on ssh connections
         @meta: meta attributes associated with the host. Those can be accessed in custom functions passed to `run_function`
+        @control_master: share one ssh connection for all commands to this host, it is closed when the process exits
+        @control_persist: how long an idle shared connection is kept open
         """
         self.host = host
         self.user = user
@@ -169,6 +229,41 @@ class Host:
         self.meta = meta
         self.verbose_ssh = verbose_ssh
         self.ssh_options = ssh_options
+        self.control_master = control_master and (
+            os.environ.get("CLAN_SSH_NO_CONTROL_MASTER", "") == ""
+        )
+        self.control_persist = control_persist
+
+    @property
+    def ssh_target(self) -> str:
+        if self.user is not None:
+            return f"{self.user}@{self.host}"
+        return self.host
+
+    def control_opts(self) -> list[str]:
+        """
+        ssh options to share a ControlMaster connection to this host.
+        Can also be passed to other tools that use ssh, i.e. rsync or NIX_SSHOPTS.
+        """
+        if not self.control_master:
+            return []
+        # agent forwarding is a property of the master connection
+        suffix = "-A" if self.forward_agent else ""
+        control_path = f"{_ssh_control_dir()}/%C{suffix}"
+        with _control_lock:
+            _control_masters[(self.ssh_target, control_path)] = [
+                "-o",
+                f"ControlPath={control_path}",
+                *(["-p", str(self.port)] if self.port else []),
+            ]
+        return [
+            "-o",
+            "ControlMaster=auto",
+            "-o",
+            f"ControlPath={control_path}",
+            "-o",
+            f"ControlPersist={self.control_persist}",
+        ]
 
     def _prefix_output(
         self,
@@ -190,10 +285,10 @@ class Host:
         if stderr is not None:
             rlist.append(stderr)
 
-        print_std_buf = ""
-        print_err_buf = ""
-        stdout_buf = ""
-        stderr_buf = ""
+        print_std_buf = LineBuffer()
+        print_err_buf = LineBuffer()
+        stdout_buf = OutputCapture()
+        stderr_buf = OutputCapture(max_bytes=MAX_STDERR_BYTES)
 
         start = time.time()
         last_output = time.time()
@@ -201,38 +296,27 @@ class Host:
             r, _, _ = select.select(rlist, [], [], min(timeout, NO_OUTPUT_TIMEOUT))
 
             def print_from(
-                print_fd: IO[str], print_buf: str, is_err: bool = False
-            ) -> tuple[float, str]:
-                read = os.read(print_fd.fileno(), 4096)
+                print_fd: IO[str], print_buf: LineBuffer, is_err: bool = False
+            ) -> float:
+                read = os.read(print_fd.fileno(), READ_SIZE)
                 if len(read) == 0:
                     rlist.remove(print_fd)
-                print_buf += read.decode("utf-8")
-                if (read == b"" and len(print_buf) != 0) or "\n" in print_buf:
-                    # print and empty the print_buf, if the stream is draining,
-                    # but there is still something in the buffer or on newline.
-                    lines = print_buf.rstrip("\n").split("\n")
-                    for line in lines:
-                        if not is_err:
-                            cmdlog.info(
-                                line, extra=dict(command_prefix=self.command_prefix)
-                            )
-                            pass
-                        else:
-                            cmdlog.error(
-                                line, extra=dict(command_prefix=self.command_prefix)
-                            )
-                    print_buf = ""
-                last_output = time.time()
-                return (last_output, print_buf)
+                    # print what is left in the buffer if the stream is draining
+                    lines = print_buf.flush()
+                else:
+                    lines = print_buf.feed(read)
+                log = cmdlog.error if is_err else cmdlog.info
+                for line in lines:
+                    log(
+                        line.decode("utf-8", errors="replace"),
+                        extra=dict(command_prefix=self.command_prefix),
+                    )
+                return time.time()
 
             if print_std_fd in r and print_std_fd is not None:
-                (last_output, print_std_buf) = print_from(
-                    print_std_fd, print_std_buf, is_err=False
-                )
+                last_output = print_from(print_std_fd, print_std_buf, is_err=False)
             if print_err_fd in r and print_err_fd is not None:
-                (last_output, print_err_buf) = print_from(
-                    print_err_fd, print_err_buf, is_err=True
-                )
+                last_output = print_from(print_err_fd, print_err_buf, is_err=True)
 
             now = time.time()
             elapsed = now - start
@@ -243,21 +327,20 @@ class Host:
                     extra=dict(command_prefix=self.command_prefix),
                 )
 
-            def handle_fd(fd: IO[Any] | None) -> str:
+            def handle_fd(fd: IO[Any] | None, buf: OutputCapture) -> None:
                 if fd and fd in r:
-                    read = os.read(fd.fileno(), 4096)
+                    read = os.read(fd.fileno(), READ_SIZE)
                     if len(read) == 0:
                         rlist.remove(fd)
                     else:
-                        return read.decode("utf-8")
-                return ""
+                        buf.write(read)
 
-            stdout_buf += handle_fd(stdout)
-            stderr_buf += handle_fd(stderr)
+            handle_fd(stdout, stdout_buf)
+            handle_fd(stderr, stderr_buf)
 
             if now - last_output >= timeout:
                 break
-        return stdout_buf, stderr_buf
+        return stdout_buf.decode(), stderr_buf.decode()
 
     def _run(
         self,
@@ -416,6 +499,40 @@ class Host:
 
         @return subprocess.CompletedProcess result of the ssh command
         """
+        ssh_cmd, displayed_cmd = self.remote_cmd(
+            cmd,
+            become_root=become_root,
+            extra_env=extra_env,
+            verbose_ssh=verbose_ssh,
+            tty=tty,
+        )
+        cmdlog.info(
+            f"$ {displayed_cmd}", extra=dict(command_prefix=self.command_prefix)
+        )
+        return self._run(
+            ssh_cmd,
+            displayed_cmd,
+            shell=False,
+            stdout=stdout,
+            stderr=stderr,
+            cwd=cwd,
+            check=check,
+            timeout=timeout,
+        )
+
+    def remote_cmd(
+        self,
+        cmd: str | list[str],
+        become_root: bool = False,
+        extra_env: dict[str, str] = {},
+        verbose_ssh: bool = False,
+        tty: bool = False,
+    ) -> tuple[list[str], str]:
+        """
+        Build the ssh command line to run cmd on the host
+
+        @return the ssh command and the command to display to the user
+        """
         sudo = ""
         if become_root and self.user != "root":
             sudo = "sudo -- "
@@ -432,9 +549,6 @@ class Host:
             displayed_cmd += " ".join(cmd)
         else:
             displayed_cmd += cmd
-        cmdlog.info(
-            f"$ {displayed_cmd}", extra=dict(command_prefix=self.command_prefix)
-        )
 
         bash_cmd = export_cmd
         bash_args = []
@@ -449,31 +563,19 @@ class Host:
             "--",
             f"{sudo}bash -c {quote(bash_cmd)} -- {' '.join(map(quote, bash_args))}",
         ]
-        return self._run(
-            ssh_cmd,
-            displayed_cmd,
-            shell=False,
-            stdout=stdout,
-            stderr=stderr,
-            cwd=cwd,
-            check=check,
-            timeout=timeout,
-        )
+        return ssh_cmd, displayed_cmd
 
     def ssh_cmd(
         self,
         verbose_ssh: bool = False,
         tty: bool = False,
     ) -> list[str]:
-        if self.user is not None:
-            ssh_target = f"{self.user}@{self.host}"
-        else:
-            ssh_target = self.host
-
         ssh_opts = ["-A"] if self.forward_agent else []
 
         for k, v in self.ssh_options.items():
             ssh_opts.extend(["-o", f"{k}={shlex.quote(v)}"])
+        # ssh uses the first value of an option, so the user's options take precedence
+        ssh_opts.extend(self.control_opts())
 
         if self.port:
             ssh_opts.extend(["-p", str(self.port)])
@@ -489,7 +591,7 @@ class Host:
         if tty:
             ssh_opts.extend(["-t"])
 
-        return ["ssh", ssh_target, *ssh_opts]
+        return ["ssh", self.ssh_target, *ssh_opts]
 
 
 T = TypeVar("T")
@@ -535,6 +637,23 @@ def _worker(
         results[idx] = HostResult(host, e)
 
 
+def reraise_errors(results: list[HostResult[Any]]) -> None:
+    """
+    Log the errors of all hosts and raise if there were any
+    """
+    errors = 0
+    for result in results:
+        e = result.error
+        if e:
+            cmdlog.error(
+                f"failed with: {e}",
+                extra=dict(command_prefix=result.host.command_prefix),
+            )
+            errors += 1
+    if errors > 0:
+        raise Exception(f"{errors} hosts failed with an error. Check the logs above")
+
+
 class HostGroup:
     def __init__(self, hosts: list[Host]) -> None:
         self.hosts = hosts
@@ -600,19 +719,7 @@ class HostGroup:
             results.append(HostResult(host, e))
 
     def _reraise_errors(self, results: list[HostResult[Any]]) -> None:
-        errors = 0
-        for result in results:
-            e = result.error
-            if e:
-                cmdlog.error(
-                    f"failed with: {e}",
-                    extra=dict(command_prefix=result.host.command_prefix),
-                )
-                errors += 1
-        if errors > 0:
-            raise Exception(
-                f"{errors} hosts failed with an error. Check the logs above"
-            )
+        reraise_errors(results)
 
     def _run(
         self,
@@ -725,30 +832,28 @@ class HostGroup:
         )
 
     def run_function(
-        self, func: Callable[[Host], T], check: bool = True
+        self,
+        func: Callable[[Host], T],
+        check: bool = True,
+        max_workers: int | None = None,
     ) -> list[HostResult[T]]:
         """
         Function to run for each host in the group in parallel
 
         @func the function to call
+        @max_workers the maximum number of hosts func runs for at the same time, defaults to all hosts
         """
-        threads = []
         results: list[HostResult[T]] = [
             HostResult(h, Exception(f"No result set for thread {i}"))
             for (i, h) in enumerate(self.hosts)
         ]
-        for i, host in enumerate(self.hosts):
-            thread = Thread(
-                target=_worker,
-                args=(func, host, results, i),
-            )
-            threads.append(thread)
-
-        for thread in threads:
-            thread.start()
-
-        for thread in threads:
-            thread.join()
+        if max_workers is None:
+            max_workers = len(self.hosts)
+        with ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(self.hosts)))
+        ) as executor:
+            for i, host in enumerate(self.hosts):
+                executor.submit(_worker, func, host, results, i)
         if check:
             self._reraise_errors(results)
         return results
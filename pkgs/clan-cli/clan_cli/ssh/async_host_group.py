@@ -0,0 +1,389 @@
+import asyncio
+import math
+import os
+import signal
+import subprocess
+import time
+from collections.abc import Awaitable, Callable
+from pathlib import Path
+from typing import TypeVar
+
+from ..output_capture import (
+    MAX_STDERR_BYTES,
+    READ_SIZE,
+    LineBuffer,
+    OutputCapture,
+)
+from . import (
+    FILE,
+    NO_OUTPUT_TIMEOUT,
+    Host,
+    HostResult,
+    Results,
+    cmdlog,
+    kitlog,
+    reraise_errors,
+)
+
+T = TypeVar("T")
+
+
+async def _read_lines(
+    host: Host,
+    stream: asyncio.StreamReader,
+    capture: OutputCapture | None,
+    is_err: bool,
+    last_output: list[float],
+) -> None:
+    """
+    Read a stream until EOF. Lines are either collected into capture
+    or logged with the host prefix.
+    """
+    lines_buf = LineBuffer()
+    while True:
+        chunk = await stream.read(READ_SIZE)
+        if chunk:
+            last_output[0] = time.time()
+        if capture is not None:
+            if not chunk:
+                return
+            capture.write(chunk)
+            continue
+        # print what is left in the buffer once the stream is draining
+        lines = lines_buf.feed(chunk) if chunk else lines_buf.flush()
+        log = cmdlog.error if is_err else cmdlog.info
+        for line in lines:
+            log(
+                line.decode("utf-8", "replace"),
+                extra=dict(command_prefix=host.command_prefix),
+            )
+        if not chunk:
+            return
+
+
+async def _watchdog(host: Host, displayed_cmd: str, last_output: list[float]) -> None:
+    start = time.time()
+    while True:
+        await asyncio.sleep(NO_OUTPUT_TIMEOUT)
+        now = time.time()
+        if now - last_output[0] >= NO_OUTPUT_TIMEOUT:
+            elapsed_msg = time.strftime("%H:%M:%S", time.gmtime(now - start))
+            cmdlog.warning(
+                f"still waiting for '{displayed_cmd}' to finish... "
+                f"({elapsed_msg} elapsed)",
+                extra=dict(command_prefix=host.command_prefix),
+            )
+
+
+def _kill_process_group(pid: int) -> None:
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+async def run_process(
+    host: Host,
+    cmd: list[str],
+    displayed_cmd: str,
+    shell: bool = False,
+    stdout: FILE = None,
+    stderr: FILE = None,
+    extra_env: dict[str, str] = {},
+    cwd: None | str | Path = None,
+    check: bool = True,
+    timeout: float = math.inf,
+) -> subprocess.CompletedProcess[str]:
+    """
+    asyncio counterpart of Host._run: stream the output of cmd line by line
+    with the host prefix, or capture it if stdout/stderr is subprocess.PIPE.
+    """
+    for fd in (stdout, stderr):
+        if fd not in (None, subprocess.PIPE):
+            raise Exception(f"unsupported value for stdout/stderr parameter: {fd}")
+    env = os.environ.copy()
+    env.update(extra_env)
+
+    # a session of its own, so a timeout can kill the children of a shell as well
+    if shell:
+        proc = await asyncio.create_subprocess_shell(
+            cmd[0],
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            cwd=cwd,
+            start_new_session=True,
+        )
+    else:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env,
+            cwd=cwd,
+            start_new_session=True,
+        )
+    assert proc.stdout is not None
+    assert proc.stderr is not None
+
+    stdout_buf = None
+    if stdout == subprocess.PIPE:
+        stdout_buf = OutputCapture()
+    stderr_buf = None
+    if stderr == subprocess.PIPE:
+        stderr_buf = OutputCapture(max_bytes=MAX_STDERR_BYTES)
+    last_output = [time.time()]
+    watchdog = asyncio.create_task(_watchdog(host, displayed_cmd, last_output))
+    try:
+        await asyncio.wait_for(
+            asyncio.gather(
+                _read_lines(host, proc.stdout, stdout_buf, False, last_output),
+                _read_lines(host, proc.stderr, stderr_buf, True, last_output),
+                proc.wait(),
+            ),
+            timeout=None if timeout == math.inf else timeout,
+        )
+    except (TimeoutError, asyncio.CancelledError) as e:
+        if proc.returncode is None:
+            _kill_process_group(proc.pid)
+            await proc.wait()
+        if isinstance(e, TimeoutError):
+            raise subprocess.TimeoutExpired(cmd, timeout) from e
+        raise
+    finally:
+        watchdog.cancel()
+
+    ret = proc.returncode
+    assert ret is not None
+    stdout_data = stdout_buf.decode() if stdout_buf is not None else ""
+    stderr_data = stderr_buf.decode() if stderr_buf is not None else ""
+    if ret != 0:
+        if check:
+            raise subprocess.CalledProcessError(
+                ret, cmd=cmd, output=stdout_data, stderr=stderr_data
+            )
+        cmdlog.warning(
+            f"[Command failed: {ret}] {displayed_cmd}",
+            extra=dict(command_prefix=host.command_prefix),
+        )
+    return subprocess.CompletedProcess(cmd, ret, stdout=stdout_data, stderr=stderr_data)
+
+
+async def run_remote(
+    host: Host,
+    cmd: str | list[str],
+    stdout: FILE = None,
+    stderr: FILE = None,
+    become_root: bool = False,
+    extra_env: dict[str, str] = {},
+    cwd: None | str | Path = None,
+    check: bool = True,
+    timeout: float = math.inf,
+    verbose_ssh: bool = False,
+    tty: bool = False,
+) -> subprocess.CompletedProcess[str]:
+    """
+    asyncio counterpart of Host.run: run cmd on the host via ssh
+    """
+    ssh_cmd, displayed_cmd = host.remote_cmd(
+        cmd,
+        become_root=become_root,
+        extra_env=extra_env,
+        verbose_ssh=verbose_ssh,
+        tty=tty,
+    )
+    cmdlog.info(f"$ {displayed_cmd}", extra=dict(command_prefix=host.command_prefix))
+    return await run_process(
+        host,
+        ssh_cmd,
+        displayed_cmd,
+        stdout=stdout,
+        stderr=stderr,
+        cwd=cwd,
+        check=check,
+        timeout=timeout,
+    )
+
+
+async def run_local(
+    host: Host,
+    cmd: str | list[str],
+    stdout: FILE = None,
+    stderr: FILE = None,
+    extra_env: dict[str, str] = {},
+    cwd: None | str | Path = None,
+    check: bool = True,
+    timeout: float = math.inf,
+) -> subprocess.CompletedProcess[str]:
+    """
+    asyncio counterpart of Host.run_local
+    """
+    shell = isinstance(cmd, str)
+    argv = [cmd] if isinstance(cmd, str) else cmd
+    displayed_cmd = " ".join(argv)
+    cmdlog.info(f"$ {displayed_cmd}", extra=dict(command_prefix=host.command_prefix))
+    return await run_process(
+        host,
+        argv,
+        displayed_cmd,
+        shell=shell,
+        stdout=stdout,
+        stderr=stderr,
+        extra_env=extra_env,
+        cwd=cwd,
+        check=check,
+        timeout=timeout,
+    )
+
+
+async def gather_hosts(
+    hosts: list[Host],
+    func: Callable[[Host], Awaitable[T]],
+    max_concurrency: int,
+) -> list[HostResult[T]]:
+    """
+    Await func for all hosts from the current event loop,
+    at most max_concurrency at a time. The results are in the order of hosts.
+    """
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def worker(host: Host) -> HostResult[T]:
+        async with semaphore:
+            try:
+                return HostResult(host, await func(host))
+            except Exception as e:
+                kitlog.exception(e)
+                return HostResult(host, e)
+
+    return list(await asyncio.gather(*(worker(host) for host in hosts)))
+
+
+class AsyncHostGroup:
+    """
+    Opt-in asyncio counterpart of HostGroup.
+    The commands of all hosts are driven from the current event loop
+    with asyncio subprocesses instead of one thread per host,
+    at most max_concurrency at a time.
+    A timeout or cancellation kills the whole process group of a command.
+    """
+
+    def __init__(self, hosts: list[Host], max_concurrency: int = 64) -> None:
+        self.hosts = hosts
+        self.max_concurrency = max_concurrency
+
+    async def _run(
+        self,
+        cmd: str | list[str],
+        local: bool = False,
+        stdout: FILE = None,
+        stderr: FILE = None,
+        extra_env: dict[str, str] = {},
+        cwd: None | str | Path = None,
+        check: bool = True,
+        timeout: float = math.inf,
+        verbose_ssh: bool = False,
+        tty: bool = False,
+    ) -> Results:
+        async def run(host: Host) -> subprocess.CompletedProcess[str]:
+            if local:
+                return await run_local(
+                    host,
+                    cmd,
+                    stdout=stdout,
+                    stderr=stderr,
+                    extra_env=extra_env,
+                    cwd=cwd,
+                    check=check,
+                    timeout=timeout,
+                )
+            return await run_remote(
+                host,
+                cmd,
+                stdout=stdout,
+                stderr=stderr,
+                extra_env=extra_env,
+                cwd=cwd,
+                check=check,
+                timeout=timeout,
+                verbose_ssh=verbose_ssh,
+                tty=tty,
+            )
+
+        results = await gather_hosts(self.hosts, run, self.max_concurrency)
+        if check:
+            reraise_errors(results)
+        return results
+
+    async def run(
+        self,
+        cmd: str | list[str],
+        stdout: FILE = None,
+        stderr: FILE = None,
+        extra_env: dict[str, str] = {},
+        cwd: None | str | Path = None,
+        check: bool = True,
+        verbose_ssh: bool = False,
+        timeout: float = math.inf,
+        tty: bool = False,
+    ) -> Results:
+        """
+        Coroutine to run cmd on all hosts via ssh, see HostGroup.run
+        """
+        return await self._run(
+            cmd,
+            stdout=stdout,
+            stderr=stderr,
+            extra_env=extra_env,
+            cwd=cwd,
+            check=check,
+            verbose_ssh=verbose_ssh,
+            timeout=timeout,
+            tty=tty,
+        )
+
+    async def run_local(
+        self,
+        cmd: str | list[str],
+        stdout: FILE = None,
+        stderr: FILE = None,
+        extra_env: dict[str, str] = {},
+        cwd: None | str | Path = None,
+        check: bool = True,
+        timeout: float = math.inf,
+    ) -> Results:
+        """
+        Coroutine to run cmd locally for each host, see HostGroup.run_local
+        """
+        return await self._run(
+            cmd,
+            local=True,
+            stdout=stdout,
+            stderr=stderr,
+            extra_env=extra_env,
+            cwd=cwd,
+            check=check,
+            timeout=timeout,
+        )
+
+    async def run_function(
+        self,
+        func: Callable[[Host], Awaitable[T]],
+        check: bool = True,
+        max_concurrency: int | None = None,
+    ) -> list[HostResult[T]]:
+        """
+        Coroutine to await func for each host in the group concurrently
+
+        @func the coroutine function to call
+        @max_concurrency the maximum number of hosts func runs for at the same time, defaults to max_concurrency of the group
+        """
+        results = await gather_hosts(
+            self.hosts, func, max_concurrency or self.max_concurrency
+        )
+        if check:
+            reraise_errors(results)
+        return results
+
+    def filter(self, pred: Callable[[Host], bool]) -> "AsyncHostGroup":
+        """Return a new Group with the results filtered by the predicate"""
+        return AsyncHostGroup(list(filter(pred, self.hosts)), self.max_concurrency)
@@ -0,0 +1,286 @@
+"""
+Tracing of where clan spends its time.
+
+Code marks phases with `span()`, spans nest and carry attributes like the machine.
+At exit the spans are written to the file in CLAN_TRACE (or `clan --trace FILE`):
+as Chrome trace JSON (open it in https://ui.perfetto.dev or chrome://tracing),
+or as OpenTelemetry OTLP/JSON if the file name ends with .otlp.json.
+With PERF=1 a summary of the time per command and phase is printed.
+"""
+
+import asyncio
+import functools
+import itertools
+import json
+import os
+import re
+import shlex
+import tempfile
+import threading
+import time
+import weakref
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import timedelta
+from pathlib import Path
+from typing import Any, TypeVar
+
+T = TypeVar("T")
+
+
+@dataclass
+class Span:
+    name: str
+    category: str
+    span_id: int
+    parent_id: int | None
+    thread_id: int
+    start_ns: int
+    end_ns: int | None = None
+    attributes: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def duration_ns(self) -> int:
+        return (self.end_ns or time.perf_counter_ns()) - self.start_ns
+
+
+_current_span: ContextVar[Span | None] = ContextVar("clan_current_span", default=None)
+
+_STORE_PATH = re.compile(r"/nix/store/[0-9a-z]{32}-")
+
+
+def normalize_command(cmd: list[str]) -> str:
+    """
+    Return a key for cmd that is the same for every run of the same command,
+    so their times add up: temporary paths and nix store hashes are replaced,
+    and the nix_shell wrapper is stripped.
+    """
+    if cmd[:2] == ["sh", "-c"] and len(cmd) > 3 and cmd[2].startswith('PATH="$0'):
+        cmd = cmd[4:]
+    elif cmd[:1] == ["nix"] and "shell" in cmd and "-c" in cmd:
+        cmd = cmd[cmd.index("-c") + 1 :]
+    tmpdir = re.escape(tempfile.gettempdir())
+    key = shlex.join(cmd)
+    key = re.sub(rf"{tmpdir}/[^/\s'\"]+", "$TMPDIR/...", key)
+    return _STORE_PATH.sub("/nix/store/...-", key)
+
+
+def _track_id() -> int:
+    """
+    The thread, or the asyncio task, a span runs in.
+    Tasks of one event loop run concurrently in the same thread,
+    each of them gets its own track in the trace.
+    """
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        # no running event loop
+        task = None
+    if task is not None:
+        return id(task)
+    return threading.get_ident()
+
+
+class Tracer:
+    """
+    Collects the finished spans of all threads.
+    """
+
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+        self.output: Path | None = None
+        if trace_file := os.environ.get("CLAN_TRACE"):
+            self.output = Path(trace_file)
+        self.trace_id = os.urandom(16).hex()
+        # converts perf_counter_ns() timestamps to unix time
+        self.epoch_offset_ns = time.time_ns() - time.perf_counter_ns()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        weakref.finalize(self, self.on_exit)
+
+    def start(self, name: str, category: str, attributes: dict[str, Any]) -> Span:
+        parent = _current_span.get()
+        if parent is not None and "machine" in parent.attributes:
+            attributes.setdefault("machine", parent.attributes["machine"])
+        with self._lock:
+            span_id = next(self._ids)
+        return Span(
+            name=name,
+            category=category,
+            span_id=span_id,
+            parent_id=parent.span_id if parent else None,
+            thread_id=_track_id(),
+            start_ns=time.perf_counter_ns(),
+            attributes=attributes,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        """
+        Spans are only kept if they are written or summarized at exit,
+        long running processes would collect them forever otherwise.
+        """
+        return self.output is not None or os.getenv("PERF") == "1"
+
+    def finish(self, span: Span) -> None:
+        span.end_ns = time.perf_counter_ns()
+        if not self.enabled:
+            return
+        with self._lock:
+            self.spans.append(span)
+
+    def chrome_trace(self) -> dict[str, Any]:
+        pid = os.getpid()
+        events: list[dict[str, Any]] = []
+        thread_names: dict[int, str] = {}
+        for span in sorted(self.spans, key=lambda s: s.start_ns):
+            # name each thread after the machine it worked on first
+            if span.thread_id not in thread_names and "machine" in span.attributes:
+                thread_names[span.thread_id] = str(span.attributes["machine"])
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": (span.start_ns + self.epoch_offset_ns) / 1000,
+                    "dur": span.duration_ns / 1000,
+                    "pid": pid,
+                    "tid": span.thread_id,
+                    "args": span.attributes,
+                }
+            )
+        for tid, name in thread_names.items():
+            events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def otlp_trace(self) -> dict[str, Any]:
+        def value(v: Any) -> dict[str, Any]:
+            if isinstance(v, bool):
+                return {"boolValue": v}
+            if isinstance(v, int):
+                return {"intValue": str(v)}
+            if isinstance(v, float):
+                return {"doubleValue": v}
+            return {"stringValue": str(v)}
+
+        spans = []
+        for span in self.spans:
+            otlp_span: dict[str, Any] = {
+                "traceId": self.trace_id,
+                "spanId": f"{span.span_id:016x}",
+                "name": span.name,
+                "kind": 1,
+                "startTimeUnixNano": str(span.start_ns + self.epoch_offset_ns),
+                "endTimeUnixNano": str(
+                    span.start_ns + span.duration_ns + self.epoch_offset_ns
+                ),
+                "attributes": [
+                    {"key": k, "value": value(v)}
+                    for k, v in {"category": span.category, **span.attributes}.items()
+                ],
+            }
+            if span.parent_id is not None:
+                otlp_span["parentSpanId"] = f"{span.parent_id:016x}"
+            spans.append(otlp_span)
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {"key": "service.name", "value": value("clan-cli")}
+                        ]
+                    },
+                    "scopeSpans": [{"scope": {"name": "clan_cli"}, "spans": spans}],
+                }
+            ]
+        }
+
+    def write(self, path: Path) -> None:
+        if path.name.endswith(".otlp.json"):
+            data = self.otlp_trace()
+        else:
+            data = self.chrome_trace()
+        with open(path, "w") as f:
+            json.dump(data, f, default=str)
+
+    def summary(self) -> dict[str, timedelta]:
+        """
+        Return the total time per command and per phase.
+        """
+        table: dict[str, timedelta] = {}
+        for span in self.spans:
+            key = span.name if span.category == "cmd" else f"[{span.name}]"
+            duration = timedelta(microseconds=span.duration_ns / 1000)
+            table[key] = table.get(key, timedelta()) + duration
+        return table
+
+    def print_summary(self) -> None:
+        print("======== CMD TIMETABLE ========")
+        # Sort the table by time in descending order
+        sorted_table = sorted(
+            self.summary().items(), key=lambda item: item[1], reverse=True
+        )
+        for k, v in sorted_table:
+            # Check if timedelta is greater than 1 second
+            if v.total_seconds() > 1:
+                # Print in red
+                print(f"\033[91mTook {v}s\033[0m for command: '{k}'")
+            else:
+                # Print in default color
+                print(f"Took {v} for command: '{k}'")
+
+    def on_exit(self) -> None:
+        if os.getenv("PERF") == "1":
+            self.print_summary()
+        if self.output is not None:
+            self.write(self.output)
+
+
+TRACER = Tracer()
+
+
+@contextmanager
+def span(name: str, category: str = "phase", **attributes: Any) -> Iterator[Span]:
+    """
+    Trace the time spent in the with block.
+    Spans opened inside the block in the same thread become its children
+    and inherit its machine attribute.
+    """
+    s = TRACER.start(name, category, attributes)
+    token = _current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        TRACER.finish(s)
+
+
+def propagate(func: Callable[..., T]) -> Callable[..., T]:
+    """
+    Make spans opened by func children of the current span,
+    even if func is run in another thread, i.e. by a ThreadPoolExecutor.
+    """
+    parent = _current_span.get()
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        token = _current_span.set(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+
+    return wrapper
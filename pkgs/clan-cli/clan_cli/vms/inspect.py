@@ -1,5 +1,4 @@
 import argparse
-import json
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -21,8 +20,8 @@ class VmConfig:
 
 
 def inspect_vm(machine: Machine) -> VmConfig:
-    data = json.loads(machine.eval_nix("config.clanCore.vm.inspect"))
-    return VmConfig(flake_url=str(machine.flake), **data)
+    data = machine.eval_many(["config.clanCore.vm.inspect"])
+    return VmConfig(flake_url=str(machine.flake), **data["config.clanCore.vm.inspect"])
 
 
 @dataclass
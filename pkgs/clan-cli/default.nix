@@ -3,6 +3,7 @@
   age,
   lib,
   argcomplete,
+  cryptography,
   installShellFiles,
   nix,
   openssh,
@@ -34,6 +35,7 @@ let
   # Dependencies that are directly used in the project
   pythonDependencies = [
     argcomplete # Enables shell completion; without it, this feature won't work.
+    cryptography # Decrypts age-only sops secrets in-process; without it, sops is spawned for every secret.
   ];
 
   # Runtime dependencies required by the application
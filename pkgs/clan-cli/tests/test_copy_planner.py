@@ -0,0 +1,191 @@
+import json
+import re
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from clan_cli.errors import ClanError, CmdOut
+from clan_cli.machines import copy_planner, update
+from clan_cli.machines.copy_planner import CopyPlanner, nix_ssh_opts
+from clan_cli.machines.update import (
+    SourceUploader,
+    archive_paths,
+    build_toplevels,
+    deploy_fleet,
+)
+from clan_cli.ssh import Host, HostGroup, HostKeyCheck
+
+
+def test_closure() -> None:
+    planner = CopyPlanner(["/nix/store/a", "/nix/store/b"])
+    planner._references = {
+        "/nix/store/a": ["/nix/store/a", "/nix/store/lib"],
+        "/nix/store/b": ["/nix/store/lib", "/nix/store/c"],
+        "/nix/store/c": [],
+        "/nix/store/lib": [],
+    }
+    assert planner.closure(["/nix/store/a"]) == ["/nix/store/a", "/nix/store/lib"]
+    assert planner.closure(["/nix/store/b"]) == [
+        "/nix/store/b",
+        "/nix/store/c",
+        "/nix/store/lib",
+    ]
+
+
+def test_copy_missing_paths(monkeypatch: pytest.MonkeyPatch) -> None:
+    paths = [f"/nix/store/{i:032}-p" for i in range(2500)]
+    store = set(paths[:100])
+    host_stdin: list[bytes] = []
+
+    def check_validity(cmd: list[str], **kwargs: Any) -> CmdOut:
+        host_stdin.append(kwargs["stdin_data"])
+        checked = kwargs["stdin_data"].decode().split("\n")
+        invalid = [path for path in checked if path not in store]
+        return CmdOut("\n".join(invalid), "", Path.cwd(), "ssh", 0, None)
+
+    monkeypatch.setattr(copy_planner, "run", check_validity)
+    copies: list[list[str]] = []
+
+    def run_local(cmd: list[str], **kwargs: Any) -> CmdOut:
+        copies.append([arg for arg in cmd if arg.startswith("/nix/store/")])
+        return CmdOut("", "", Path.cwd(), "nix copy", 0, None)
+
+    host = Host("foo", control_master=False)
+    monkeypatch.setattr(host, "run_local", run_local)
+    planner = CopyPlanner(paths)
+    planner._references = {path: [] for path in paths}
+    planner.copy(host)
+    # the paths to check are passed over stdin, not as arguments
+    assert host_stdin == ["\n".join(paths).encode()]
+    # the missing paths are copied in chunks
+    assert [len(c) for c in copies] == [1000, 1000, 400]
+    assert [path for c in copies for path in c] == paths[100:]
+
+
+def test_archive_paths() -> None:
+    archive = {
+        "path": "/nix/store/flake",
+        "inputs": {
+            "nixpkgs": {"path": "/nix/store/nixpkgs", "inputs": {}},
+            "clan-core": {
+                "path": "/nix/store/clan-core",
+                "inputs": {"nixpkgs": {"path": "/nix/store/nixpkgs2"}},
+            },
+        },
+    }
+    assert archive_paths(archive) == [
+        "/nix/store/flake",
+        "/nix/store/nixpkgs",
+        "/nix/store/clan-core",
+        "/nix/store/nixpkgs2",
+    ]
+
+
+def test_source_uploader_fetches_inputs(monkeypatch: pytest.MonkeyPatch) -> None:
+    archive = {
+        "path": "/nix/store/flake",
+        "inputs": {"nixpkgs": {"path": "/nix/store/nixpkgs", "inputs": {}}},
+    }
+    # nixpkgs was never needed by an evaluation, so it is not in the store yet
+    store = {"/nix/store/flake"}
+
+    def nix(cmd: list[str], **kwargs: Any) -> CmdOut:
+        if "archive" in cmd:
+            if "--dry-run" not in cmd:
+                store.update(archive_paths(archive))
+            return CmdOut(json.dumps(archive), "", Path.cwd(), "nix", 0, None)
+        paths = [arg for arg in cmd if arg.startswith("/nix/store/")]
+        missing = [path for path in paths if path not in store]
+        if missing:
+            raise ClanError(f"path '{missing[0]}' is not valid")
+        info: dict[str, dict[str, list[str]]] = {p: {"references": []} for p in paths}
+        return CmdOut(json.dumps(info), "", Path.cwd(), "nix", 0, None)
+
+    monkeypatch.setattr(update, "run", nix)
+    monkeypatch.setattr(copy_planner, "run", nix)
+    uploader = SourceUploader("path:/flake", always_upload_source=True)
+    url, planner = uploader._compute_plan()
+    assert url == "/nix/store/flake"
+    assert planner is not None
+    assert planner.closure(planner.roots) == ["/nix/store/flake", "/nix/store/nixpkgs"]
+
+
+def test_nix_ssh_opts() -> None:
+    host = Host(
+        "foo",
+        port=2222,
+        key="/key",
+        host_key_check=HostKeyCheck.NONE,
+        control_master=False,
+    )
+    assert (
+        nix_ssh_opts(host)
+        == "-p 2222 -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i /key"
+    )
+
+
+class FakeMachine:
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+
+def fake_nix_build(cmd: list[str], **kwargs: Any) -> CmdOut:
+    """
+    Builds every machine except "broken", like nix build --print-out-paths
+    """
+    machines = re.findall(r'"(\w+)"\.config\.system\.build\.toplevel', " ".join(cmd))
+    if "broken" in machines:
+        return CmdOut("", "error: broken", Path.cwd(), "nix build", 1, None)
+    stdout = "".join(f"/nix/store/{'0' * 32}-{name}\n" for name in machines)
+    return CmdOut(stdout, "", Path.cwd(), "nix build", 0, None)
+
+
+def test_build_toplevels(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(update, "nix_config", lambda: {"system": "x86_64-linux"})
+    monkeypatch.setattr(update, "run", fake_nix_build)
+    machines: list[Any] = [FakeMachine("a"), FakeMachine("b")]
+    toplevels, failures = build_toplevels(machines, tmp_path, tmp_path / "result")
+    assert toplevels == {
+        "a": Path(f"/nix/store/{'0' * 32}-a"),
+        "b": Path(f"/nix/store/{'0' * 32}-b"),
+    }
+    assert failures == {}
+
+
+def test_deploy_fleet(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(update, "nix_config", lambda: {"system": "x86_64-linux"})
+    monkeypatch.setattr(update, "run", fake_nix_build)
+    monkeypatch.setattr(update, "generate_facts_for_machines", lambda *a, **kw: None)
+    uploaded = []
+    monkeypatch.setattr(update, "upload_secrets", lambda m: uploaded.append(m.name))
+    copied = []
+
+    class FakePlanner:
+        def __init__(self, roots: list[str], **kwargs: Any) -> None:
+            self.roots = roots
+
+        def copy(self, host: Host, roots: list[str]) -> None:
+            copied.append((host.host, roots))
+
+    monkeypatch.setattr(update, "CopyPlanner", FakePlanner)
+    commands = []
+
+    async def run_remote(host: Host, cmd: list[str], **kwargs: Any) -> None:
+        commands.append((host.host, cmd[0]))
+
+    monkeypatch.setattr(update, "run_remote", run_remote)
+
+    hosts = HostGroup(
+        [Host(name, meta={"machine": FakeMachine(name)}) for name in ["a", "broken"]]
+    )
+    # the broken machine doesn't keep the other one from being deployed
+    with pytest.raises(ClanError, match="failed to update machines: broken"):
+        deploy_fleet(hosts, tmp_path)
+    toplevel = f"/nix/store/{'0' * 32}-a"
+    assert uploaded == ["a"]
+    assert copied == [("a", [toplevel])]
+    assert commands == [
+        ("a", "nix-env"),
+        ("a", f"{toplevel}/bin/switch-to-configuration"),
+    ]
@@ -0,0 +1,185 @@
+import json
+import os
+import re
+import shlex
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from clan_cli.disk_cache import DiskCache, cache_key
+from clan_cli.errors import CmdOut
+from clan_cli.machines import machines
+from clan_cli.machines.machines import Machine
+from clan_cli.nix_repl import NixReplTimeoutError
+
+
+def test_cache_key_stable() -> None:
+    assert cache_key("a", {"x": 1, "y": 2}) == cache_key("a", {"y": 2, "x": 1})
+    assert cache_key("a", None) != cache_key("b", None)
+
+
+def test_get_set(tmp_path: Path) -> None:
+    cache = DiskCache(tmp_path / "cache")
+    assert cache.get("foo") is None
+    cache.set("foo", {"bar": [1, 2]}, machine="vm1")
+    assert cache.get("foo") == {"bar": [1, 2]}
+    cache.remove("foo")
+    assert cache.get("foo") is None
+
+
+def test_corrupted_entry(tmp_path: Path) -> None:
+    cache = DiskCache(tmp_path)
+    (tmp_path / "foo.json").write_text("{")
+    assert cache.get("foo") is None
+    assert not (tmp_path / "foo.json").exists()
+
+
+def test_lru_eviction(tmp_path: Path) -> None:
+    cache = DiskCache(tmp_path, max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    # make sure "a" is the least recently used entry
+    os.utime(tmp_path / "a.json", (0, 0))
+    cache.set("c", 3)
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    assert cache.get("c") == 3
+
+
+def test_eviction_amortized(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = DiskCache(tmp_path, max_entries=100)
+    scans = 0
+    entries = DiskCache._entries
+
+    def count_scans(self: DiskCache) -> list[tuple[Path, os.stat_result]]:
+        nonlocal scans
+        scans += 1
+        return entries(self)
+
+    monkeypatch.setattr(DiskCache, "_entries", count_scans)
+    for i in range(1000):
+        cache.set(str(i), i)
+    # the directory is not scanned on every write
+    assert scans < 100
+    assert 90 <= len(list(tmp_path.glob("*.json"))) <= 100
+    assert cache.get("999") == 999
+
+
+def test_invalidate(tmp_path: Path) -> None:
+    cache = DiskCache(tmp_path)
+    cache.set("a", 1, machine="vm1")
+    cache.set("b", 2, machine="vm2")
+    cache.invalidate(lambda meta: meta.get("machine") == "vm1")
+    assert cache.get("a") is None
+    assert cache.get("b") == 2
+    cache.clear()
+    assert cache.get("b") is None
+
+
+def test_disabled(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("CLAN_NO_CACHE", "1")
+    cache = DiskCache(tmp_path)
+    cache.set("a", 1)
+    assert cache.get("a") is None
+
+
+def test_machine_cache(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(machines, "nix_config", lambda: {"system": "x86_64-linux"})
+    monkeypatch.setattr(Machine, "flake_fingerprint", property(lambda self: "fp"))
+    calls = []
+
+    def nix(
+        self: Machine,
+        method: str,
+        attr: str,
+        extra_config: dict | None,
+        impure: bool,
+        nix_options: list[str],
+    ) -> str | Path:
+        calls.append((method, attr, impure))
+        if method == "build":
+            return tmp_path
+        return f'"{attr}-{len(calls)}"'
+
+    monkeypatch.setattr(Machine, "nix", nix)
+
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.eval_nix("foo") == '"foo-1"'
+    assert machine.build_nix("bar") == tmp_path
+    # a new instance is served from the disk cache
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.eval_nix("foo") == '"foo-1"'
+    assert machine.build_nix("bar") == tmp_path
+    assert len(calls) == 2
+
+    # impure results neither come from nor end up in the cache
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.eval_nix("foo", impure=True) == '"foo-3"'
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.build_nix("bar", impure=True) == tmp_path
+    assert calls[2:] == [("eval", "foo", True), ("build", "bar", True)]
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.eval_nix("foo") == '"foo-1"'
+
+
+def test_machine_eval_many(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.delenv("CLAN_EVAL_WORKER", raising=False)
+    monkeypatch.setattr(machines, "nix_config", lambda: {"system": "x86_64-linux"})
+    monkeypatch.setattr(Machine, "flake_fingerprint", property(lambda self: "fp"))
+    applied = []
+
+    def run(cmd: list[str], **kwargs: Any) -> CmdOut:
+        apply = cmd[cmd.index("--apply") + 1]
+        applied.append(apply)
+        attrs = re.findall(r'"([^"]+)" = machine\.', apply)
+        stdout = json.dumps({attr: {"attr": attr} for attr in attrs})
+        return CmdOut(stdout, "", tmp_path, shlex.join(cmd), 0, None)
+
+    monkeypatch.setattr(machines, "run", run)
+
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.eval_many(["a.b", "c"]) == {
+        "a.b": {"attr": "a.b"},
+        "c": {"attr": "c"},
+    }
+    # all attributes are evaluated by a single nix process
+    assert len(applied) == 1
+
+    # cached attributes are not evaluated again
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.eval_many(["c", "d"]) == {"c": {"attr": "c"}, "d": {"attr": "d"}}
+    assert len(applied) == 2
+    assert '"c"' not in applied[1]
+    assert json.loads(machine.eval_nix("a.b")) == {"attr": "a.b"}
+    assert len(applied) == 2
+
+    # eval_nix and eval_many cache the same text for an attribute
+    cached = Machine(name="vm1", flake=tmp_path).eval_nix("c")
+    monkeypatch.setattr(Machine, "nix", lambda self, *args: '{ "attr": "c" }')
+    assert machine.eval_nix("c", refresh=True) == cached == '{"attr":"c"}'
+
+
+def test_machine_eval_worker_timeout(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("CLAN_EVAL_WORKER", "1")
+    monkeypatch.delenv("IN_NIX_SANDBOX", raising=False)
+    monkeypatch.setattr(machines, "nix_config", lambda: {"system": "x86_64-linux"})
+    monkeypatch.setattr(Machine, "flake_fingerprint", property(lambda self: "fp"))
+
+    def repl_eval(self: Machine, system: str, expr: str) -> Any:
+        raise NixReplTimeoutError("nix repl did not answer")
+
+    monkeypatch.setattr(Machine, "_repl_eval", repl_eval)
+
+    def run(cmd: list[str], **kwargs: Any) -> CmdOut:
+        return CmdOut('{"a":1}', "", tmp_path, shlex.join(cmd), 0, None)
+
+    monkeypatch.setattr(machines, "run", run)
+    # a hanging worker falls back to a one-shot nix eval
+    machine = Machine(name="vm1", flake=tmp_path)
+    assert machine.eval_many(["a"]) == {"a": 1}
@@ -0,0 +1,33 @@
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+from clan_cli.facts.check import missing_facts
+from clan_cli.facts.public_modules import in_repo
+from clan_cli.facts.secret_modules import vm
+
+
+def test_missing_facts(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("XDG_DATA_HOME", str(tmp_path / "data"))
+    machine: Any = SimpleNamespace(
+        name="machine1",
+        flake=tmp_path,
+        flake_dir=tmp_path,
+        facts_data={
+            "ssh": dict(secret=[dict(name="ssh.id_ed25519")], public=["ssh.pub"]),
+            "password": dict(secret=["password"], public=[]),
+            "zerotier": dict(secret=[], public=["zerotier-ip"]),
+        },
+    )
+    secret_store = vm.SecretStore(machine)
+    public_store = in_repo.FactStore(machine)
+    secret_store.set("ssh", "ssh.id_ed25519", b"private", [])
+    public_store.set("ssh", "ssh.pub", b"public")
+    public_store.set("zerotier", "zerotier-ip", b"fd00::1")
+
+    assert missing_facts(machine, secret_store, public_store) == {
+        "password": ["password"]
+    }
+    assert missing_facts(machine, secret_store, public_store, ["ssh"]) == {}
@@ -0,0 +1,181 @@
+import json
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any
+
+import pytest
+
+from clan_cli.errors import ClanError
+from clan_cli.facts import upload
+from clan_cli.facts.secret_modules import password_store, sops
+from clan_cli.facts.upload import MANIFEST_FILE, diff_manifest, parse_manifest
+from clan_cli.git_reader import blob_sha
+from clan_cli.ssh import Host
+
+
+def test_diff_manifest() -> None:
+    local = {"a": "1", "b": "2", "c": "3"}
+    remote = {"a": "1", "b": "0", "d": "4"}
+    assert diff_manifest(local, remote) == ({"b", "c"}, {"d"})
+    assert diff_manifest(local, local) == (set(), set())
+    # secrets without a hash are always uploaded
+    assert diff_manifest({"a": ""}, {"a": ""}) == ({"a"}, set())
+
+
+def test_parse_manifest() -> None:
+    assert parse_manifest(json.dumps({"key.txt": "abc"})) == {"key.txt": "abc"}
+    assert parse_manifest("") is None
+    assert parse_manifest("[]") is None
+    assert parse_manifest(json.dumps({"key.txt": 1})) is None
+    assert parse_manifest(json.dumps({"../etc/passwd": "abc"})) is None
+    assert parse_manifest(json.dumps({"/etc/passwd": "abc"})) is None
+
+
+def test_rsync_target(monkeypatch: pytest.MonkeyPatch) -> None:
+    commands: list[list[str]] = []
+    monkeypatch.setattr(upload, "nix_shell", lambda packages, cmd: cmd)
+    monkeypatch.setattr(upload, "run", lambda cmd, **kwargs: commands.append(cmd))
+    for user, target in [(None, "foo"), ("root", "root@foo")]:
+        machine: Any = SimpleNamespace(
+            target_host=Host("foo", user=user, control_master=False),
+            secrets_upload_directory="/var/lib/secrets",
+        )
+        upload._rsync(machine, Path("/tmp/secrets"), delete=False)
+        assert commands[-1][-1] == f"{target}:/var/lib/secrets/"
+
+
+def test_upload_manifest_last(monkeypatch: pytest.MonkeyPatch) -> None:
+    class SecretStore:
+        def __init__(self, machine: Any) -> None:
+            pass
+
+        def manifest(self) -> dict[str, str]:
+            return {"a": "2", "b": "1"}
+
+        def upload_files(self, output_dir: Path, files: set[str]) -> None:
+            for name in files:
+                (output_dir / name).write_text(name)
+
+    module = SimpleNamespace(SecretStore=SecretStore)
+    monkeypatch.setitem(sys.modules, "fake_secret_store", module)
+    monkeypatch.setattr(upload, "read_remote_manifest", lambda m: {"a": "1", "b": "1"})
+    uploads: list[list[str]] = []
+    fail = True
+
+    def rsync(machine: Any, source: Path, delete: bool) -> None:
+        uploads.append(sorted(p.name for p in source.iterdir()))
+        if fail:
+            raise ClanError("connection lost")
+
+    monkeypatch.setattr(upload, "_rsync", rsync)
+    machine: Any = SimpleNamespace(
+        name="machine1", secret_facts_module="fake_secret_store"
+    )
+
+    # the manifest is not uploaded if the secrets didn't make it
+    with pytest.raises(ClanError):
+        upload.upload_secrets(machine)
+    assert uploads == [["a"]]
+
+    fail = False
+    uploads.clear()
+    upload.upload_secrets(machine)
+    assert uploads == [["a"], [MANIFEST_FILE]]
+
+
+def test_password_store_manifest(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("PASSWORD_STORE_DIR", str(tmp_path))
+    machine: Any = SimpleNamespace(
+        name="machine1",
+        facts_data={
+            "ssh": dict(secret=[dict(name="ssh.id_ed25519")], public=[]),
+            "password": dict(secret=["password"], public=[]),
+        },
+    )
+    machine_dir = tmp_path / "machines" / "machine1"
+    machine_dir.mkdir(parents=True)
+    (machine_dir / "ssh.id_ed25519.gpg").write_bytes(b"encrypted")
+
+    store = password_store.SecretStore(machine)
+    assert store.manifest() == {
+        "ssh.id_ed25519": blob_sha(b"encrypted"),
+        "password": "",
+    }
+    # the missing secret is reported before anything is decrypted
+    with pytest.raises(ClanError, match=r"missing in .*: password"):
+        store.upload_files(tmp_path / "out", {"ssh.id_ed25519", "password"})
+
+
+def test_sops_hash(tmp_path: Path) -> None:
+    machine: Any = SimpleNamespace(name="machine1", flake_dir=tmp_path, facts_data={})
+    store = sops.SecretStore(machine)
+    assert store.generate_hash() == b""
+    assert store.manifest() == {}
+
+    secret = tmp_path / "sops" / "secrets" / "machine1-age.key" / "secret"
+    secret.parent.mkdir(parents=True)
+
+    def write_secret(recipients: list[str]) -> None:
+        metadata = {"age": [{"recipient": r} for r in recipients]}
+        secret.write_text(json.dumps({"data": "ENC[...]", "sops": metadata}))
+
+    write_secret(["age1a"])
+    first = store.generate_hash()
+    assert first
+    assert store.manifest() == {"key.txt": first.decode()}
+    assert store.generate_hash() == first
+    write_secret(["age1a", "age1b"])
+    assert store.generate_hash() != first
+
+
+@pytest.mark.skipif(shutil.which("gpg") is None, reason="gpg is not installed")
+def test_password_store_upload_files(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    gnupghome = tmp_path / "gpg"
+    gnupghome.mkdir(mode=0o700)
+    monkeypatch.setenv("GNUPGHOME", str(gnupghome))
+    monkeypatch.setenv("PASSWORD_STORE_DIR", str(tmp_path / "pass"))
+    subprocess.run(
+        ["gpg", "--batch", "--passphrase", "", "--quick-gen-key", "test@local"],
+        check=True,
+        capture_output=True,
+    )
+    machine: Any = SimpleNamespace(
+        name="machine1",
+        facts_data={
+            "ssh": dict(secret=[dict(name="ssh.id_ed25519")], public=[]),
+            "password": dict(secret=["password"], public=[]),
+        },
+    )
+    machine_dir = tmp_path / "pass" / "machines" / "machine1"
+    machine_dir.mkdir(parents=True)
+    for name in ["ssh.id_ed25519", "password"]:
+        subprocess.run(
+            [
+                "gpg",
+                "--batch",
+                "-e",
+                "-r",
+                "test@local",
+                "-o",
+                machine_dir / f"{name}.gpg",
+            ],
+            input=f"{name} value".encode(),
+            check=True,
+        )
+
+    store = password_store.SecretStore(machine)
+    output_dir = tmp_path / "out"
+    output_dir.mkdir()
+    store.upload_files(output_dir, {"password"})
+    assert sorted(p.name for p in output_dir.iterdir()) == ["password"]
+    assert (output_dir / "password").read_bytes() == b"password value"
+
+    store.upload(output_dir)
+    assert (output_dir / "ssh.id_ed25519").read_bytes() == b"ssh.id_ed25519 value"
@@ -1,5 +1,6 @@
 import subprocess
 import tempfile
+import threading
 from pathlib import Path
 
 import pytest
@@ -67,3 +68,84 @@ def test_clan_flake_in_subdir(git_repo: Path, monkeypatch: pytest.MonkeyPatch) -
         ).decode("utf-8")
         == "test commit\n\n"
     )
+
+
+def test_commit_many_files(git_repo: Path) -> None:
+    files = [git_repo / f"test{i}.txt" for i in range(100)]
+    for file in files:
+        file.touch()
+    git.commit_files(files, git_repo, "test commit")
+    assert not subprocess.check_output(["git", "status", "--porcelain"], cwd=git_repo)
+    # nothing changed, so no new commit
+    git.commit_files(files, git_repo, "another commit")
+    assert (
+        subprocess.check_output(
+            ["git", "log", "-1", "--pretty=%B"], cwd=git_repo
+        ).decode("utf-8")
+        == "test commit\n\n"
+    )
+
+
+def test_batch_commit(git_repo: Path) -> None:
+    (git_repo / "a.txt").touch()
+    (git_repo / "b.txt").touch()
+    with git.batch_commit("batch"):
+        git.commit_file(git_repo / "a.txt", git_repo, "add a")
+        git.commit_file(git_repo / "b.txt", git_repo, "add b")
+        # nothing is committed until the batch is done
+        assert subprocess.check_output(["git", "status", "--porcelain"], cwd=git_repo)
+    assert not subprocess.check_output(["git", "status", "--porcelain"], cwd=git_repo)
+    assert (
+        subprocess.check_output(
+            ["git", "log", "-1", "--pretty=%B"], cwd=git_repo
+        ).decode("utf-8")
+        == "batch\n\nadd a\nadd b\n\n"
+    )
+
+    (git_repo / "c.txt").touch()
+    with pytest.raises(ClanError):
+        with git.batch_commit():
+            git.commit_file(git_repo / "c.txt", git_repo, "add c")
+            raise ClanError("generation failed")
+    assert subprocess.check_output(["git", "status", "--porcelain"], cwd=git_repo)
+
+
+def test_batch_commit_threads(git_repo: Path) -> None:
+    (git_repo / "a.txt").touch()
+    (git_repo / "b.txt").touch()
+    a_added = threading.Event()
+    b_failed = threading.Event()
+
+    def commit_a() -> None:
+        with git.batch_commit("batch a"):
+            git.commit_file(git_repo / "a.txt", git_repo, "add a")
+            a_added.set()
+            # the batch of the other thread fails while this one is open
+            assert b_failed.wait(timeout=5)
+
+    def commit_b() -> None:
+        assert a_added.wait(timeout=5)
+        try:
+            with git.batch_commit("batch b"):
+                git.commit_file(git_repo / "b.txt", git_repo, "add b")
+                raise ClanError("generation failed")
+        except ClanError:
+            b_failed.set()
+
+    threads = [threading.Thread(target=commit_a), threading.Thread(target=commit_b)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert (
+        subprocess.check_output(
+            ["git", "log", "-1", "--pretty=%B"], cwd=git_repo
+        ).decode("utf-8")
+        == "batch a\n\nadd a\n\n"
+    )
+    # only the files of the failed batch are left uncommitted
+    assert (
+        subprocess.check_output(["git", "status", "--porcelain"], cwd=git_repo).decode()
+        == "?? b.txt\n"
+    )
@@ -0,0 +1,81 @@
+import subprocess
+from pathlib import Path
+
+from clan_cli.git_reader import GitRepo
+
+
+def git(repo: Path, *args: str) -> str:
+    return subprocess.check_output(["git", *args], cwd=repo, text=True).strip()
+
+
+def test_git_reader(git_repo: Path) -> None:
+    repo = GitRepo.find(git_repo / "subdir")
+    assert repo is not None
+    assert repo.worktree == git_repo
+    # no commit yet
+    assert repo.head() is None
+
+    (git_repo / "a.txt").write_text("a")
+    (git_repo / "link").symlink_to("a.txt")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-m", "init")
+    ref, rev = repo.head() or (None, None)
+    assert rev == git(git_repo, "rev-parse", "HEAD")
+    assert ref == git(git_repo, "symbolic-ref", "HEAD")
+    assert repo.commit_tree(rev) == git(git_repo, "rev-parse", "HEAD^{tree}")
+    assert repo.is_dirty() is False
+    assert repo.unchanged(["a.txt", "link"])
+
+    (git_repo / "a.txt").write_text("b")
+    assert repo.is_dirty() is True
+    assert repo.changed_paths() == ["a.txt"]
+    assert not repo.unchanged(["a.txt"])
+
+    git(git_repo, "commit", "-am", "update")
+    # refs and objects are read from packs after a gc
+    git(git_repo, "gc", "-q")
+    assert not (git_repo / ".git" / ref).exists()
+    ref, rev = repo.head() or (None, None)
+    assert rev == git(git_repo, "rev-parse", "HEAD")
+    assert repo.is_dirty() is False
+
+    # untracked files don't make the tree dirty
+    (git_repo / "new.txt").write_text("new")
+    assert repo.is_dirty() is False
+    assert not repo.unchanged(["new.txt"])
+    # staged files do
+    git(git_repo, "add", "new.txt")
+    assert repo.is_dirty() is not False
+
+
+def test_git_reader_split_index(git_repo: Path) -> None:
+    repo = GitRepo.find(git_repo)
+    assert repo is not None
+    (git_repo / "a.txt").write_text("a")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-m", "init")
+    assert repo.is_dirty() is False
+
+    # entries in the shared index are not read, so we cannot tell
+    git(git_repo, "update-index", "--split-index")
+    assert repo.read_index() is None
+    assert repo.is_dirty() is None
+    assert not repo.unchanged(["a.txt"])
+
+    git(git_repo, "update-index", "--no-split-index")
+    assert repo.is_dirty() is False
+
+
+def test_git_reader_sparse_index(git_repo: Path) -> None:
+    repo = GitRepo.find(git_repo)
+    assert repo is not None
+    (git_repo / "a.txt").write_text("a")
+    (git_repo / "dir").mkdir()
+    (git_repo / "dir" / "b.txt").write_text("b")
+    git(git_repo, "add", ".")
+    git(git_repo, "commit", "-m", "init")
+
+    # dir/ is a single directory entry instead of the files below it
+    git(git_repo, "sparse-checkout", "set", "--cone", "--sparse-index", "other")
+    assert repo.read_index() is None
+    assert repo.is_dirty() is None
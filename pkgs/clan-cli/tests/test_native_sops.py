@@ -0,0 +1,131 @@
+import base64
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pytest
+from age_keys import KEYS
+
+from clan_cli.errors import ClanError
+from clan_cli.secrets import sops
+from clan_cli.secrets.native_sops import (
+    UnsupportedSopsFileError,
+    _dearmor,
+    _decrypt_value,
+    age_decrypt,
+    decrypt_sops_file,
+)
+
+pytest.importorskip("cryptography")
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+SECRETS_YAML = Path(__file__).parent / "data" / "secrets.yaml"
+IDENTITY = KEYS[1].privkey
+
+
+def secrets_yaml() -> dict[str, str]:
+    """
+    The encrypted values and the metadata of secrets.yaml, which was written by sops.
+    """
+    text = SECRETS_YAML.read_text()
+    values: dict[str, str] = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition(": ")
+        if sep and value.strip('"') and not key.strip().startswith("-"):
+            # the nested secret-key comes after the top level one
+            name = "nested" if key == "    secret-key" else key.strip()
+            values[name] = value.strip('"')
+    begin = text.index("-----BEGIN AGE ENCRYPTED FILE-----")
+    end = text.index("-----END AGE ENCRYPTED FILE-----")
+    values["enc"] = text[begin : end + len("-----END AGE ENCRYPTED FILE-----")]
+    return values
+
+
+def encrypt_value(plaintext: bytes, data_key: bytes, additional_data: str) -> str:
+    iv = os.urandom(32)
+    ciphertext = AESGCM(data_key).encrypt(iv, plaintext, additional_data.encode())
+    data, tag = ciphertext[:-16], ciphertext[-16:]
+    return "ENC[AES256_GCM,data:{},iv:{},tag:{},type:str]".format(
+        *(base64.b64encode(part).decode() for part in (data, iv, tag))
+    )
+
+
+def write_binary_secret(path: Path, plaintext: bytes, **extra: object) -> Path:
+    """
+    Write a sops binary file, reusing the age wrapped data key of secrets.yaml.
+    """
+    values = secrets_yaml()
+    data_key = age_decrypt(_dearmor(values["enc"]), [IDENTITY])
+    mac = hashlib.sha512(plaintext).hexdigest().upper().encode()
+    metadata: dict[str, object] = dict(
+        age=[dict(recipient=KEYS[1].pubkey, enc=values["enc"])],
+        lastmodified=values["lastmodified"],
+        mac=encrypt_value(mac, data_key, values["lastmodified"]),
+        pgp=None,
+        version="3.7.3",
+    )
+    metadata.update(extra)
+    document = dict(data=encrypt_value(plaintext, data_key, "data:"), sops=metadata)
+    path.write_text(json.dumps(document))
+    return path
+
+
+def test_decrypt_sops_yaml() -> None:
+    # written by sops, checks the additional data and the MAC format
+    values = secrets_yaml()
+    data_key = age_decrypt(_dearmor(values["enc"]), [IDENTITY])
+    value = _decrypt_value(values["secret-key"], data_key, "secret-key:")
+    nested = _decrypt_value(values["nested"], data_key, "nested:secret-key:")
+    assert value == nested == b"secret-value"
+    mac = _decrypt_value(values["mac"], data_key, values["lastmodified"])
+    assert mac == hashlib.sha512(value + nested).hexdigest().upper().encode()
+
+
+def test_decrypt_sops_file(tmp_path: Path) -> None:
+    secret = write_binary_secret(tmp_path / "secret", b"hello\nworld")
+    assert decrypt_sops_file(secret, [KEYS[0].privkey, IDENTITY]) == "hello\nworld"
+
+    with pytest.raises(UnsupportedSopsFileError):
+        decrypt_sops_file(secret, [KEYS[0].privkey])
+
+    pgp = write_binary_secret(tmp_path / "pgp", b"hello", pgp=[dict(fp="abc")])
+    with pytest.raises(UnsupportedSopsFileError):
+        decrypt_sops_file(pgp, [IDENTITY])
+
+    tampered = json.loads(secret.read_text())
+    tampered["sops"]["lastmodified"] = "2024-01-01T00:00:00Z"
+    secret.write_text(json.dumps(tampered))
+    with pytest.raises(UnsupportedSopsFileError):
+        decrypt_sops_file(secret, [IDENTITY])
+
+    with pytest.raises(UnsupportedSopsFileError):
+        decrypt_sops_file(SECRETS_YAML, [IDENTITY])
+
+
+def test_decrypt_file_fallback(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    secret = write_binary_secret(tmp_path / "secret", b"hello")
+    monkeypatch.setenv("SOPS_AGE_KEY", IDENTITY)
+    monkeypatch.setenv("SOPS_AGE_KEY_FILE", str(tmp_path / "missing.txt"))
+
+    calls = []
+
+    def nix_shell(packages: list[str], cmd: list[str]) -> list[str]:
+        calls.append(cmd)
+        return ["false"]
+
+    monkeypatch.setattr(sops, "nix_shell", nix_shell)
+    assert sops.decrypt_file(secret) == "hello"
+    assert calls == []
+
+    # files sops has to decrypt and an explicit opt-out use the sops binary
+    monkeypatch.setenv("SOPS_AGE_KEY", KEYS[0].privkey)
+    with pytest.raises(ClanError):
+        sops.decrypt_file(secret)
+    assert len(calls) == 1
+
+    monkeypatch.setenv("SOPS_AGE_KEY", IDENTITY)
+    monkeypatch.setenv("CLAN_NATIVE_SOPS", "0")
+    with pytest.raises(ClanError):
+        sops.decrypt_file(secret)
+    assert len(calls) == 2
@@ -0,0 +1,80 @@
+import json
+import os
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from clan_cli import nix
+from clan_cli.errors import CmdOut
+
+
+@pytest.fixture
+def show_config(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> list[list[str]]:
+    """
+    Replace `nix show-config` with a fake that reports the substituters
+    of $NIX_CONF_DIR/extra.conf, return the list of its calls
+    """
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(nix, "_nix_config", None)
+    calls = []
+
+    def run(cmd: list[str], **kwargs: Any) -> CmdOut:
+        calls.append(cmd)
+        extra = Path(os.environ["NIX_CONF_DIR"]) / "extra.conf"
+        config = dict(substituters=dict(value=extra.read_text()))
+        return CmdOut(json.dumps(config), "", tmp_path, "nix", 0, None)
+
+    monkeypatch.setattr(nix, "run", run)
+    return calls
+
+
+def test_nix_config_memoized(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, show_config: list[list[str]]
+) -> None:
+    etc = tmp_path / "etc"
+    etc.mkdir()
+    (etc / "nix.conf").write_text("!include extra.conf\n")
+    (etc / "extra.conf").write_text("substituters = https://a\n")
+    monkeypatch.setenv("NIX_CONF_DIR", str(etc))
+    monkeypatch.setenv("NIX_USER_CONF_FILES", str(tmp_path / "missing.conf"))
+
+    assert nix.nix_config() == {"substituters": "substituters = https://a\n"}
+    # the config files are not read again within the same process
+    monkeypatch.setattr(nix, "_nix_config_cache_key", lambda: pytest.fail())
+    assert nix.nix_config() == {"substituters": "substituters = https://a\n"}
+    assert len(show_config) == 1
+
+
+def test_nix_config_disk_cache(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch, show_config: list[list[str]]
+) -> None:
+    # like on NixOS: a symlink into the store, where every mtime is 1
+    store = tmp_path / "store"
+    store.mkdir()
+    (store / "nix.conf").write_text("system = x86_64-linux\n!include extra.conf\n")
+    (store / "extra.conf").write_text("substituters = https://a\n")
+    for file in store.iterdir():
+        os.utime(file, (1, 1))
+    etc = tmp_path / "etc"
+    etc.mkdir()
+    # relative includes are resolved next to the symlink, not its target
+    for name in ("nix.conf", "extra.conf"):
+        (etc / name).symlink_to(store / name)
+    monkeypatch.setenv("NIX_CONF_DIR", str(etc))
+    monkeypatch.setenv("NIX_USER_CONF_FILES", str(tmp_path / "missing.conf"))
+
+    def nix_config() -> dict[str, Any]:
+        # a new process, only the disk cache is left
+        monkeypatch.setattr(nix, "_nix_config", None)
+        return nix.nix_config()
+
+    assert nix_config() == {"substituters": "substituters = https://a\n"}
+    assert nix_config() == {"substituters": "substituters = https://a\n"}
+    assert len(show_config) == 1
+
+    # a change of an included file invalidates the cache, even with the same mtime
+    (store / "extra.conf").write_text("substituters = https://b\n")
+    os.utime(store / "extra.conf", (1, 1))
+    assert nix_config() == {"substituters": "substituters = https://b\n"}
+    assert len(show_config) == 2
@@ -0,0 +1,158 @@
+import threading
+import time
+from typing import Any, cast
+
+import pytest
+
+from clan_cli import nix_repl
+from clan_cli.errors import ClanError
+from clan_cli.nix_repl import (
+    NixRepl,
+    NixReplPool,
+    NixReplTimeoutError,
+    eval_worker_timeout,
+    eval_workers,
+    parse_nix_string,
+)
+
+
+def test_parse_nix_string() -> None:
+    assert parse_nix_string('"foo"\n') == "foo"
+    assert parse_nix_string('nix-repl> "{\\"a\\":1}"') == '{"a":1}'
+    assert parse_nix_string('"a\\nb\\tc\\\\d\\$e"') == "a\nb\tc\\d$e"
+    assert parse_nix_string('\x1b[35;1m"colored"\x1b[0m') == "colored"
+    for line in ["", '"', "42", '"unterminated']:
+        with pytest.raises(ValueError):
+            parse_nix_string(line)
+
+
+class FakeProcess:
+    def __init__(self) -> None:
+        self.returncode: int | None = None
+
+    def poll(self) -> int | None:
+        return self.returncode
+
+
+class FakeRepl:
+    def __init__(self, flake_url: str) -> None:
+        self.flake_url = flake_url
+        self.process = FakeProcess()
+        self.closed = False
+        repls.append(self)
+
+    def eval_json(self, expr: str) -> Any:
+        if expr == "die":
+            self.process.returncode = 1
+            raise ClanError("nix repl died")
+        return [self.flake_url, expr]
+
+    def close(self) -> None:
+        self.closed = True
+
+
+repls: list[FakeRepl] = []
+
+
+@pytest.fixture
+def pool(monkeypatch: pytest.MonkeyPatch) -> NixReplPool:
+    repls.clear()
+    monkeypatch.setattr(nix_repl, "NixRepl", FakeRepl)
+    return NixReplPool(size=1)
+
+
+def test_pool_reuse(pool: NixReplPool) -> None:
+    assert pool.eval_json("flake", "rev1", "a") == ["flake", "a"]
+    assert pool.eval_json("flake", "rev1", "b") == ["flake", "b"]
+    assert pool.eval_json("other", "rev1", "c") == ["other", "c"]
+    assert len(repls) == 2
+
+    # a new revision of a flake replaces the workers of the old one
+    pool.eval_json("flake", "rev2", "d")
+    assert len(repls) == 3
+    assert repls[0].closed
+    assert not repls[1].closed
+    pool.close()
+    assert all(repl.closed for repl in repls)
+
+
+def test_pool_dead_worker(pool: NixReplPool) -> None:
+    with pytest.raises(ClanError):
+        pool.eval_json("flake", "rev1", "die")
+    assert repls[0].closed
+    assert pool.eval_json("flake", "rev1", "a") == ["flake", "a"]
+    assert len(repls) == 2
+
+
+def test_pool_wakes_waiters(pool: NixReplPool) -> None:
+    slot, repl = pool._acquire(("flake", "rev1"))
+    busy = cast(FakeRepl, repl)
+    results = []
+    waiter = threading.Thread(
+        target=lambda: results.append(pool.eval_json("flake", "rev1", "a"))
+    )
+    waiter.start()
+    waiter.join(timeout=0.1)
+    # the only worker is busy
+    assert waiter.is_alive()
+
+    # the busy worker dies, the waiting thread starts a new one
+    busy.process.returncode = 1
+    pool._release(slot, repl)
+    waiter.join(timeout=5)
+    assert results == [["flake", "a"]]
+    assert len(repls) == 2
+
+    # a waiter for a revision that is replaced in the meantime is woken up as well
+    slot, repl = pool._acquire(("flake", "rev1"))
+    busy = cast(FakeRepl, repl)
+    waiter = threading.Thread(
+        target=lambda: results.append(pool.eval_json("flake", "rev1", "b"))
+    )
+    waiter.start()
+    waiter.join(timeout=0.1)
+    assert waiter.is_alive()
+    assert pool.eval_json("flake", "rev2", "c") == ["flake", "c"]
+    waiter.join(timeout=5)
+    assert results[1:] == [["flake", "b"]]
+    pool._release(slot, repl)
+    assert busy.closed
+
+
+def test_eval_workers(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delenv("CLAN_EVAL_WORKERS", raising=False)
+    assert eval_workers() == 2
+    monkeypatch.setenv("CLAN_EVAL_WORKERS", "4")
+    assert eval_workers() == 4
+    for value in ["many", "0"]:
+        monkeypatch.setenv("CLAN_EVAL_WORKERS", value)
+        with pytest.raises(ClanError):
+            NixReplPool().eval_json("flake", "rev1", "a")
+
+
+def test_eval_worker_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.delenv("CLAN_EVAL_WORKER_TIMEOUT", raising=False)
+    assert eval_worker_timeout() == 600
+    monkeypatch.setenv("CLAN_EVAL_WORKER_TIMEOUT", "2.5")
+    assert eval_worker_timeout() == 2.5
+    for value in ["never", "0"]:
+        monkeypatch.setenv("CLAN_EVAL_WORKER_TIMEOUT", value)
+        with pytest.raises(ClanError):
+            eval_worker_timeout()
+
+
+def test_repl_timeout(monkeypatch: pytest.MonkeyPatch) -> None:
+    # answers the :lf command and then stops answering
+    script = 'read cmd; read sentinel; echo "$sentinel"; sleep 100'
+    monkeypatch.setattr(nix_repl, "nix_command", lambda args: ["sh", "-c", script])
+    repl = NixRepl("flake", timeout=0.5)
+    start = time.monotonic()
+    with pytest.raises(NixReplTimeoutError):
+        repl.eval_json("1")
+    assert time.monotonic() - start < 5
+    # the hanging worker is killed, so the pool does not hand it out again
+    assert repl.process.poll() is not None
+
+    monkeypatch.setattr(nix_repl, "nix_command", lambda args: ["sleep", "100"])
+    with pytest.raises(NixReplTimeoutError):
+        NixRepl("flake", timeout=0.1)
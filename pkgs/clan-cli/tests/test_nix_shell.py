@@ -0,0 +1,79 @@
+import json
+import subprocess
+import threading
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from clan_cli import nix
+from clan_cli.dirs import user_tool_cache_dir
+from clan_cli.disk_cache import DiskCache
+from clan_cli.errors import CmdOut
+
+
+def test_nix_shell_cached_tools(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.delenv("IN_NIX_SANDBOX", raising=False)
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(nix, "_tool_paths", {})
+    bin_dir = tmp_path / "hello" / "bin"
+    bin_dir.mkdir(parents=True)
+    hello = bin_dir / "hello"
+    hello.write_text("#!/bin/sh\necho hello $1\n")
+    hello.chmod(0o755)
+    DiskCache(user_tool_cache_dir()).set(
+        nix._tool_cache_key("nixpkgs#hello"), [str(bin_dir)]
+    )
+
+    cmd = nix.nix_shell(["nixpkgs#hello"], ["hello", "world"])
+    assert "shell" not in cmd
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=True)
+    assert proc.stdout == "hello world\n"
+
+
+def test_resolve_packages_concurrently(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(nix, "_tool_paths", {})
+    monkeypatch.setattr(nix, "nixpkgs_flake", lambda: tmp_path)
+    (tmp_path / "bin").mkdir()
+    started = {"nixpkgs#a": threading.Event(), "nixpkgs#b": threading.Event()}
+
+    def run(cmd: list[str], **kwargs: Any) -> CmdOut:
+        package = cmd[-1]
+        started[package].set()
+        # the build of a only finishes once b is being built as well
+        other = "nixpkgs#b" if package == "nixpkgs#a" else "nixpkgs#a"
+        assert started[other].wait(timeout=5)
+        stdout = json.dumps([{"outputs": {"out": str(tmp_path)}}])
+        return CmdOut(stdout, "", tmp_path, "nix build", 0, None)
+
+    monkeypatch.setattr(nix, "run", run)
+
+    results: dict[str, list[str] | None] = {}
+
+    def resolve(package: str) -> None:
+        results[package] = nix.resolve_packages([package, package])
+
+    threads = [threading.Thread(target=resolve, args=(p,)) for p in started]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == {p: [f"{tmp_path}/bin"] * 2 for p in started}
+
+
+def test_resolve_packages_bad_output(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setattr(nix, "_tool_paths", {})
+    monkeypatch.setattr(nix, "nixpkgs_flake", lambda: tmp_path)
+    # nix_shell falls back to `nix shell` for output it does not understand
+    for stdout in ["not json", "{}", "[{}]", '[{"outputs": []}]', "[]"]:
+        out = CmdOut(stdout, "", tmp_path, "nix build", 0, None)
+        monkeypatch.setattr(nix, "run", lambda cmd, out=out, **kwargs: out)
+        assert nix.resolve_packages(["nixpkgs#hello"]) is None
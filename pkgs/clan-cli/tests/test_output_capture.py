@@ -0,0 +1,71 @@
+import io
+
+import pytest
+
+from clan_cli import cmd
+from clan_cli.cmd import Log, run
+from clan_cli.output_capture import LineBuffer, OutputCapture
+
+
+def test_output_capture_limit() -> None:
+    tee = io.BytesIO()
+    chunks: list[bytes] = []
+    capture = OutputCapture(max_bytes=4, tee=tee, callback=chunks.append)
+    for chunk in [b"ab", b"cd", b"ef", b"g"]:
+        capture.write(chunk)
+    assert capture.getvalue() == b"defg"
+    assert capture.dropped == 3
+    assert capture.decode() == "[... 3 bytes of output dropped ...]\ndefg"
+    assert tee.getvalue() == b"abcdefg"
+    assert chunks == [b"ab", b"cd", b"ef", b"g"]
+
+
+def test_output_capture_keep_nothing() -> None:
+    tee = io.BytesIO()
+    capture = OutputCapture(max_bytes=0, tee=tee)
+    for chunk in [b"ab", b"cd"]:
+        capture.write(chunk)
+    assert capture.getvalue() == b""
+    assert capture.dropped == 4
+    assert tee.getvalue() == b"abcd"
+
+
+def test_line_buffer() -> None:
+    buf = LineBuffer()
+    assert buf.feed(b"foo") == []
+    assert buf.feed(b"bar\nbaz\nqu") == [b"foobar", b"baz"]
+    assert buf.flush() == [b"qu"]
+    assert buf.flush() == []
+
+
+def test_run_capture() -> None:
+    capture = OutputCapture(max_bytes=1024)
+    out = run(
+        ["sh", "-c", "head -c 1000000 /dev/zero | tr '\\0' x"],
+        log=Log.NONE,
+        stdout=capture,
+    )
+    assert out.stdout.endswith("x" * 1024)
+    assert capture.dropped == 1000000 - 1024
+
+
+def test_run_input() -> None:
+    # more than a pipe buffer, so reading and writing have to interleave
+    data = b"x" * (1024 * 1024)
+    assert run(["cat"], stdin_data=data, log=Log.NONE).stdout == data.decode()
+
+
+def test_run_default_limits(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(cmd, "MAX_STDERR_BYTES", 1024)
+    # only the end of stderr is kept
+    out = run(
+        ["sh", "-c", "head -c 1000000 /dev/zero | tr '\\0' x >&2; echo done >&2"],
+        log=Log.NONE,
+    )
+    assert out.stderr.startswith("[... ")
+    assert out.stderr.endswith("x" * 1019 + "done\n")
+    assert len(out.stderr) < 1100
+
+    # stdout is kept in full, callers parse it
+    out = run(["sh", "-c", "head -c 1000000 /dev/zero | tr '\\0' x"], log=Log.NONE)
+    assert out.stdout == "x" * 1000000
@@ -0,0 +1,172 @@
+import io
+import json
+import os
+import subprocess
+from pathlib import Path
+from typing import Any
+
+import pytest
+
+from clan_cli.errors import ClanError, CmdOut
+from clan_cli.secrets import secrets, sops
+from clan_cli.secrets.key_index import KeyIndex
+from clan_cli.secrets.secrets import collect_keys_for_path
+from clan_cli.secrets.sops import sops_recipients, update_keys_batch
+
+
+def write_secret(path: Path, recipients: list[str], **extra: object) -> Path:
+    path.mkdir(parents=True)
+    metadata = dict(
+        age=[dict(recipient=r, enc="...") for r in recipients], pgp=None, **extra
+    )
+    (path / "secret").write_text(json.dumps(dict(data="ENC[...]", sops=metadata)))
+    return path
+
+
+def test_sops_recipients(tmp_path: Path) -> None:
+    secret = write_secret(tmp_path / "foo", ["age1a", "age1b"])
+    assert sops_recipients(secret / "secret") == {"age1a", "age1b"}
+
+    pgp = write_secret(tmp_path / "pgp", ["age1a"], key_groups=[dict(pgp=[])])
+    assert sops_recipients(pgp / "secret") is None
+
+    (tmp_path / "broken").write_text("not json")
+    assert sops_recipients(tmp_path / "broken") is None
+    assert sops_recipients(tmp_path / "missing") is None
+
+
+def test_update_keys_batch_skips_unchanged(tmp_path: Path) -> None:
+    secrets = {
+        write_secret(tmp_path / "a", ["age1a"]): ["age1a"],
+        write_secret(tmp_path / "b", ["age1a", "age1b"]): ["age1b", "age1a"],
+    }
+    # sops would fail here, as it is not available in the tests
+    assert update_keys_batch(secrets) == []
+
+
+def test_key_index(tmp_path: Path) -> None:
+    sops_dir = tmp_path / "sops"
+
+    def add(kind: str, name: str, key: str) -> None:
+        (sops_dir / kind / name).mkdir(parents=True)
+        (sops_dir / kind / name / "key.json").write_text(
+            json.dumps(dict(publickey=key, type="age"))
+        )
+
+    def link(folder: Path, target: Path) -> None:
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / target.name).symlink_to(os.path.relpath(target, folder))
+
+    add("users", "user1", "age1user1")
+    add("users", "user2", "age1user2")
+    add("machines", "machine1", "age1machine1")
+    link(sops_dir / "groups" / "group1" / "users", sops_dir / "users" / "user2")
+    secret = sops_dir / "secrets" / "secret1"
+    link(secret / "machines", sops_dir / "machines" / "machine1")
+    link(secret / "groups", sops_dir / "groups" / "group1")
+
+    index = KeyIndex.load(tmp_path)
+    assert KeyIndex.load(tmp_path) is index
+    assert collect_keys_for_path(secret) == {"age1machine1", "age1user2"}
+
+    # adding a user to the group invalidates the index
+    link(sops_dir / "groups" / "group1" / "users", sops_dir / "users" / "user1")
+    assert not index.valid()
+    assert collect_keys_for_path(secret) == {"age1machine1", "age1user1", "age1user2"}
+    assert KeyIndex.load(tmp_path) is not index
+
+
+def test_ensure_sops_key_cached(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    monkeypatch.setenv("SOPS_AGE_KEY", "AGE-SECRET-KEY-TEST")
+    calls = []
+
+    def age_keygen(cmd: list[str], **kwargs: Any) -> subprocess.CompletedProcess:
+        calls.append(cmd)
+        return subprocess.CompletedProcess(cmd, 0, stdout="age1user1\n")
+
+    monkeypatch.setattr(sops.subprocess, "run", age_keygen)
+    user = tmp_path / "sops" / "users" / "user1"
+    user.mkdir(parents=True)
+    (user / "key.json").write_text(json.dumps(dict(publickey="age1user1", type="age")))
+
+    key = sops.ensure_sops_key(tmp_path)
+    assert (key.username, key.pubkey) == ("user1", "age1user1")
+    assert sops.ensure_sops_key(tmp_path) is key
+    assert len(calls) == 1
+
+    # a new process uses the disk cache
+    monkeypatch.setattr(sops, "_sops_keys", {})
+    monkeypatch.setattr(sops, "_public_keys", {})
+    assert sops.ensure_sops_key(tmp_path).username == "user1"
+    assert len(calls) == 1
+
+    # a renamed user is found again
+    user.rename(user.parent / "user2")
+    assert sops.ensure_sops_key(tmp_path).username == "user2"
+    assert len(calls) == 1
+
+
+def test_encrypt_file_streams_plaintext(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    inputs = []
+
+    def sops_encrypt(cmd: list[str], stdin_data: bytes, **kwargs: Any) -> CmdOut:
+        inputs.append(stdin_data)
+        assert "/dev/stdin" in cmd
+        return CmdOut(json.dumps(dict(data="ENC[...]")), "", tmp_path, "", 0, None)
+
+    monkeypatch.setattr(sops, "run", sops_encrypt)
+    secret = tmp_path / "secrets" / "foo" / "secret"
+    sops.encrypt_file(secret, "plaintext", ["age1a"])
+    sops.encrypt_file(secret, io.StringIO("from a stream"), ["age1a"])
+    assert inputs == [b"plaintext", b"from a stream"]
+    assert json.loads(secret.read_text()) == dict(data="ENC[...]")
+    # no temporary files are left behind
+    assert os.listdir(secret.parent) == ["secret"]
+
+
+def test_encrypt_secrets_single_commit(
+    git_repo: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setenv("XDG_CACHE_HOME", str(git_repo / ".cache"))
+    monkeypatch.setenv("SOPS_AGE_KEY", "AGE-SECRET-KEY-BULK")
+    monkeypatch.setattr(sops, "get_public_key", lambda privkey: "age1user1")
+    encrypted = {}
+
+    def encrypt_file(path: Path, value: str, keys: list[str]) -> None:
+        if value == "fail":
+            raise ClanError("sops failed")
+        if value == "oserror":
+            raise OSError("No space left on device")
+        encrypted[path.parent.name] = keys
+        path.write_text(json.dumps(dict(data=value)))
+
+    monkeypatch.setattr(secrets, "encrypt_file", encrypt_file)
+    user = git_repo / "sops" / "users" / "user1"
+    user.mkdir(parents=True)
+    (user / "key.json").write_text(json.dumps(dict(publickey="age1user1", type="age")))
+    subprocess.run(["git", "add", "."], cwd=git_repo, check=True)
+    subprocess.run(["git", "commit", "-q", "-m", "init"], cwd=git_repo, check=True)
+
+    values: dict[str, str | bytes] = {f"secret{i}": f"value{i}" for i in range(20)}
+    with pytest.raises(ClanError, match="broken, full"):
+        secrets.encrypt_secrets(
+            git_repo, {**values, "broken": "fail", "full": "oserror"}
+        )
+    assert encrypted == {name: ["age1user1"] for name in values}
+    log = subprocess.run(
+        ["git", "log", "--format=%s"], cwd=git_repo, check=True, capture_output=True
+    ).stdout.decode()
+    assert log.splitlines() == ["Add 20 secrets", "init"]
+    assert (git_repo / "sops/secrets/secret0/users/user1").is_symlink()
+    # nothing is left behind of the secrets that failed
+    assert sorted(os.listdir(git_repo / "sops/secrets")) == sorted(values)
+    # the files of an existing secret are kept if its update fails
+    with pytest.raises(ClanError, match="secret0"):
+        secrets.encrypt_secrets(git_repo, {"secret0": "fail"})
+    assert (git_repo / "sops/secrets/secret0/secret").exists()
+    assert (git_repo / "sops/secrets/secret0/users/user1").is_symlink()
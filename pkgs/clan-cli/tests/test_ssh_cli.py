@@ -6,9 +6,17 @@ import pytest_subprocess.fake_process
 from pytest_subprocess import utils
 
 import clan_cli
+from clan_cli import nix
 from clan_cli.ssh import cli
 
 
+@pytest.fixture
+def unresolved_packages(monkeypatch: pytest.MonkeyPatch) -> None:
+    # nix_shell falls back to `nix shell` if the packages cannot be realised,
+    # otherwise the nix build that realises them would be an unregistered process
+    monkeypatch.setattr(nix, "resolve_packages", lambda packages: None)
+
+
 def test_no_args(
     capsys: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
 ) -> None:
@@ -20,6 +28,7 @@ def test_no_args(
 
 
 # using fp fixture from pytest-subprocess
+@pytest.mark.usefixtures("unresolved_packages")
 def test_ssh_no_pass(
     fp: pytest_subprocess.fake_process.FakeProcess, monkeypatch: pytest.MonkeyPatch
 ) -> None:
@@ -50,6 +59,7 @@ def test_ssh_no_pass(
     assert fp.call_count(cmd) == 1
 
 
+@pytest.mark.usefixtures("unresolved_packages")
 def test_ssh_with_pass(
     fp: pytest_subprocess.fake_process.FakeProcess, monkeypatch: pytest.MonkeyPatch
 ) -> None:
@@ -77,6 +87,7 @@ def test_ssh_with_pass(
     assert fp.call_count(cmd) == 1
 
 
+@pytest.mark.usefixtures("unresolved_packages")
 def test_qrcode_scan(fp: pytest_subprocess.fake_process.FakeProcess) -> None:
     cmd: list[str | utils.Any] = [fp.any()]
     fp.register(cmd, stdout="https://test.test")
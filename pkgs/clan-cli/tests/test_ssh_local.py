@@ -1,6 +1,14 @@
+import asyncio
 import subprocess
+import threading
+import time
+from pathlib import Path
 
-from clan_cli.ssh import Host, HostGroup
+import pytest
+
+from clan_cli import ssh
+from clan_cli.ssh import Host, HostGroup, async_host_group, close_control_masters
+from clan_cli.ssh.async_host_group import AsyncHostGroup
 
 hosts = HostGroup([Host("some_host")])
 
@@ -63,3 +71,136 @@ def test_run_function_exception() -> None:
 def test_run_local_non_shell() -> None:
     p2 = hosts.run_local(["echo", "1"], stdout=subprocess.PIPE)
     assert p2[0].result.stdout == "1\n"
+
+
+def test_run_function_max_workers() -> None:
+    lock = threading.Lock()
+    running = 0
+    max_running = 0
+
+    def some_func(h: Host) -> None:
+        nonlocal running, max_running
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        time.sleep(0.05)
+        with lock:
+            running -= 1
+
+    group = HostGroup([Host(f"host{i}") for i in range(6)])
+    res = group.run_function(some_func, max_workers=2)
+    assert len(res) == 6
+    assert max_running <= 2
+
+
+def test_control_master_opts() -> None:
+    host = Host("some_host", user="root", port=2222)
+    cmd = host.ssh_cmd()
+    assert "ControlMaster=auto" in cmd
+    control_path = next(o for o in cmd if o.startswith("ControlPath="))
+    control_dir = Path(control_path.removeprefix("ControlPath=")).parent
+    assert control_dir.is_dir()
+    assert Host("some_host", control_master=False).control_opts() == []
+
+    # the options of the user come first, ssh uses the first value it sees
+    host = Host("some_host", ssh_options={"ControlPersist": "10m"})
+    cmd = host.ssh_cmd()
+    assert cmd.index("ControlPersist=10m") < cmd.index("ControlPersist=60s")
+
+    close_control_masters()
+    assert not control_dir.exists()
+
+
+def test_async_host_group() -> None:
+    group = AsyncHostGroup([Host("a"), Host("b"), Host("c")], max_concurrency=2)
+    results = asyncio.run(
+        group.run_local(
+            "echo $env_var", extra_env=dict(env_var="true"), stdout=subprocess.PIPE
+        )
+    )
+    assert [r.host.host for r in results] == ["a", "b", "c"]
+    assert all(r.result.stdout == "true\n" for r in results)
+
+    results = asyncio.run(group.run_local(["false"], check=False))
+    assert all(r.result.returncode == 1 for r in results)
+    with pytest.raises(Exception, match="3 hosts failed"):
+        asyncio.run(group.run_local(["false"]))
+
+
+def is_running(pid: int) -> bool:
+    try:
+        stat = Path(f"/proc/{pid}/stat").read_text()
+    except FileNotFoundError:
+        return False
+    # killed orphans stay zombies until init reaps them
+    return stat.rsplit(")", 1)[1].split()[0] != "Z"
+
+
+def test_async_host_group_timeout(tmp_path: Path) -> None:
+    pid_file = tmp_path / "pid"
+    group = AsyncHostGroup([Host("some_host")])
+    # the shell starts a child that would outlive a kill of the shell alone
+    results = asyncio.run(
+        group.run_local(
+            f"sleep 10 & echo $! > {pid_file}; wait", timeout=0.5, check=False
+        )
+    )
+    with pytest.raises(subprocess.TimeoutExpired):
+        results[0].result
+    pid = int(pid_file.read_text())
+    for _ in range(100):
+        if not is_running(pid):
+            break
+        time.sleep(0.01)
+    else:
+        raise AssertionError(f"the child of the shell ({pid}) is still running")
+
+
+def test_async_run_function() -> None:
+    group = AsyncHostGroup([Host(f"host{i}") for i in range(6)])
+    running = 0
+    max_running = 0
+
+    async def some_func(h: Host) -> str:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return h.host
+
+    results = asyncio.run(group.run_function(some_func, max_concurrency=2))
+    assert [r.result for r in results] == [f"host{i}" for i in range(6)]
+    assert max_running == 2
+
+
+def test_stdout_not_truncated(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(ssh, "MAX_STDERR_BYTES", 1024)
+    monkeypatch.setattr(async_host_group, "MAX_STDERR_BYTES", 1024)
+    host = Host("some_host")
+    cmd = ["sh", "-c", "head -c 100000 /dev/zero | tr '\\0' x"]
+    # stdout is parsed by the callers, so it is never cut short
+    proc = host.run_local(cmd, stdout=subprocess.PIPE)
+    assert proc.stdout == "x" * 100000
+    proc = asyncio.run(async_host_group.run_local(host, cmd, stdout=subprocess.PIPE))
+    assert proc.stdout == "x" * 100000
+
+
+def test_run_from_running_loop() -> None:
+    group = HostGroup([Host("a"), Host("b")])
+
+    async def some_func(h: Host) -> str:
+        # HostGroup runs its commands in threads, not on the running event loop
+        results = group.run_local(["echo", h.host], stdout=subprocess.PIPE)
+        return "".join(r.result.stdout for r in results)
+
+    results = asyncio.run(AsyncHostGroup(group.hosts).run_function(some_func))
+    assert [r.result for r in results] == ["a\na\n", "b\nb\n"]
+
+    async def failing_func(h: Host) -> None:
+        group.run_local(["false"])
+
+    failures = asyncio.run(
+        AsyncHostGroup(group.hosts).run_function(failing_func, check=False)
+    )
+    assert all("2 hosts failed" in str(r.error) for r in failures)
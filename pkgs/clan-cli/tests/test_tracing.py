@@ -0,0 +1,87 @@
+import json
+import tempfile
+import threading
+from pathlib import Path
+
+import pytest
+
+from clan_cli import tracing
+from clan_cli.tracing import Tracer, normalize_command, propagate, span
+
+
+def test_normalize_command() -> None:
+    tmp = tempfile.gettempdir()
+    assert normalize_command(["git", "-C", f"{tmp}/tmpabc123/repo", "add"]) == (
+        "git -C $TMPDIR/.../repo add"
+    )
+    assert normalize_command(
+        ["nix-store", "-q", "/nix/store/" + "a" * 32 + "-hello-2.12"]
+    ) == ("nix-store -q /nix/store/...-hello-2.12")
+    # the nix_shell wrapper is not part of the key
+    assert (
+        normalize_command(
+            ["sh", "-c", 'PATH="$0:$PATH"; exec "$@"', "/nix/store/x/bin", "git", "log"]
+        )
+        == "git log"
+    )
+    assert normalize_command(["nix", "shell", "nixpkgs#git", "-c", "git"]) == "git"
+
+
+def test_span_nesting(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(tracing, "TRACER", Tracer())
+    monkeypatch.setenv("PERF", "1")
+    result: list[int | None] = []
+    with span("deploy", machine="machine1") as outer:
+        with span("copy") as inner:
+            pass
+
+        @propagate
+        def in_thread() -> None:
+            with span("activate") as s:
+                result.append(s.parent_id)
+                assert s.attributes["machine"] == "machine1"
+
+        thread = threading.Thread(target=in_thread)
+        thread.start()
+        thread.join()
+
+    assert inner.parent_id == outer.span_id
+    assert inner.attributes == {"machine": "machine1"}
+    assert result == [outer.span_id]
+    assert inner in tracing.TRACER.spans and outer in tracing.TRACER.spans
+    summary = tracing.TRACER.summary()
+    assert summary["[deploy]"] >= summary["[copy]"]
+
+
+def test_write_trace(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # threads are named after their first machine, spans of other tests get in the way
+    tracer = Tracer()
+    tracer.output = tmp_path / "trace.json"
+    monkeypatch.setattr(tracing, "TRACER", tracer)
+    with span("deploy", machine="machine1"):
+        with span("git status", category="cmd"):
+            pass
+
+    tracer.write(tmp_path / "trace.json")
+    events = json.loads((tmp_path / "trace.json").read_text())["traceEvents"]
+    names = {e["name"] for e in events}
+    assert {"deploy", "git status", "thread_name"} <= names
+    assert any(e["args"] == {"name": "machine1"} for e in events)
+
+    tracer.write(tmp_path / "trace.otlp.json")
+    otlp = json.loads((tmp_path / "trace.otlp.json").read_text())
+    spans = otlp["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    by_name = {s["name"]: s for s in spans}
+    assert by_name["git status"]["parentSpanId"] == by_name["deploy"]["spanId"]
+
+
+def test_spans_not_kept(monkeypatch: pytest.MonkeyPatch) -> None:
+    tracer = Tracer()
+    monkeypatch.setattr(tracing, "TRACER", tracer)
+    monkeypatch.delenv("PERF", raising=False)
+    # without an output or PERF=1 nothing would read the spans
+    with span("deploy") as outer:
+        with span("copy") as inner:
+            pass
+    assert inner.parent_id == outer.span_id
+    assert tracer.spans == []